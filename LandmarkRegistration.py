@@ -1,5 +1,8 @@
 import os, string
+import logging
+import math
 import time
+import numpy
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 
@@ -53,17 +56,23 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
     self.sliceNodesByVolumeID = {}
     self.observerTags = []
     self.interactorObserverTags = []
+    self.interactorMap = {} # interactor -> dictionary of the nodes shown in its slice view
+    self.restrictedViewsKey = None # inputs of the last restrictLandmarksToViews
+    self.pointListViewStates = {} # pointList ID -> (view node IDs, hidden) last applied
+    self.cachedRegistrationState = None # see registrationState
     self.viewNames = ("Fixed", "Moving", "Transformed")
     self.volumeSelectDialog = None
     self.currentRegistrationInterface = None
     self.currentLocalRefinementInterface = None
+    # landmark drags update the registration at most this often
+    self.landmarkMovedScheduler = RegistrationLib.UpdateScheduler(self.updateLandmarkMoved, maximumRate=30)
 
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
 
     if self.developerMode:
       # reload and run specific tests
-      scenarios = ("Basic", "Affine", "ThinPlate", "VTKv6Picking", "ManyLandmarks")
+      scenarios = ("Basic", "Affine", "ThinPlate", "VTKv6Picking", "ManyLandmarks", "LinearSolver", "CrossValidation", "Wendland", "BSpline")
       for scenario in scenarios:
         button = qt.QPushButton("Reload and Test %s" % scenario)
         button.toolTip = "Reload this module and then run the %s self test." % scenario
@@ -205,9 +214,20 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
                                   self.registrationTypeButtons[registrationType])
     registrationFormLayout.addWidget(self.registrationTypeBox)
 
+    self.updateRateSpinBox = qt.QSpinBox()
+    self.updateRateSpinBox.minimum = 0
+    self.updateRateSpinBox.maximum = 120
+    self.updateRateSpinBox.suffix = " Hz"
+    self.updateRateSpinBox.specialValueText = "Unlimited"
+    self.updateRateSpinBox.value = self.landmarkMovedScheduler.maximumRate
+    self.updateRateSpinBox.setToolTip( "Maximum rate at which the registration is updated while a landmark is dragged.  The final position is always used." )
+    self.updateRateSpinBox.connect('valueChanged(int)', self.onUpdateRateChanged)
+    registrationFormLayout.addRow("Drag update rate ", self.updateRateSpinBox)
+
     # connections
     for selector in self.volumeSelectors.values():
       selector.connect("currentNodeChanged(vtkMRMLNode*)", self.onVolumeNodeSelect)
+    self.transformSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.invalidateRegistrationState)
 
     # listen to the scene
     self.addObservers()
@@ -341,6 +361,8 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
   def cleanup(self):
     self.removeObservers()
     self.landmarksWidget.removeLandmarkObservers()
+    self.logic.landmarkIndex.removeObservers()
+    self.logic.pointListAssociation.removeObservers()
 
   def addObservers(self):
     """Observe the mrml scene for changes that we wish to respond to.
@@ -352,10 +374,33 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
      - when points are manipulated, perform (or schedule) an update
        to the currently active registration method.
     """
-    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeAddedEvent, self.landmarksWidget.requestNodeAddedUpdate)
+    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeAddedEvent, self.landmarksWidget.onSceneNodeAdded)
+    self.observerTags.append( (slicer.mrmlScene, tag) )
+    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self.landmarksWidget.onSceneNodeRemoved)
+    self.observerTags.append( (slicer.mrmlScene, tag) )
+    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeAddedEvent, self.onSceneNodeAddedOrRemoved)
     self.observerTags.append( (slicer.mrmlScene, tag) )
-    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self.landmarksWidget.requestNodeAddedUpdate)
+    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self.onSceneNodeAddedOrRemoved)
     self.observerTags.append( (slicer.mrmlScene, tag) )
+    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self.onSceneNodeRemoved)
+    self.observerTags.append( (slicer.mrmlScene, tag) )
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onSceneNodeAddedOrRemoved(self,caller,event,node):
+    """A point list appearing or going away can change the
+    lists associated with the selected volumes"""
+    if node and node.IsA("vtkMRMLMarkupsFiducialNode"):
+      self.invalidateRegistrationState()
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onSceneNodeRemoved(self,caller,event,node):
+    """Forget a removed point list in the interactor map, so that a
+    list created later for the same volume is looked up again"""
+    if node and node.IsA("vtkMRMLMarkupsFiducialNode"):
+      for entry in self.interactorMap.values():
+        if entry['pointList'] == node:
+          entry['pointList'] = None
+          entry['generation'] = None
 
   def removeObservers(self):
     """Remove observers and any other cleanup needed to
@@ -366,7 +411,8 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
     self.observerTags = []
 
   def addInteractorObservers(self):
-    """Add observers to the Slice interactors
+    """Add observers to the Slice interactors and to the
+    composite nodes of their views
     """
     self.removeInteractorObservers()
     layoutManager = slicer.app.layoutManager()
@@ -377,30 +423,80 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
       interactor = sliceView.interactorStyle().GetInteractor()
       tag = interactor.AddObserver(vtk.vtkCommand.MouseMoveEvent, self.processSliceEvents)
       self.interactorObserverTags.append( (interactor, tag) )
+      compositeNode = sliceLogic.GetSliceCompositeNode()
+      tag = compositeNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onSliceCompositeNodeModified)
+      self.interactorObserverTags.append( (compositeNode, tag) )
+    self.updateInteractorMap()
+
+  def updateInteractorMap(self):
+    """Precompute, for each observed slice interactor, the composite node,
+    the background volume and its point list so that mouse move
+    events do not need to search the layout or the scene.
+    Call this when the layout or the volume selection changes.
+    Entries also follow changes of the background volume and removed
+    point lists, see processSliceEvents."""
+    self.interactorMap = {}
+    layoutManager = slicer.app.layoutManager()
+    for sliceNodeName in self.sliceNodesByViewName.keys():
+      sliceWidget = layoutManager.sliceWidget(sliceNodeName)
+      interactor = sliceWidget.sliceView().interactorStyle().GetInteractor()
+      compositeNode = sliceWidget.sliceLogic().GetSliceCompositeNode()
+      volumeID = compositeNode.GetBackgroundVolumeID()
+      volumeNode = slicer.mrmlScene.GetNodeByID(volumeID) if volumeID else None
+      self.interactorMap[interactor] = {
+        'compositeNode': compositeNode,
+        'volume': volumeNode,
+        'pointList': self.logic.volumePointList(volumeNode),
+        'isLandmarkList': False,
+        'generation': None, # landmark index generation of isLandmarkList
+        }
+
+  def onSliceCompositeNodeModified(self,caller,event):
+    """Follow a background volume changed in a slice controller, so
+    that landmark jumps and view restrictions use the views that show
+    each volume now"""
+    sliceNodesByVolumeID = self.sliceNodesByVolumeIDInLayout()
+    if sliceNodesByVolumeID == self.sliceNodesByVolumeID:
+      return
+    self.sliceNodesByVolumeID = sliceNodesByVolumeID
+    if not self.landmarksWidget.movingView:
+      self.restrictLandmarksToViews()
 
   def removeInteractorObservers(self):
-    """Remove observers from the Slice interactors
+    """Remove observers from the Slice interactors and
+    their composite nodes
     """
     for obj,tag in self.interactorObserverTags:
       obj.RemoveObserver(tag)
     self.interactorObserverTags = []
+    self.interactorMap = {}
 
   def registrationState(self):
     """Return an instance of RegistrationState populated
-    with current gui parameters"""
-    state = RegistrationLib.RegistrationState()
-    state.logic = self.logic
-    state.fixed = self.volumeSelectors["Fixed"].currentNode()
-    state.moving = self.volumeSelectors["Moving"].currentNode()
-    state.transformed = self.volumeSelectors["Transformed"].currentNode()
-    state.fixedPoints = self.logic.volumePointList(state.fixed)
-    state.movingPoints = self.logic.volumePointList(state.moving)
-    state.transformedPoints = self.logic.volumePointList(state.transformed)
-    state.transform = self.transformSelector.currentNode()
+    with current gui parameters.
+    The same instance is returned until invalidateRegistrationState
+    is called, only the current landmark name is refreshed."""
+    state = self.cachedRegistrationState
+    if state is None:
+      state = RegistrationLib.RegistrationState()
+      state.logic = self.logic
+      state.fixed = self.volumeSelectors["Fixed"].currentNode()
+      state.moving = self.volumeSelectors["Moving"].currentNode()
+      state.transformed = self.volumeSelectors["Transformed"].currentNode()
+      state.fixedPoints = self.logic.volumePointList(state.fixed)
+      state.movingPoints = self.logic.volumePointList(state.moving)
+      state.transformedPoints = self.logic.volumePointList(state.transformed)
+      state.transform = self.transformSelector.currentNode()
+      self.cachedRegistrationState = state
     state.currentLandmarkName = self.landmarksWidget.selectedLandmark
 
     return(state)
 
+  def invalidateRegistrationState(self,*args):
+    """Rebuild the registration state on next use, e.g. after
+    a selector changed or point lists were created"""
+    self.cachedRegistrationState = None
+
   def currentVolumeNodes(self):
     """List of currently selected volume nodes"""
     volumeNodes = []
@@ -412,6 +508,7 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
 
   def onVolumeNodeSelect(self):
     """When one of the volume selectors is changed"""
+    self.invalidateRegistrationState()
     volumeNodes = self.currentVolumeNodes()
     self.landmarksWidget.setVolumeNodes(volumeNodes)
     fixed = self.volumeSelectors['Fixed'].currentNode()
@@ -419,6 +516,7 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
     transformed = self.volumeSelectors['Transformed'].currentNode()
     self.registrationCollapsibleButton.enabled = bool(fixed and moving)
     self.logic.hiddenPointVolumes = (transformed,)
+    self.updateInteractorMap()
 
   def onLayout(self, layoutMode="Axi/Sag/Cor",volumesToShow=None):
     """When the layout is changed by the VisualizationWidget
@@ -463,7 +561,7 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
     self.currentRegistrationInterface = interfaceClass(self.registrationCollapsibleButton)
     # argument registrationState is a callable that gets current state
     self.currentRegistrationInterface.create(self.registrationState)
-    self.currentRegistrationInterface.onLandmarkEndMoving(self.registrationState)
+    self.currentRegistrationInterface.onLandmarkEndMoving(self.registrationState())
 
   def onLocalRefinementMethod(self,pickedLocalRefinementMethod):
     """Pick which local refinement method to display"""
@@ -476,109 +574,140 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
 
   def updateSliceNodesByVolumeID(self):
     """Build a mapping to a list of slice nodes
-    node that are currently displaying a given volumeID"""
+    node that are currently displaying a given volumeID.
+    It is kept up to date with the background volumes by
+    onSliceCompositeNodeModified."""
+    self.sliceNodesByVolumeID = self.sliceNodesByVolumeIDInLayout()
+    self.addInteractorObservers()
+
+  def sliceNodesByVolumeIDInLayout(self):
+    """Return the mapping from volumeIDs to the slice nodes of the
+    layout showing them in the background"""
     compositeNodes = slicer.util.getNodesByClass('vtkMRMLSliceCompositeNode')
-    self.sliceNodesByVolumeID = {}
+    sliceNodesByVolumeID = {}
     if self.sliceNodesByViewName:
       for sliceNode in self.sliceNodesByViewName.values():
         for compositeNode in compositeNodes:
           if compositeNode.GetLayoutName() == sliceNode.GetLayoutName():
             volumeID = compositeNode.GetBackgroundVolumeID()
-            if volumeID in self.sliceNodesByVolumeID:
-              self.sliceNodesByVolumeID[volumeID].append(sliceNode)
+            if volumeID in sliceNodesByVolumeID:
+              sliceNodesByVolumeID[volumeID].append(sliceNode)
             else:
-              self.sliceNodesByVolumeID[volumeID] = [sliceNode,]
-
-    self.addInteractorObservers()
+              sliceNodesByVolumeID[volumeID] = [sliceNode,]
+    return sliceNodesByVolumeID
 
   def processSliceEvents(self, caller=None, event=None):
+    """Make the point list of the volume under the mouse the active
+    list, so that new points are placed in it"""
     if caller is None:
       return
 
-    applicationLogic = slicer.app.applicationLogic()
-    layoutManager = slicer.app.layoutManager()
-    compositeNode = None
-    for sliceNodeName in self.sliceNodesByViewName.keys():
-      sliceWidget = layoutManager.sliceWidget(sliceNodeName)
-      sliceLogic = sliceWidget.sliceLogic()
-      sliceView = sliceWidget.sliceView()
-      interactor = sliceView.interactorStyle().GetInteractor()
-      if not interactor is caller:
-        continue
-
-      compositeNode = sliceLogic.GetSliceCompositeNode()
-      break
-
-    if compositeNode is None:
-      return
-
-    volumeID = compositeNode.GetBackgroundVolumeID()
-    if volumeID is None:
+    entry = self.interactorMap.get(caller)
+    if entry is None:
       return
-
-    volumeNode = slicer.util.getNode(volumeID)
-    if volumeNode is None:
+    volumeID = entry['compositeNode'].GetBackgroundVolumeID()
+    if volumeID != (entry['volume'].GetID() if entry['volume'] else None):
+      # the background was changed in the slice controller
+      entry['volume'] = slicer.mrmlScene.GetNodeByID(volumeID) if volumeID else None
+      entry['pointList'] = None
+      entry['generation'] = None
+    if entry['volume'] is None:
       return
 
-    pointList = self.logic.volumePointList(volumeNode)
+    pointList = entry['pointList']
+    if pointList and pointList.GetScene() is None:
+      # removed from the scene
+      pointList = entry['pointList'] = None
     if not pointList:
-      return
+      # the list is created with the first landmark on this volume
+      pointList = entry['pointList'] = self.logic.volumePointList(entry['volume'])
+      if not pointList:
+        return
+
+    generation = self.logic.landmarkIndex.generation
+    if entry['generation'] != generation:
+      # landmarks have one point in the list of every current volume,
+      # so the list is in use if it belongs to a current volume and
+      # there is at least one landmark
+      volumeNodes = self.currentVolumeNodes()
+      landmarks = self.logic.landmarksForVolumes(volumeNodes)
+      entry['isLandmarkList'] = bool(landmarks) and entry['volume'] in volumeNodes
+      entry['generation'] = generation
 
-    pointsInLandmarks = False
-    volumeNodes = self.currentVolumeNodes()
-    landmarks = self.logic.landmarksForVolumes(volumeNodes)
-    for landmarkName in landmarks:
-      if pointsInLandmarks:
-        break
-      for tempList,index in landmarks[landmarkName]:
-        if tempList == pointList:
-          pointsInLandmarks = True
-          break
-
-    if pointsInLandmarks:
+    if entry['isLandmarkList']:
       markupsLogic = slicer.modules.markups.logic()
-      markupsLogic.SetActiveListID(pointList)
+      if markupsLogic.GetActiveListID() != pointList.GetID():
+        markupsLogic.SetActiveListID(pointList)
 
   def restrictLandmarksToViews(self):
     """Set points so they only show up in the view
     for the volume on which they were defined.
     Also turn off other point lists, since leaving
     them visible can interfere with picking.
-    Since multiple landmarks will be in the same lists, keep track of the
-    lists that have been processed to avoid duplicated updates.
+    The display nodes are only rewritten when the layout, the volume
+    selection or the set of point lists changed since the last call,
+    and then only for the lists whose restriction differs from
+    what was last applied.
     """
-    slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+    if not self.sliceNodesByViewName:
+      return
     volumeNodes = self.currentVolumeNodes()
-    if self.sliceNodesByViewName:
-      landmarks = self.logic.landmarksForVolumes(volumeNodes)
-      activePointLists = []
-      processedPointLists = []
-      for landmarkName in landmarks:
-        for pointList,index in landmarks[landmarkName]:
-          if pointList in processedPointLists:
-            continue
-          processedPointLists.append(pointList)
-          activePointLists.append(pointList)
-          displayNode = pointList.GetDisplayNode()
-          displayNode.RemoveAllViewNodeIDs()
-          volumeNodeID = pointList.GetAttribute("AssociatedNodeID")
-          if volumeNodeID:
-            if volumeNodeID in self.sliceNodesByVolumeID:
-              for sliceNode in self.sliceNodesByVolumeID[volumeNodeID]:
-                displayNode.AddViewNodeID(sliceNode.GetID())
-                for hiddenVolume in self.logic.hiddenPointVolumes:
-                  if hiddenVolume and volumeNodeID == hiddenVolume.GetID():
-                    displayNode.SetVisibility(False)
-      allPointLists = slicer.util.getNodesByClass('vtkMRMLMarkupsFiducialNode')
-      for pointList in allPointLists:
-        if pointList not in activePointLists:
-          displayNode = pointList.GetDisplayNode()
-          if displayNode:
-            displayNode.SetVisibility(False)
-            displayNode.RemoveAllViewNodeIDs()
-            displayNode.AddViewNodeID("__invalid_view_id__")
+    landmarks = self.logic.landmarksForVolumes(volumeNodes)
+    activePointLists = set()
+    if landmarks:
+      # every landmark has one point in each of the active lists
+      for pointList,index in next(iter(landmarks.values())):
+        activePointLists.add(pointList)
+    allPointListIDs = self.landmarksWidget.observedPointListIDs()
+    key = (
+      tuple(sorted([(volumeID, tuple([sliceNode.GetID() for sliceNode in sliceNodes]))
+                    for volumeID,sliceNodes in self.sliceNodesByVolumeID.items() if volumeID])),
+      tuple(sorted([pointList.GetID() for pointList in activePointLists])),
+      tuple([volume.GetID() for volume in self.logic.hiddenPointVolumes if volume]),
+      allPointListIDs,
+      )
+    if key == self.restrictedViewsKey:
+      return
+    self.restrictedViewsKey = key
+    # forget lists that left the scene, their IDs may be reused
+    for pointListID in list(self.pointListViewStates.keys()):
+      if pointListID not in allPointListIDs:
+        del self.pointListViewStates[pointListID]
+
+    hiddenVolumeIDs = set([volume.GetID() for volume in self.logic.hiddenPointVolumes if volume])
+    slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+    activePointListIDs = set()
+    for pointList in activePointLists:
+      activePointListIDs.add(pointList.GetID())
+      viewNodeIDs = ()
+      hidden = False
+      volumeNodeID = self.logic.pointListVolumeID(pointList)
+      if volumeNodeID and volumeNodeID in self.sliceNodesByVolumeID:
+        viewNodeIDs = tuple([sliceNode.GetID() for sliceNode in self.sliceNodesByVolumeID[volumeNodeID]])
+        hidden = volumeNodeID in hiddenVolumeIDs
+      self.applyPointListViewState(pointList, viewNodeIDs, hidden)
+    for pointListID in allPointListIDs - activePointListIDs:
+      pointList = slicer.mrmlScene.GetNodeByID(pointListID)
+      if pointList:
+        self.applyPointListViewState(pointList, ("__invalid_view_id__",), True)
     slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
 
+  def applyPointListViewState(self,pointList,viewNodeIDs,hidden):
+    """Restrict the display of pointList to viewNodeIDs and hide it if
+    requested, unless that is already the state last applied"""
+    state = (viewNodeIDs, hidden)
+    if self.pointListViewStates.get(pointList.GetID()) == state:
+      return
+    displayNode = pointList.GetDisplayNode()
+    if not displayNode:
+      return
+    self.pointListViewStates[pointList.GetID()] = state
+    displayNode.RemoveAllViewNodeIDs()
+    for viewNodeID in viewNodeIDs:
+      displayNode.AddViewNodeID(viewNodeID)
+    if hidden:
+      displayNode.SetVisibility(False)
+
   def onLocalRefineClicked(self):
     """Refine the selected landmark"""
     timing = True
@@ -601,12 +730,11 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
     if not self.landmarksWidget.movingView:
       # only change the points if they are not being manipulated
       self.restrictLandmarksToViews()
-    self.updateSliceNodesByVolumeID()
     volumeNodes = self.currentVolumeNodes()
     landmarksByName = self.logic.landmarksForVolumes(volumeNodes)
     if landmarkName in landmarksByName:
       for pointList,index in landmarksByName[landmarkName]:
-        volumeNodeID = pointList.GetAttribute("AssociatedNodeID")
+        volumeNodeID = self.logic.pointListVolumeID(pointList)
         if volumeNodeID in self.sliceNodesByVolumeID:
           point = pointList.GetNthControlPointPosition(index)
           for sliceNode in self.sliceNodesByVolumeID[volumeNodeID]:
@@ -617,19 +745,32 @@ class LandmarkRegistrationWidget(ScriptedLoadableModuleWidget):
     else:
       self.localRefineButton.text = 'No landmark selected for refinement'
 
+  def onUpdateRateChanged(self,rate):
+    self.landmarkMovedScheduler.maximumRate = rate
+
   def onLandmarkMoved(self,landmarkName):
     """Called when a landmark is moved (probably through
     manipulation of the widget in the slice view).
-    This updates the active registration"""
+    This schedules an update of the active registration"""
+    if self.currentRegistrationInterface:
+      self.landmarkMovedScheduler.request(landmarkName)
+
+  def updateLandmarkMoved(self,landmarkName):
+    """Update the active registration for a moved landmark"""
     if self.currentRegistrationInterface:
       state = self.registrationState()
       self.currentRegistrationInterface.onLandmarkMoved(state)
 
   def onLandmarkEndMoving(self,landmarkName):
-    """Called when a landmark is done being moved (e.g. when mouse button released)"""
+    """Called when a landmark is done being moved (e.g. when mouse button released).
+    Intermediate updates still pending are dropped since this one uses the final position."""
+    self.landmarkMovedScheduler.cancel()
     if self.currentRegistrationInterface:
       state = self.registrationState()
       self.currentRegistrationInterface.onLandmarkEndMoving(state)
+    processed,skipped = self.landmarkMovedScheduler.counts()
+    logging.debug("Landmark %s moved: %d updates processed, %d skipped" % (landmarkName, processed, skipped))
+    self.landmarkMovedScheduler.resetCounts()
 
   def onReload(self,moduleName="LandmarkRegistration"):
     """Generic reload method for any scripted module.
@@ -728,7 +869,96 @@ class LandmarkRegistrationLogic(ScriptedLoadableModuleLogic):
     self.cropLogic = None
     if hasattr(slicer.modules, 'cropvolume'):
       self.cropLogic = slicer.modules.cropvolume.logic()
-
+    self.landmarkIndex = RegistrationLib.LandmarkIndex()
+    self.pointListAssociation = RegistrationLib.PointListAssociation()
+    self.landmarkSetCache = (None, None, None) # (tuple of listIDs, generation, LandmarkSet) of the last request
+    self.outlierLandmarks = set() # names rejected by the last robust fit
+    self.outlierObservers = [] # callables notified when outlierLandmarks changes
+    self.landmarkResiduals = None # RegistrationLib.ResidualReport of the last registration update
+    self.residualObservers = [] # callables notified with each new landmarkResiduals
+
+
+  def setOutlierLandmarks(self,names):
+    """Record the landmarks rejected by a robust registration
+    and notify the outlier observers if they changed"""
+    names = set(names)
+    if names == self.outlierLandmarks:
+      return
+    self.outlierLandmarks = names
+    for observer in list(self.outlierObservers):
+      observer(names)
+
+  def setLandmarkResiduals(self,report):
+    """Record the residual report of the current registration
+    (or None) and pass it to the residual observers"""
+    self.landmarkResiduals = report
+    for observer in list(self.residualObservers):
+      observer(report)
+
+  def residualsForVolumes(self,volumeNodes,transformNode,method=None,fitMask=None):
+    """Return a RegistrationLib.ResidualReport of transformNode for the
+    landmarks of the (fixed, moving) volumeNodes.  The moving landmarks
+    are mapped through the transform in one call.  With method (a linear
+    mode or 'ThinPlate'), the transform is the fit of that method and
+    leave-one-out errors are included; fitMask tells which landmarks
+    the fit used."""
+    landmarkSet = self.landmarkSetForVolumes(volumeNodes)
+    return RegistrationLib.computeResiduals(landmarkSet, transformNode, method, fitMask)
+
+  def updateLandmarkResiduals(self,state,method=None,fitMask=None,leaveOneOut=None):
+    """Recompute the residuals of the registration in state after its
+    transform was updated and notify the residual observers.
+    See residualsForVolumes for method and fitMask.  Registrations that
+    keep their leave-one-out residuals up to date pass them as leaveOneOut,
+    one row per landmark with a defined position."""
+    if not state.transform or not state.fixedPoints or not state.movingPoints:
+      self.setLandmarkResiduals(None)
+      return
+    landmarkSet = state.landmarkSet()
+    self.setLandmarkResiduals(RegistrationLib.computeResiduals(landmarkSet, state.transform, method, fitMask,
+                                                               leaveOneOut=leaveOneOut))
+
+  def crossValidate(self,method,volumeNodes=None):
+    """Return a RegistrationLib.ResidualReport with the fit and leave-one-out
+    errors of every landmark for method, one of
+    RegistrationLib.leaveOneOutMethods ('Rigid', 'Similarity', 'Affine'
+    or 'ThinPlate').  The fits are computed from the landmarks of the
+    (fixed, moving) volumeNodes, by default those of the current
+    registration, independently of the transform node.  All leave-one-out
+    residuals come from a single fit, see RegistrationLib.Validation."""
+    if volumeNodes is None:
+      volumeNodes = self.registrationState().volumeNodes()
+    landmarkSet = self.landmarkSetForVolumes(volumeNodes)
+    return RegistrationLib.crossValidate(landmarkSet, method)
+
+  def bootstrapUncertainty(self,method,volumeNodes=None,replicates=100,step=4,workers=None,seed=0):
+    """Estimate the uncertainty of the transform fitted with method
+    (a linear mode or 'ThinPlate') by refitting it to replicates
+    resamplings of the landmarks of the (fixed, moving) volumeNodes,
+    by default those of the current registration.
+    Displacements are evaluated on every step-th voxel of the fixed volume,
+    in a pool of workers threads (default: one per cpu), see
+    RegistrationLib.bootstrapDisplacements.
+    Returns two new volume nodes on that grid: a vector volume with the
+    mean displacement and a scalar volume with its standard deviation
+    (the root of the summed component variances), in mm."""
+    if volumeNodes is None:
+      volumeNodes = self.registrationState().volumeNodes()
+    fixedVolume = volumeNodes[0]
+    landmarkSet = self.landmarkSetForVolumes(volumeNodes)
+    fixedPoints = landmarkSet.column(0, definedOnly=True)
+    movingPoints = landmarkSet.column(1, definedOnly=True)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    fixedVolume.GetIJKToRASMatrix(ijkToRAS)
+    ijkToRAS = slicer.util.arrayFromVTKMatrix(ijkToRAS) @ numpy.diag((step, step, step, 1))
+    dimensions = [int(math.ceil(dimension / step)) for dimension in fixedVolume.GetImageData().GetDimensions()]
+    mean,std = RegistrationLib.bootstrapDisplacements(fixedPoints, movingPoints, method, ijkToRAS, dimensions,
+                                                      replicates=replicates, seed=seed, workers=workers)
+    meanNode = slicer.util.addVolumeFromArray(mean, ijkToRAS, fixedVolume.GetName() + "-bootstrap-mean",
+                                              nodeClassName="vtkMRMLVectorVolumeNode")
+    stdNode = slicer.util.addVolumeFromArray(numpy.sqrt((std * std).sum(axis=-1)), ijkToRAS,
+                                             fixedVolume.GetName() + "-bootstrap-std")
+    return meanNode, stdNode
 
   def setPointListDisplay(self,pointList):
     displayNode = pointList.GetDisplayNode()
@@ -748,55 +978,99 @@ class LandmarkRegistrationLogic(ScriptedLoadableModuleLogic):
     If list already has a point with the given name, then
     set the position to the passed value.
     """
+    self.addPoints((name,), (position,), associatedNode)
+
+  def addPoints(self,names,positions,associatedNode):
+    """Add or update the named points of the list associated with
+    associatedNode, creating the list if needed.
+    positions is a sequence (or (N,3) array) with one RAS position per name.
+    Existing points are found through the landmark index and moved,
+    new points are clipped to the bounds of associatedNode.
+    All points are processed in a single scene batch state.
+    Several points are also added in one point list modification,
+    whose events carry no point index, so the landmark index rescans
+    the list once afterwards; a single point is added without it so
+    that its events keep the index and the labels are updated in place.
+    """
+    positions = numpy.array(positions, dtype=float).reshape(-1,3)
+    if len(names) != positions.shape[0]:
+      raise ValueError("Got %d names but %d positions" % (len(names), positions.shape[0]))
 
     markupsLogic = slicer.modules.markups.logic()
     originalActiveListID = markupsLogic.GetActiveListID() # TODO: naming convention?
     slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
 
     # make the point list if required
-    listName = associatedNode.GetName() + "-landmarks"
-    pointList = slicer.mrmlScene.GetFirstNodeByName(listName)
+    pointList = self.volumePointList(associatedNode)
     if not pointList:
+      listName = self.pointListAssociation.listName(associatedNode)
       pointListNodeID = markupsLogic.AddNewFiducialNode(listName,slicer.mrmlScene)
       pointList = slicer.mrmlScene.GetNodeByID(pointListNodeID)
       pointList.SetMarkupLabelFormat("L-%d")
-      if associatedNode:
-        pointList.SetAttribute("AssociatedNodeID", associatedNode.GetID())
+      self.pointListAssociation.associate(associatedNode, pointList)
       self.setPointListDisplay(pointList)
 
     # make this active so that the fids will be added to it
     markupsLogic.SetActiveListID(pointList)
 
-    foundLandmarkPoint = False
-    pointSize = pointList.GetNumberOfControlPoints()
-    for pointIndex in range(pointSize):
-      if pointList.GetNthControlPointLabel(pointIndex) == name:
+    # clip new points to min/max bounds of target volume
+    rasBounds = [0,]*6
+    associatedNode.GetRASBounds(rasBounds)
+    clippedPositions = numpy.clip(positions, rasBounds[::2], rasBounds[1::2])
+
+    batch = len(names) > 1
+    if batch:
+      # the index is stale during the modification, track added points here
+      indicesByLabel = dict(self.landmarkIndex.labelIndex(pointList))
+      wasModifying = pointList.StartModify()
+    for name,position,clippedPosition in zip(names, positions, clippedPositions):
+      if batch:
+        pointIndex = indicesByLabel.get(name)
+      else:
+        pointIndex = self.landmarkIndex.labelIndex(pointList).get(name)
+      if pointIndex is not None:
         pointList.SetNthControlPointPosition(pointIndex, *position)
-        foundLandmarkPoint = True
-        break
-
-    if not foundLandmarkPoint:
-      if associatedNode:
-        # clip point to min/max bounds of target volume
-        rasBounds = [0,]*6
-        associatedNode.GetRASBounds(rasBounds)
-        for i in range(3):
-          if position[i] < rasBounds[2*i]:
-            position[i] = rasBounds[2*i]
-          if position[i] > rasBounds[2*i+1]:
-            position[i] = rasBounds[2*i+1]
-      pointList.AddControlPoint(position, "")
-      pointIndex = pointList.GetNumberOfControlPoints()-1
-
-    pointList.SetNthControlPointLabel(pointIndex, name)
-    pointList.SetNthControlPointSelected(pointIndex, False)
-    pointList.SetNthControlPointLocked(pointIndex, False)
+      else:
+        pointIndex = pointList.AddControlPoint(list(clippedPosition), name)
+        if batch:
+          indicesByLabel[name] = pointIndex
+      pointList.SetNthControlPointLabel(pointIndex, name)
+      pointList.SetNthControlPointSelected(pointIndex, False)
+      pointList.SetNthControlPointLocked(pointIndex, False)
+    if batch:
+      pointList.EndModify(wasModifying)
 
     originalActiveList = slicer.mrmlScene.GetNodeByID(originalActiveListID)
     if originalActiveList:
       markupsLogic.SetActiveListID(originalActiveList)
     slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
 
+  def importLandmarks(self,path,associatedNode):
+    """Read the landmarks in an fcsv, csv or json file and add or
+    update them in the list associated with associatedNode.
+    Returns the list of landmark names read from the file."""
+    names,positions = RegistrationLib.readLandmarkFile(path)
+    self.addPoints(names, positions, associatedNode)
+    return names
+
+  def exportLandmarks(self,directory,volumeNodes,fileFormat="fcsv"):
+    """Write the point list of each of volumeNodes to
+    directory/<list name>.<fileFormat> (fcsv, csv or json).
+    Each list is read with one bulk call.  Points that are not placed
+    are left out, as they are skipped on import.  Returns the written paths."""
+    paths = []
+    for volumeNode in volumeNodes:
+      pointList = self.volumePointList(volumeNode)
+      if not pointList:
+        continue
+      path = os.path.join(directory, "%s.%s" % (pointList.GetName(), fileFormat))
+      defined = RegistrationLib.definedMaskForPointList(pointList)
+      names = [name for name,isDefined in zip(self.landmarkIndex.labels(pointList), defined) if isDefined]
+      positions = RegistrationLib.arrayFromPointList(pointList)[defined]
+      RegistrationLib.writeLandmarkFile(path, names, positions, volumeNode.GetID())
+      paths.append(path)
+    return paths
+
   def addLandmark(self,volumeNodes=[], position=(0,0,0), movingPosition=(0,0,0)):
     """Add a new landmark by adding correspondingly named
     points to all the current volume nodes.
@@ -806,13 +1080,8 @@ class LandmarkRegistrationLogic(ScriptedLoadableModuleLogic):
     (this way it can account for the current transform).
     """
     state = self.registrationState()
-    landmarks = self.landmarksForVolumes(volumeNodes)
-    index = 0
-    while True:
-      landmarkName = 'L-%d' % index
-      if not landmarkName in landmarks.keys():
-        break
-      index += 1
+    pointLists = [self.volumePointList(volumeNode) for volumeNode in volumeNodes]
+    landmarkName = self.landmarkIndex.newLandmarkName(pointLists)
     for volumeNode in volumeNodes:
       # if the volume is the moving on, map position through transform to world
       if volumeNode == state.moving:
@@ -820,6 +1089,7 @@ class LandmarkRegistrationLogic(ScriptedLoadableModuleLogic):
       else:
         positionToAdd = position
       point = self.addPoint(landmarkName, position=positionToAdd, associatedNode=volumeNode)
+    self.landmarkIndex.nameAllocator.release(landmarkName)
     return landmarkName
 
   def removeLandmarkForVolumes(self,landmark,volumeNodes):
@@ -834,36 +1104,44 @@ class LandmarkRegistrationLogic(ScriptedLoadableModuleLogic):
 
   def volumePointList(self,volumeNode):
     """return point list node that is
-    list associated with the given volume node"""
-    if not volumeNode:
-      return None
-    listName = volumeNode.GetName() + "-landmarks"
-    listNode = slicer.mrmlScene.GetFirstNodeByName(listName)
-    if listNode:
-      if listNode.GetAttribute("AssociatedNodeID") != volumeNode.GetID():
-        self.setPointListDisplay(listNode)
-        listNode.SetAttribute("AssociatedNodeID",volumeNode.GetID())
-    return listNode
+    list associated with the given volume node.
+    The lookup goes through the point list association index,
+    lists only matching by name are adopted on first use."""
+    return self.pointListAssociation.pointListForVolume(volumeNode, adopt=self.setPointListDisplay)
+
+  def pointListVolumeID(self,pointList):
+    """return the ID of the volume node associated with pointList"""
+    return self.pointListAssociation.volumeIDForPointList(pointList)
 
   def landmarksForVolumes(self,volumeNodes):
     """Return a dictionary of keyed by
     landmark name containing pairs (pointListNodes,index)
-    Only points that exist for all volumes are returned."""
-    landmarksByName = {}
-    for volumeNode in volumeNodes:
-      listForVolume = self.volumePointList(volumeNode)
-      if listForVolume:
-        pointSize = listForVolume.GetNumberOfControlPoints()
-        for pointIndex in range(pointSize):
-          pointName = listForVolume.GetNthControlPointLabel(pointIndex)
-          if pointName in landmarksByName:
-            landmarksByName[pointName].append((listForVolume,pointIndex))
-          else:
-            landmarksByName[pointName] = [(listForVolume,pointIndex),]
-    for pointName in list(landmarksByName.keys()):
-      if len(landmarksByName[pointName]) != len(volumeNodes):
-        landmarksByName.__delitem__(pointName)
-    return landmarksByName
+    Only points that exist for all volumes are returned.
+    The dictionary comes from the landmark index and is shared
+    between callers until the labels change, so treat it as read-only."""
+    pointLists = [self.volumePointList(volumeNode) for volumeNode in volumeNodes]
+    return self.landmarkIndex.landmarksForPointLists(pointLists)
+
+  def landmarkSetForVolumes(self,volumeNodes):
+    """Return a RegistrationLib.LandmarkSet with the landmarks shared by
+    the point lists of volumeNodes, one column per volume."""
+    pointLists = [self.volumePointList(volumeNode) for volumeNode in volumeNodes]
+    return self.landmarkSetForPointLists(pointLists)
+
+  def landmarkSetForPointLists(self,pointLists):
+    """Return a RegistrationLib.LandmarkSet with the landmarks shared by
+    pointLists, one column per list.
+    When the lists and the landmark names are those of the last call
+    its rows are reused and only the positions are re-read from the
+    point lists.  Only that set is kept, so removed lists are not held."""
+    key = tuple([pointList.GetID() if pointList else None for pointList in pointLists])
+    cachedKey,generation,landmarkSet = self.landmarkSetCache
+    if cachedKey == key and generation == self.landmarkIndex.generation:
+      landmarkSet.readFromPointLists()
+    else:
+      landmarkSet = RegistrationLib.LandmarkSet.fromPointLists(pointLists, self.landmarkIndex)
+      self.landmarkSetCache = (key, self.landmarkIndex.generation, landmarkSet)
+    return landmarkSet
 
   def ensurePointInListForVolume(self,volumeNode,landmarkName,landmarkPosition):
     """Make sure the point list associated with the given
@@ -875,11 +1153,10 @@ class LandmarkRegistrationLogic(ScriptedLoadableModuleLogic):
     pointList = self.volumePointList(volumeNode)
     if not pointList:
       return None
-    pointSize = pointList.GetNumberOfControlPoints()
-    for pointIndex in range(pointSize):
-      if pointList.GetNthControlPointLabel(pointIndex) == landmarkName:
-        pointList.SetNthControlPointAssociatedNodeID(pointIndex, volumeNode.GetID())
-        return None
+    pointIndex = self.landmarkIndex.labelIndex(pointList).get(landmarkName)
+    if pointIndex is not None:
+      pointList.SetNthControlPointAssociatedNodeID(pointIndex, volumeNode.GetID())
+      return None
     # if we got here, then there is no point with this name so add one
     pointList.AddControlPoint(landmarkPosition, "")
     pointIndex = pointList.GetNumberOfControlPoints()-1
@@ -888,24 +1165,53 @@ class LandmarkRegistrationLogic(ScriptedLoadableModuleLogic):
     pointList.SetNthControlPointLocked(pointIndex, False)
     return landmarkName
 
+  def collectAssociatedPoint(self,volumeNodes,pointList,pointIndex):
+    """If the point at pointIndex of pointList (which is not one of our
+    lists) is associated with one of volumeNodes, add it as a landmark.
+    The caller is responsible for removing the point from pointList.
+    Return the name of the added landmark or None.
+    """
+    status = pointList.GetNthControlPointPositionStatus(pointIndex)
+    if status != pointList.PositionDefined:
+      return None
+    associatedID = pointList.GetNthControlPointAssociatedNodeID(pointIndex)
+    volumeNode = None
+    for candidate in volumeNodes:
+      if candidate.GetID() == associatedID:
+        volumeNode = candidate
+    if not volumeNode:
+      return None
+    # found one, so add it as a landmark
+    state = self.registrationState()
+    landmarkPosition = pointList.GetNthControlPointPositionVector(pointIndex)
+    # if new point is associated with moving volume,
+    # then map the position back to where it would have been
+    # if it were not transformed, if not, then calculate where
+    # the point would be on the moving volume
+    movingPosition = [0.,]*3
+    volumeTransformNode = state.transformed.GetParentTransformNode()
+    volumeTransform = vtk.vtkGeneralTransform()
+    if volumeTransformNode:
+      if volumeNode == state.moving:
+        # in this case, moving stays and other point moves
+        volumeTransformNode.GetTransformToWorld(volumeTransform)
+        movingPosition[:] = landmarkPosition
+        volumeTransform.TransformPoint(movingPosition,landmarkPosition)
+      else:
+        # in this case, landmark stays and moving point moves
+        volumeTransformNode.GetTransformFromWorld(volumeTransform)
+        volumeTransform.TransformPoint(landmarkPosition,movingPosition)
+    return self.addLandmark(volumeNodes,landmarkPosition,movingPosition)
+
   def collectAssociatedPoints(self,volumeNodes):
     """Look at each point list in scene and find any points associated
     with one of our volumes but not in in one of our lists.
     Add the point as a landmark and delete it from the other list.
     Return the name of the last added landmark if it exists.
     """
-    state = self.registrationState()
     addedLandmark = None
-    volumeNodeIDs = []
-    for volumeNode in volumeNodes:
-      volumeNodeIDs.append(volumeNode.GetID())
-    landmarksByName = self.landmarksForVolumes(volumeNodes)
+    landmarkPointLists = set([self.volumePointList(volumeNode) for volumeNode in volumeNodes])
     pointListsInScene = slicer.util.getNodesByClass('vtkMRMLMarkupsFiducialNode')
-    landmarkPointLists = []
-    for landmarkName in landmarksByName.keys():
-      for pointList,index in landmarksByName[landmarkName]:
-        if pointList not in landmarkPointLists:
-          landmarkPointLists.append(pointList)
     listIndexToRemove = [] # remove back to front after identifying them
     for pointList in pointListsInScene:
       if pointList not in landmarkPointLists:
@@ -913,38 +1219,39 @@ class LandmarkRegistrationLogic(ScriptedLoadableModuleLogic):
         # associated with one of our volumes
         pointSize = pointList.GetNumberOfControlPoints()
         for pointIndex in range(pointSize):
-          status = pointList.GetNthControlPointPositionStatus(pointIndex)
-          if status != pointList.PositionDefined:
-            continue
-
-          associatedID = pointList.GetNthControlPointAssociatedNodeID(pointIndex)
-          if associatedID in volumeNodeIDs:
-            # found one, so add it as a landmark
-            landmarkPosition = pointList.GetNthControlPointPositionVector(pointIndex)
-            volumeNode = slicer.mrmlScene.GetNodeByID(associatedID)
-            # if new point is associated with moving volume,
-            # then map the position back to where it would have been
-            # if it were not transformed, if not, then calculate where
-            # the point would be on the moving volume
-            movingPosition = [0.,]*3
-            volumeTransformNode = state.transformed.GetParentTransformNode()
-            volumeTransform = vtk.vtkGeneralTransform()
-            if volumeTransformNode:
-              if volumeNode == state.moving:
-                # in this case, moving stays and other point moves
-                volumeTransformNode.GetTransformToWorld(volumeTransform)
-                movingPosition[:] = landmarkPosition
-                volumeTransform.TransformPoint(movingPosition,landmarkPosition)
-              else:
-                # in this case, landmark stays and moving point moves
-                volumeTransformNode.GetTransformFromWorld(volumeTransform)
-                volumeTransform.TransformPoint(landmarkPosition,movingPosition)
-            addedLandmark = self.addLandmark(volumeNodes,landmarkPosition,movingPosition)
+          landmarkName = self.collectAssociatedPoint(volumeNodes,pointList,pointIndex)
+          if landmarkName:
+            addedLandmark = landmarkName
             listIndexToRemove.insert(0,(pointList,pointIndex))
     for pointList,pointIndex in listIndexToRemove:
       pointList.RemoveNthControlPoint(pointIndex)
     return addedLandmark
 
+  def landmarkFromPoint(self,volumeNode,volumeNodes,pointList,pointIndex):
+    """Make sure the point at pointIndex in pointList, the list of
+    volumeNode, is associated with volumeNode and has a matching point
+    in the lists of the other volumeNodes.
+    Returns the name of the landmark if a point was added, otherwise None.
+    """
+    status = pointList.GetNthControlPointPositionStatus(pointIndex)
+    if status != pointList.PositionDefined:
+      return None
+
+    addedLandmark = None
+    pointAssociatedVolumeID = pointList.GetNthControlPointAssociatedNodeID(pointIndex)
+    landmarkName = pointList.GetNthControlPointLabel(pointIndex)
+    landmarkPosition = pointList.GetNthControlPointPosition(pointIndex)
+    if pointAssociatedVolumeID != volumeNode.GetID():
+      # point was placed on a viewer associated with the non-active list, so change it
+      pointList.SetNthControlPointAssociatedNodeID(pointIndex,volumeNode.GetID())
+    # now make sure all other lists have a corresponding point (same name)
+    for otherVolumeNode in volumeNodes:
+      if otherVolumeNode != volumeNode:
+        addedPoint = self.ensurePointInListForVolume(otherVolumeNode,landmarkName,landmarkPosition)
+        if addedPoint:
+          addedLandmark = addedPoint
+    return addedLandmark
+
   def landmarksFromPoints(self,volumeNodes):
     """Look through all points in the scene and make sure they
     are in a point list that is associated with the same
@@ -962,43 +1269,62 @@ class LandmarkRegistrationLogic(ScriptedLoadableModuleLogic):
         continue
       pointSize = pointList.GetNumberOfControlPoints()
       for pointIndex in range(pointSize):
-        status = pointList.GetNthControlPointPositionStatus(pointIndex)
-        if status != pointList.PositionDefined:
-          continue
+        addedPoint = self.landmarkFromPoint(volumeNode,volumeNodes,pointList,pointIndex)
+        if addedPoint:
+          addedLandmark = addedPoint
+    slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
+    return addedLandmark
 
-        pointAssociatedVolumeID = pointList.GetNthControlPointAssociatedNodeID(pointIndex)
-        landmarkName = pointList.GetNthControlPointLabel(pointIndex)
-        landmarkPosition = pointList.GetNthControlPointPosition(pointIndex)
-        if pointAssociatedVolumeID != volumeNode.GetID():
-          # point was placed on a viewer associated with the non-active list, so change it
-          pointList.SetNthControlPointAssociatedNodeID(pointIndex,volumeNode.GetID())
-        # now make sure all other lists have a corresponding point (same name)
-        for otherVolumeNode in volumeNodes:
-          if otherVolumeNode != volumeNode:
-            addedPoint = self.ensurePointInListForVolume(otherVolumeNode,landmarkName,landmarkPosition)
-            if addedPoint:
-              addedLandmark = addedPoint
+  def landmarksFromPlacedPoints(self,volumeNodes,placedPoints):
+    """Reconcile only the given points, a sequence of (pointList,controlPointID)
+    pairs, typically the points placed since the last update.
+    Points in one of our lists get matching points in the other lists,
+    points in other lists that are associated with one of our volumes
+    become landmarks and are removed from their list.
+    Returns the most recently added landmark (or None).
+    """
+    slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+    addedLandmark = None
+    volumesByPointListID = {}
+    for volumeNode in volumeNodes:
+      pointList = self.volumePointList(volumeNode)
+      if pointList:
+        volumesByPointListID[pointList.GetID()] = volumeNode
+    pointsToRemove = []
+    for pointList,controlPointID in placedPoints:
+      pointIndex = pointList.GetNthControlPointIndexByID(controlPointID)
+      if pointIndex < 0:
+        continue
+      volumeNode = volumesByPointListID.get(pointList.GetID())
+      if volumeNode:
+        addedPoint = self.landmarkFromPoint(volumeNode,volumeNodes,pointList,pointIndex)
+      else:
+        addedPoint = self.collectAssociatedPoint(volumeNodes,pointList,pointIndex)
+        if addedPoint:
+          pointsToRemove.append( (pointList,controlPointID) )
+      if addedPoint:
+        addedLandmark = addedPoint
+    for pointList,controlPointID in pointsToRemove:
+      pointIndex = pointList.GetNthControlPointIndexByID(controlPointID)
+      if pointIndex >= 0:
+        pointList.RemoveNthControlPoint(pointIndex)
     slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
     return addedLandmark
 
   def vtkPointsForVolumes(self, volumeNodes, pointListNodes):
     """Return dictionary of vtkPoints instances containing the control points
-    associated with current landmarks, indexed by volume"""
+    associated with current landmarks, indexed by volume.
+    Points are matched by landmark name, so the lists may differ in size
+    and order; only landmarks defined in every list are included."""
     points = {}
     for volumeNode in volumeNodes:
       points[volumeNode] = vtk.vtkPoints()
     sameNumberOfNodes = len(volumeNodes) == len(pointListNodes)
     noNoneNodes = None not in volumeNodes and None not in pointListNodes
     if sameNumberOfNodes and noNoneNodes:
-      pointCount = pointListNodes[0].GetNumberOfControlPoints()
-      for pointListNode in pointListNodes:
-        if pointCount != pointListNode.GetNumberOfControlPoints():
-          raise Exception(f"Point counts don't match {pointCount}")
-      indices = range(pointCount)
-      for pointListNode,volumeNode in zip(pointListNodes,volumeNodes):
-        for index in indices:
-          point = pointListNode.GetNthControlPointPosition(index)
-          points[volumeNode].InsertNextPoint(point)
+      landmarkSet = self.landmarkSetForPointLists(pointListNodes)
+      for column,volumeNode in enumerate(volumeNodes):
+        points[volumeNode] = landmarkSet.vtkPoints(column)
     return points
 
 
@@ -1050,12 +1376,24 @@ class LandmarkRegistrationTest(ScriptedLoadableModuleTest):
       self.test_LandmarkRegistrationVTKv6Picking()
     elif scenario == "ManyLandmarks":
       self.test_LandmarkRegistrationManyLandmarks()
+    elif scenario == "LinearSolver":
+      self.test_LandmarkRegistrationLinearSolver()
+    elif scenario == "CrossValidation":
+      self.test_LandmarkRegistrationCrossValidation()
+    elif scenario == "Wendland":
+      self.test_LandmarkRegistrationWendland()
+    elif scenario == "BSpline":
+      self.test_LandmarkRegistrationBSpline()
     else:
       self.test_LandmarkRegistrationBasic()
       self.test_LandmarkRegistrationAffine()
       self.test_LandmarkRegistrationThinPlate()
       self.test_LandmarkRegistrationVTKv6Picking()
       self.test_LandmarkRegistrationManyLandmarks()
+      self.test_LandmarkRegistrationLinearSolver()
+      self.test_LandmarkRegistrationCrossValidation()
+      self.test_LandmarkRegistrationWendland()
+      self.test_LandmarkRegistrationBSpline()
 
   def test_LandmarkRegistrationBasic(self):
     """
@@ -1176,10 +1514,139 @@ class LandmarkRegistrationTest(ScriptedLoadableModuleTest):
     w.currentRegistrationInterface.onThinPlateApply()
 
     self.delayDisplay('Exporting as a grid node')
-    w.currentRegistrationInterface.onExportGrid()
+    gridNode = w.currentRegistrationInterface.onExportGrid()
+
+    # at the grid points the grid matches the inverse of the thin plate transform
+    from vtk.util import numpy_support
+    gridTransform = gridNode.GetTransformFromParent()
+    grid = gridTransform.GetDisplacementGrid()
+    displacements = numpy_support.vtk_to_numpy(grid.GetPointData().GetScalars())
+    directions = slicer.util.arrayFromVTKMatrix(gridTransform.GetGridDirectionMatrix())[:3,:3]
+    dimensions = grid.GetDimensions()
+    inverse = w.registrationState().transform.GetTransformFromParent()
+    for index in numpy.random.default_rng(0).integers(0, displacements.shape[0], size=20):
+      k,j,i = numpy.unravel_index(index, dimensions[::-1])
+      point = directions @ (numpy.array([i,j,k]) * grid.GetSpacing()) + grid.GetOrigin()
+      expected = numpy.array(inverse.TransformPoint(point)) - point
+      self.assertLess(numpy.abs(displacements[index] - expected).max(), 1e-2)
+
+    self.delayDisplay('Dragging a landmark with hot update')
+    plugin = w.currentRegistrationInterface
+    plugin.hotUpdateButton.checked = True
+    state = w.registrationState()
+    (fixedList,fixedIndex),(movingList,movingIndex) = state.landmarks()['L-4']
+    position = [0,]*3
+    for step in range(3):
+      movingList.GetNthControlPointPositionWorld(movingIndex, position)
+      movingList.SetNthControlPointPositionWorld(movingIndex, position[0] + 2, position[1], position[2] - 1)
+      w.updateLandmarkMoved('L-4')
+    # the preview follows the cached spline, near the landmark at once
+    # and everywhere after a refresh
+    self.assertEqual(state.transform.GetTransformToParent(), plugin.previewTransform)
+    plugin.refreshPreviewTransform()
+    self.assertFalse(plugin.previewStale.any())
+    preview = plugin.previewTransform.GetDisplacementGrid()
+    displacements = numpy_support.vtk_to_numpy(preview.GetPointData().GetScalars()).reshape(-1,3)
+    expected = plugin.thinPlateSpline.transformPoints(plugin.previewPoints) - plugin.previewPoints
+    self.assertLess(numpy.abs(displacements - expected).max(), 1e-6)
+    w.onLandmarkEndMoving('L-4')
+    self.assertEqual(state.transform.GetTransformToParent(), plugin.thinPlateTransform)
 
     self.delayDisplay('test_LandmarkRegistrationThinPlate passed!')
 
+  def test_LandmarkRegistrationWendland(self):
+    """Test the compact support warp on the thin plate landmarks,
+    then fit one through thousands of landmarks"""
+    self.test_LandmarkRegistrationThinPlate()
+
+    self.delayDisplay('starting test_LandmarkRegistrationWendland')
+
+    w = slicer.modules.LandmarkRegistrationWidget
+    w.registrationTypeButtons["Wendland"].checked = True
+    w.registrationTypeButtons["Wendland"].clicked()
+    w.onRegistrationType("Wendland")
+
+    self.delayDisplay('Applying transform')
+    w.currentRegistrationInterface.onWendlandApply()
+
+    # the grid maps the fixed landmarks onto the moving ones
+    state = w.registrationState()
+    landmarkSet = state.landmarkSet()
+    fixed = landmarkSet.column(0, definedOnly=True)
+    moving = landmarkSet.column(1, definedOnly=True)
+    fromParent = state.transform.GetTransformFromParent()
+    for fixedPoint,movingPoint in zip(fixed, moving):
+      self.assertLess(numpy.linalg.norm(numpy.array(fromParent.TransformPoint(fixedPoint)) - movingPoint), 1.0)
+
+    # surface correspondences: fitting and evaluating scale with the neighbor pairs
+    random = numpy.random.default_rng(3)
+    count = 20000
+    azimuth = random.uniform(0, 2 * numpy.pi, count)
+    elevation = random.uniform(0, numpy.pi, count)
+    source = numpy.stack((80 * numpy.cos(azimuth) * numpy.sin(elevation),
+                          60 * numpy.sin(azimuth) * numpy.sin(elevation),
+                          70 * numpy.cos(elevation)), axis=1)
+    target = 1.05 * source + 3 * numpy.sin(source / 20)
+    startTime = time.perf_counter()
+    spline = RegistrationLib.WendlandSpline(source, target)
+    fitTime = time.perf_counter() - startTime
+    startTime = time.perf_counter()
+    mapped = spline.transformPoints(source)
+    evaluationTime = time.perf_counter() - startTime
+    logging.info("Compact support warp of %d landmarks, radius %.2f mm: fit %.3f s, evaluation %.3f s" %
+                 (count, spline.radius, fitTime, evaluationTime))
+    self.assertTrue(spline.converged)
+    self.assertLess(numpy.abs(mapped - target).max(), 1e-6)
+
+    self.delayDisplay('test_LandmarkRegistrationWendland passed!')
+
+  def test_LandmarkRegistrationBSpline(self):
+    """Test the B-spline warp on the thin plate landmarks, export it,
+    then fit one to many landmarks"""
+    self.test_LandmarkRegistrationThinPlate()
+
+    self.delayDisplay('starting test_LandmarkRegistrationBSpline')
+
+    w = slicer.modules.LandmarkRegistrationWidget
+    w.registrationTypeButtons["BSpline"].checked = True
+    w.registrationTypeButtons["BSpline"].clicked()
+    w.onRegistrationType("BSpline")
+
+    self.delayDisplay('Applying transform')
+    w.currentRegistrationInterface.onBSplineApply()
+
+    # the warp takes the fixed landmarks close to the moving ones, and
+    # the exported node holds the same transform
+    state = w.registrationState()
+    landmarkSet = state.landmarkSet()
+    fixed = landmarkSet.column(0, definedOnly=True)
+    moving = landmarkSet.column(1, definedOnly=True)
+    bsplineNode = w.currentRegistrationInterface.onExportBSpline()
+    self.assertTrue(bsplineNode.IsA('vtkMRMLBSplineTransformNode'))
+    fromParent = state.transform.GetTransformFromParent()
+    exported = bsplineNode.GetTransformFromParent()
+    for fixedPoint,movingPoint in zip(fixed, moving):
+      mapped = numpy.array(fromParent.TransformPoint(fixedPoint))
+      self.assertLess(numpy.linalg.norm(mapped - movingPoint), 1.0)
+      self.assertLess(numpy.linalg.norm(numpy.array(exported.TransformPoint(fixedPoint)) - mapped), 1e-6)
+    deformation = w.currentRegistrationInterface.deformation
+    self.assertLess(numpy.abs(deformation.transformPoints(fixed) - RegistrationLib.mapPoints(fromParent, fixed)).max(), 1e-6)
+
+    # fitting is linear in the landmarks, subdividing is exact
+    random = numpy.random.default_rng(5)
+    count = 50000
+    source = random.uniform(-100, 100, (count,3))
+    target = source + 5 * numpy.sin(source / 25)
+    startTime = time.perf_counter()
+    deformation, converged = RegistrationLib.fitLandmarks(source, target, 10, levels=3, smoothness=0.01)
+    logging.info("B-spline warp of %d landmarks on %s control points: fit %.3f s" %
+                 (count, deformation.dimensions, time.perf_counter() - startTime))
+    self.assertTrue(converged)
+    self.assertLess(numpy.abs(deformation.transformPoints(source) - target).max(), 0.1)
+    self.assertLess(numpy.abs(deformation.refined().displacements(source) - deformation.displacements(source)).max(), 1e-9)
+
+    self.delayDisplay('test_LandmarkRegistrationBSpline passed!')
+
 
   def test_LandmarkRegistrationVTKv6Picking(self):
     """Test the picking situation on VTKv6"""
@@ -1324,5 +1791,302 @@ class LandmarkRegistrationTest(ScriptedLoadableModuleTest):
     self.delayDisplay('Total time ' + str(time.time() - startTime))
     self.delayDisplay(str(times))
 
+    # adding a landmark appends to the cached labels, the lists are not rescanned
+    logic = w.logic
+    volumeNodes = (dtiBrain, mrHead)
+    landmarkCount = len(logic.landmarksForVolumes(volumeNodes))
+    rescanCount = logic.landmarkIndex.rescanCount
+    for step in range(20):
+      logic.addLandmark(volumeNodes)
+    self.assertEqual(logic.landmarkIndex.rescanCount, rescanCount)
+    self.assertEqual(len(logic.landmarksForVolumes(volumeNodes)), landmarkCount + 20)
+
 
     self.delayDisplay('test_LandmarkRegistrationManyLandmarks passed!')
+
+  def test_LandmarkRegistrationLinearSolver(self):
+    """
+    This checks the numpy linear solvers against vtkLandmarkTransform
+    and times both for increasing numbers of landmarks
+    """
+
+    self.delayDisplay("Starting test_LandmarkRegistrationLinearSolver")
+
+    from vtk.util import numpy_support
+    solver = RegistrationLib.LinearSolver
+
+    def vtkMatrix(source, target, mode):
+      sourcePoints = vtk.vtkPoints()
+      sourcePoints.SetData(numpy_support.numpy_to_vtk(source, deep=True))
+      targetPoints = vtk.vtkPoints()
+      targetPoints.SetData(numpy_support.numpy_to_vtk(target, deep=True))
+      landmarkTransform = vtk.vtkLandmarkTransform()
+      if mode == 'Rigid':
+        landmarkTransform.SetModeToRigidBody()
+      if mode == 'Similarity':
+        landmarkTransform.SetModeToSimilarity()
+      if mode == 'Affine':
+        landmarkTransform.SetModeToAffine()
+      landmarkTransform.SetSourceLandmarks(sourcePoints)
+      landmarkTransform.SetTargetLandmarks(targetPoints)
+      landmarkTransform.Update()
+      return slicer.util.arrayFromVTKMatrix(landmarkTransform.GetMatrix())
+
+    random = numpy.random.default_rng(42)
+    repeats = 10
+    for count in (1, 2, 3, 10, 100, 1000, 10000):
+      source = random.normal(scale=50, size=(count,3))
+      rotation = numpy.linalg.qr(random.normal(size=(3,3)))[0]
+      if numpy.linalg.det(rotation) < 0:
+        rotation[:,0] *= -1
+      target = 1.2 * source @ rotation.T + (10, -20, 30) + random.normal(scale=2, size=(count,3))
+      for mode in solver.linearModes:
+        if mode == 'Affine' and count < 4:
+          # vtkLandmarkTransform has no unique answer here
+          continue
+        startTime = time.perf_counter()
+        for repeat in range(repeats):
+          matrix = solver.fitLinear(source, target, mode)
+        numpyTime = (time.perf_counter() - startTime) / repeats
+        startTime = time.perf_counter()
+        for repeat in range(repeats):
+          expected = vtkMatrix(source, target, mode)
+        vtkTime = (time.perf_counter() - startTime) / repeats
+        difference = numpy.abs(matrix - expected).max()
+        logging.info("%s %d landmarks: numpy %.3f ms, vtk %.3f ms, difference %g" %
+                     (mode, count, numpyTime * 1000, vtkTime * 1000, difference))
+        self.assertLess(difference, 1e-9)
+
+    # weights act like repeated landmarks
+    source = random.normal(scale=50, size=(20,3))
+    target = source @ numpy.diag((1., 2., 3.)) + random.normal(size=(20,3))
+    weights = random.integers(1, 4, size=20)
+    repeated = numpy.repeat(numpy.arange(20), weights)
+    for mode in solver.linearModes:
+      difference = numpy.abs(solver.fitLinear(source, target, mode, weights) -
+                             solver.fitLinear(source[repeated], target[repeated], mode)).max()
+      self.assertLess(difference, 1e-9)
+
+    # moving single landmarks updates the incremental fit in constant time
+    incrementalFit = solver.IncrementalLinearFit(refitInterval=50)
+    source = random.normal(scale=50, size=(1000,3))
+    target = source @ numpy.diag((1., 1.1, 0.9)) + random.normal(size=(1000,3))
+    incrementalFit.reset(source, target)
+    for move in range(200):
+      row = random.integers(len(source))
+      source[row] += random.normal(scale=5, size=3)
+      target[row] += random.normal(scale=5, size=3)
+      incrementalFit.movePoint(row, source[row], target[row])
+    for mode in solver.linearModes:
+      difference = numpy.abs(incrementalFit.matrix(mode) - solver.fitLinear(source, target, mode)).max()
+      self.assertLess(difference, 1e-9)
+
+    # the robust fit finds gross outliers among many landmarks in milliseconds
+    source = random.normal(scale=50, size=(5000,3))
+    target = source @ rotation.T + (1, 2, 3) + random.normal(scale=0.5, size=(5000,3))
+    outliers = random.random(5000) < 0.3
+    target[outliers] += random.normal(scale=30, size=(outliers.sum(),3)) + 20
+    for mode in solver.linearModes:
+      startTime = time.perf_counter()
+      matrix,inlierMask = solver.fitRobust(source, target, mode)
+      logging.info("Robust %s 5000 landmarks: %.3f ms" % (mode, (time.perf_counter() - startTime) * 1000))
+      self.assertGreater((inlierMask == ~outliers).mean(), 0.97)
+      expected = solver.fitLinear(source[~outliers], target[~outliers], mode)
+      self.assertLess(numpy.abs(matrix - expected).max(), 0.05)
+
+    # landmarks on a line, or in a plane for Affine, give only degenerate
+    # subsets: the automatic threshold falls back to fitting all of them
+    line = numpy.outer(numpy.arange(6.), (1., 2., 3.))
+    plane = numpy.hstack((random.normal(scale=20, size=(8,2)), numpy.zeros((8,1))))
+    coincident = numpy.ones((6,3))
+    for source,modes in ((line, solver.linearModes), (plane, ('Affine',)), (coincident, solver.linearModes)):
+      target = source + (1, 2, 3)
+      for mode in modes:
+        matrix,inlierMask = solver.fitRobust(source, target, mode)
+        self.assertTrue(inlierMask.all())
+        self.assertLess(numpy.abs(solver.transformPoints(matrix, source) - target).max(), 1e-9)
+
+    # the leave-one-out residuals match refitting without each landmark
+    source = random.normal(scale=50, size=(50,3))
+    target = 1.1 * source @ rotation.T + random.normal(size=(50,3))
+    for mode in solver.linearModes:
+      leaveOneOut = RegistrationLib.leaveOneOutResiduals(source, target, mode)
+      for row in range(len(source)):
+        others = numpy.arange(len(source)) != row
+        matrix = solver.fitLinear(source[others], target[others], mode)
+        expected = solver.transformPoints(matrix, source[row:row+1])[0] - target[row]
+        self.assertLess(numpy.abs(leaveOneOut[row] - expected).max(), 1e-9)
+
+    # the matrix ends up in the transform node as the transform to parent
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    matrix = solver.fitAffine(source, target)
+    solver.updateTransformNode(transformNode, matrix)
+    self.assertLess(numpy.abs(slicer.util.arrayFromTransformMatrix(transformNode) - matrix).max(), 1e-12)
+    # and the residuals map the points through it in one call
+    residuals = RegistrationLib.mapPoints(transformNode, source) - target
+    self.assertLess(numpy.abs(residuals - (solver.transformPoints(matrix, source) - target)).max(), 1e-9)
+    slicer.mrmlScene.RemoveNode(transformNode)
+
+    self.delayDisplay('test_LandmarkRegistrationLinearSolver passed!')
+
+  def test_LandmarkRegistrationCrossValidation(self):
+    """
+    This checks the closed form leave-one-out residuals against
+    refitting vtkLandmarkTransform and vtkThinPlateSplineTransform
+    without each landmark, and times them up to 2000 landmarks.
+    Checks that moving landmarks of a cached thin plate spline gives
+    the spline of the moved landmarks, and checks the smoothing spline
+    sweep against solving the regularized system.
+    Then bootstraps the thin plate fit over the fixed volume.
+    """
+
+    self.delayDisplay("Starting test_LandmarkRegistrationCrossValidation")
+
+    from SampleData import SampleDataLogic
+    mrHead = SampleDataLogic().downloadMRHead()
+    dtiBrain = SampleDataLogic().downloadDTIBrain()
+    self.delayDisplay('Two data sets loaded')
+
+    from vtk.util import numpy_support
+    def vtkPoints(array):
+      points = vtk.vtkPoints()
+      points.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(array), deep=True))
+      return points
+
+    # landmarks on the moving volume and displaced ones on the fixed volume
+    random = numpy.random.default_rng(7)
+    count = 30
+    names = ["L-%d" % index for index in range(count)]
+    moving = random.uniform(-40, 40, size=(count,3))
+    fixed = moving + random.normal(scale=3, size=(count,3))
+    logic = LandmarkRegistrationLogic()
+    logic.addPoints(names, fixed, dtiBrain)
+    logic.addPoints(names, moving, mrHead)
+    # new points are clipped to the volume bounds
+    landmarkSet = logic.landmarkSetForVolumes((dtiBrain, mrHead))
+    fixed, moving = landmarkSet.column(0), landmarkSet.column(1)
+
+    for method in ('Affine', 'ThinPlate'):
+      report = logic.crossValidate(method, (dtiBrain, mrHead))
+      self.assertEqual(report.names, names)
+      for row in range(count):
+        others = numpy.arange(count) != row
+        if method == 'Affine':
+          transform = vtk.vtkLandmarkTransform()
+          transform.SetModeToAffine()
+        else:
+          transform = vtk.vtkThinPlateSplineTransform()
+          transform.SetBasisToR()
+        transform.SetSourceLandmarks(vtkPoints(moving[others]))
+        transform.SetTargetLandmarks(vtkPoints(fixed[others]))
+        transform.Update()
+        expected = numpy.linalg.norm(numpy.array(transform.TransformPoint(moving[row])) - fixed[row])
+        self.assertAlmostEqual(report.leaveOneOutErrors[row], expected, places=6)
+      logging.info("%s: RMS error %.3f, leave-one-out %.3f" % (method, report.rms, report.leaveOneOutRMS))
+
+    # one thin plate fit gives all the residuals, where refitting takes N fits
+    for method,count,seconds in RegistrationLib.benchmarkCrossValidation(counts=(100, 500, 1000, 2000)):
+      logging.info("Leave-one-out %s %d landmarks: %.3f s" % (method, count, seconds))
+    source = random.normal(scale=50, size=(2000,3))
+    target = source + random.normal(scale=2, size=(2000,3))
+    startTime = time.perf_counter()
+    RegistrationLib.leaveOneOutResiduals(source, target, 'ThinPlate')
+    leaveOneOutTime = time.perf_counter() - startTime
+    # a single vtk fit of 2000 landmarks takes minutes, time 200 and scale by N^3
+    startTime = time.perf_counter()
+    transform = vtk.vtkThinPlateSplineTransform()
+    transform.SetBasisToR()
+    transform.SetSourceLandmarks(vtkPoints(source[:200]))
+    transform.SetTargetLandmarks(vtkPoints(target[:200]))
+    transform.Update()
+    refitTime = (time.perf_counter() - startTime) * 10 ** 3
+    logging.info("2000 landmarks: closed form %.3f s, one vtk fit about %.0f s, refitting about %.0f s" %
+                 (leaveOneOutTime, refitTime, refitTime * 2000))
+    self.assertLess(leaveOneOutTime, refitTime)
+
+    # moving landmarks of a cached spline matches fitting the moved landmarks
+    spline = RegistrationLib.ThinPlateSpline(moving, fixed, refitInterval=1000)
+    for step in range(100):
+      row = step % count
+      moving[row] += random.normal(scale=2, size=3)
+      fixed[row] += random.normal(scale=2, size=3)
+      spline.moveLandmark(row, source=moving[row], target=fixed[row])
+    transform = vtk.vtkThinPlateSplineTransform()
+    transform.SetBasisToR()
+    transform.SetSourceLandmarks(vtkPoints(moving))
+    transform.SetTargetLandmarks(vtkPoints(fixed))
+    transform.Update()
+    samples = random.uniform(-60, 60, size=(50,3))
+    expected = numpy.array([transform.TransformPoint(sample) for sample in samples])
+    self.assertLess(numpy.abs(spline.transformPoints(samples) - expected).max(), 1e-6)
+    expected = RegistrationLib.ThinPlateSpline(moving, fixed).leaveOneOutResiduals()
+    self.assertLess(numpy.abs(spline.leaveOneOutResiduals() - expected).max(), 1e-6)
+    fixed, moving = landmarkSet.column(0), landmarkSet.column(1)
+
+    # the smoothing sweep matches solving the regularized system, and the
+    # vtk spline through the smoothed targets is the smoothing spline
+    smoothing = RegistrationLib.ThinPlateSmoothing(moving, fixed)
+    regularization = smoothing.optimalRegularization()
+    logging.info("Thin plate smoothing by cross validation: %g" % regularization)
+    self.assertGreater(regularization, 0)
+    spline = RegistrationLib.ThinPlateSpline(moving, fixed, regularization=regularization)
+    self.assertLess(numpy.abs(smoothing.fittedTargets(regularization) - spline.fittedTargets()).max(), 1e-6)
+    self.assertLess(numpy.abs(smoothing.leaveOneOutResiduals(regularization) - spline.leaveOneOutResiduals()).max(), 1e-6)
+    transform = vtk.vtkThinPlateSplineTransform()
+    transform.SetBasisToR()
+    transform.SetSourceLandmarks(vtkPoints(moving))
+    transform.SetTargetLandmarks(vtkPoints(spline.fittedTargets()))
+    transform.Update()
+    expected = numpy.array([transform.TransformPoint(sample) for sample in samples])
+    self.assertLess(numpy.abs(smoothing.transformPoints(samples, regularization) - expected).max(), 1e-6)
+    others = numpy.arange(count) != 0
+    leftOut = RegistrationLib.ThinPlateSpline(moving[others], fixed[others], regularization=regularization)
+    expected = leftOut.transformPoints(moving[:1])[0] - fixed[0]
+    self.assertLess(numpy.abs(smoothing.leaveOneOutResiduals(regularization)[0] - expected).max(), 1e-6)
+
+    # bootstrapping in a thread pool gives the same grids as serially
+    startTime = time.perf_counter()
+    meanNode,stdNode = logic.bootstrapUncertainty('ThinPlate', (dtiBrain, mrHead), replicates=20, step=8, workers=4)
+    logging.info("Bootstrap of 20 thin plate fits: %.3f s" % (time.perf_counter() - startTime))
+    self.assertEqual(meanNode.GetImageData().GetNumberOfScalarComponents(), 3)
+    fixedDimensions = dtiBrain.GetImageData().GetDimensions()
+    self.assertEqual(stdNode.GetImageData().GetDimensions(), tuple([int(math.ceil(d / 8)) for d in fixedDimensions]))
+    standardDeviation = slicer.util.arrayFromVolume(stdNode)
+    self.assertTrue(numpy.isfinite(standardDeviation).all())
+    self.assertGreater(standardDeviation.max(), 0)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    stdNode.GetIJKToRASMatrix(ijkToRAS)
+    mean,std = RegistrationLib.bootstrapDisplacements(fixed, moving, 'ThinPlate', slicer.util.arrayFromVTKMatrix(ijkToRAS),
+                                                      stdNode.GetImageData().GetDimensions(), replicates=20, workers=1)
+    self.assertLess(numpy.abs(numpy.sqrt((std * std).sum(axis=-1)) - standardDeviation).max(), 1e-3)
+    self.assertLess(numpy.abs(mean - slicer.util.arrayFromVolume(meanNode)).max(), 1e-3)
+
+    # outside the application the numerical modules import without Qt
+    # and bootstrap in a process pool, to the same grids
+    import shutil, subprocess
+    pythonSlicer = shutil.which('PythonSlicer')
+    if pythonSlicer:
+      inputPath = os.path.join(slicer.app.temporaryPath, 'LandmarkRegistrationBootstrapInput.npz')
+      outputPath = os.path.join(slicer.app.temporaryPath, 'LandmarkRegistrationBootstrapOutput.npz')
+      numpy.savez(inputPath, fixed=fixed, moving=moving, ijkToRAS=slicer.util.arrayFromVTKMatrix(ijkToRAS),
+                  dimensions=stdNode.GetImageData().GetDimensions())
+      script = "\n".join((
+        "import sys, numpy",
+        "sys.path.insert(0, sys.argv[1])",
+        "from RegistrationLib import Bootstrap",
+        "data = numpy.load(sys.argv[2])",
+        "mean, std = Bootstrap.bootstrapDisplacements(data['fixed'], data['moving'], 'ThinPlate', data['ijkToRAS'],",
+        "                                             data['dimensions'], replicates=20, workers=2)",
+        "numpy.savez(sys.argv[3], mean=mean, std=std)"))
+      moduleDirectory = os.path.dirname(os.path.dirname(RegistrationLib.__file__))
+      startTime = time.perf_counter()
+      subprocess.run([pythonSlicer, '-c', script, moduleDirectory, inputPath, outputPath], check=True)
+      logging.info("Bootstrap of 20 thin plate fits in worker processes: %.3f s" % (time.perf_counter() - startTime))
+      result = numpy.load(outputPath)
+      self.assertLess(numpy.abs(result['mean'] - mean).max(), 1e-9)
+      self.assertLess(numpy.abs(result['std'] - std).max(), 1e-9)
+    else:
+      logging.warning("PythonSlicer not found, the process pool is not tested")
+
+    self.delayDisplay('test_LandmarkRegistrationCrossValidation passed!')
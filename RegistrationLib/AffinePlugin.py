@@ -1,5 +1,7 @@
+import numpy
 import vtk, qt, ctk, slicer
 from . import RegistrationPlugin
+from . import LinearSolver
 
 
 #########################################################
@@ -55,6 +57,9 @@ class AffinePlugin(RegistrationPlugin):
     super().create(registrationState)
 
     self.linearMode = "Rigid"
+    self.incrementalFit = LinearSolver.IncrementalLinearFit()
+    self.incrementalFitKey = None
+    self.incrementalRows = {} # landmark name -> row in incrementalFit
 
     #
     # Linear Registration Pane - initially hidden
@@ -80,15 +85,50 @@ class AffinePlugin(RegistrationPlugin):
     linearModeButtons[self.linearMode].checked = True
     linearFormLayout.addRow("Registration Mode ", buttonLayout)
 
+    self.robustCheckBox = qt.QCheckBox()
+    self.robustCheckBox.text = "Reject outliers"
+    self.robustCheckBox.setToolTip( "Fit with RANSAC over minimal landmark subsets so that mislabeled landmarks are ignored.  Rejected landmarks are shown in red." )
+    self.robustCheckBox.connect('toggled(bool)', self.onRobustChanged)
+    self.widgets.append(self.robustCheckBox)
+    linearFormLayout.addRow("Robust ", self.robustCheckBox)
+
+    self.outlierThresholdSpinBox = qt.QDoubleSpinBox()
+    self.outlierThresholdSpinBox.minimum = 0
+    self.outlierThresholdSpinBox.maximum = 1000
+    self.outlierThresholdSpinBox.decimals = 1
+    self.outlierThresholdSpinBox.suffix = " mm"
+    self.outlierThresholdSpinBox.specialValueText = "Automatic"
+    self.outlierThresholdSpinBox.enabled = False
+    self.outlierThresholdSpinBox.setToolTip( "Largest distance between a transformed moving landmark and its fixed landmark for it to count as an inlier.  Automatic estimates it from the landmark errors." )
+    self.outlierThresholdSpinBox.connect('valueChanged(double)', self.onRobustChanged)
+    self.widgets.append(self.outlierThresholdSpinBox)
+    linearFormLayout.addRow("Outlier threshold ", self.outlierThresholdSpinBox)
+
     self.parent.layout().addWidget(linearCollapsibleButton)
 
 
   def destroy(self):
     """Clean up"""
+    state = self.registrationState()
+    state.logic.setOutlierLandmarks(())
+    state.logic.setLandmarkResiduals(None)
     super().destroy()
 
   def onLandmarkMoved(self,state):
-    """Perform the linear transform using the vtkLandmarkTransform class"""
+    """Update the transform for the landmark being dragged.
+    Only the moved landmark is read back, the fit statistics
+    of the others are kept from the start of the drag."""
+    self.updateLinearTransform(state, movedLandmarkName=state.currentLandmarkName)
+
+  def onLandmarkEndMoving(self,state):
+    """Refit from all the landmarks once the drag is over"""
+    self.updateLinearTransform(state)
+
+  def updateLinearTransform(self,state,movedLandmarkName=None):
+    """Fit the linear transform to the landmarks with the closed form
+    solvers in LinearSolver and write the matrix into the transform node.
+    With movedLandmarkName the fit is updated incrementally if it is still
+    valid for the current landmarks, otherwise all landmarks are read."""
     if state.transformed:
       if state.transformed.GetTransformNodeID() != state.transform.GetID():
         state.transformed.SetAndObserveTransformNodeID(state.transform.GetID())
@@ -96,29 +136,76 @@ class AffinePlugin(RegistrationPlugin):
     if not state.fixedPoints or not state.movingPoints:
       return
 
+    if self.robustCheckBox.checked:
+      self.updateRobustTransform(state)
+      return
+    state.logic.setOutlierLandmarks(())
+
+    fitKey = (state.fixedPoints.GetID(), state.movingPoints.GetID(), state.logic.landmarkIndex.generation)
+    row = self.incrementalRows.get(movedLandmarkName)
+    if self.incrementalFit.isValid() and fitKey == self.incrementalFitKey and row is not None:
+      # the landmark pairs are (fixed,index),(moving,index) in the order of state.pointLists();
+      # read in the local coordinates of the lists, like LandmarkSet does for the full fit
+      (fixedList,fixedIndex),(movingList,movingIndex) = state.landmarks()[movedLandmarkName]
+      fixedPosition = [0,]*3
+      movingPosition = [0,]*3
+      fixedList.GetNthControlPointPosition(fixedIndex, fixedPosition)
+      movingList.GetNthControlPointPosition(movingIndex, movingPosition)
+      self.incrementalFit.movePoint(row, source=movingPosition, target=fixedPosition)
+    else:
+      landmarkSet = state.landmarkSet()
+      definedMask = landmarkSet.definedMask()
+      definedNames = [name for name,defined in zip(landmarkSet.names, definedMask) if defined]
+      self.incrementalRows = {name: row for row,name in enumerate(definedNames)}
+      self.incrementalFitKey = fitKey
+      # the transform maps the moving (source) landmarks onto the fixed (target) ones
+      self.incrementalFit.reset(landmarkSet.column(1, definedOnly=True),
+                                landmarkSet.column(0, definedOnly=True))
+
     # try to use user selection, but fall back if not enough points are available
-    landmarkTransform = vtk.vtkLandmarkTransform()
-    if self.linearMode == 'Rigid':
-      landmarkTransform.SetModeToRigidBody()
-    if self.linearMode == 'Similarity':
-      landmarkTransform.SetModeToSimilarity()
-    if self.linearMode == 'Affine':
-      landmarkTransform.SetModeToAffine()
-    if state.fixedPoints.GetNumberOfControlPoints() < 3:
-      landmarkTransform.SetModeToRigidBody()
-
-    volumeNodes = (state.fixed, state.moving)
-    pointListNodes = (state.fixedPoints,state.movingPoints)
-    points = state.logic.vtkPointsForVolumes( volumeNodes, pointListNodes )
-    landmarkTransform.SetSourceLandmarks(points[state.moving])
-    landmarkTransform.SetTargetLandmarks(points[state.fixed])
-    landmarkTransform.Update()
-    state.transform.SetAndObserveTransformToParent(landmarkTransform)
+    linearMode = self.linearMode
+    if len(self.incrementalFit) < 3:
+      linearMode = 'Rigid'
+
+    matrix = self.incrementalFit.matrix(linearMode)
+    LinearSolver.updateTransformNode(state.transform, matrix)
+    state.logic.updateLandmarkResiduals(state, linearMode)
+
+    if movedLandmarkName is None:
+      # points may change outside of a drag, start the next one from scratch
+      self.incrementalFit.invalidate()
+
+  def updateRobustTransform(self,state):
+    """Fit while rejecting outliers and flag them in the landmark set.
+    The robust fit looks at every landmark, so it is not incremental."""
+    landmarkSet = state.landmarkSet()
+    definedMask = landmarkSet.definedMask()
+    fixedPoints = landmarkSet.column(0, definedOnly=True)
+    movingPoints = landmarkSet.column(1, definedOnly=True)
+
+    linearMode = self.linearMode
+    if fixedPoints.shape[0] < 3:
+      linearMode = 'Rigid'
+
+    threshold = self.outlierThresholdSpinBox.value or None
+    matrix,inlierMask = LinearSolver.fitRobust(movingPoints, fixedPoints, linearMode, threshold=threshold)
+    LinearSolver.updateTransformNode(state.transform, matrix)
+
+    outlierMask = numpy.zeros(len(landmarkSet), dtype=bool)
+    outlierMask[definedMask] = ~inlierMask
+    landmarkSet.setFlag(landmarkSet.OUTLIER, outlierMask)
+    state.logic.setOutlierLandmarks(landmarkSet.flaggedNames(landmarkSet.OUTLIER))
+    state.logic.updateLandmarkResiduals(state, linearMode, fitMask=~outlierMask)
 
   def onLinearTransform(self,mode):
     state = self.registrationState()
     self.linearMode = mode
-    self.onLandmarkMoved(state)
+    self.updateLinearTransform(state)
+
+  def onRobustChanged(self,value=None):
+    self.outlierThresholdSpinBox.enabled = self.robustCheckBox.checked
+    state = self.registrationState()
+    self.updateLinearTransform(state)
 
 
 
@@ -0,0 +1,178 @@
+import itertools
+import logging
+import numpy
+import vtk, qt, ctk, slicer
+from . import RegistrationPlugin
+from . import GridExport
+from .FreeFormDeformation import bsplineTransform, fitLandmarks
+
+
+#########################################################
+#
+#
+comment = """
+
+  RegistrationPlugin is a superclass for code that plugs into the
+  slicer LandmarkRegistration module.
+
+  These classes are Abstract.
+
+# TODO :
+"""
+#
+#########################################################
+
+
+
+#
+# RegistrationPlugin
+#
+
+class BSplinePlugin(RegistrationPlugin):
+  """ Plugin for cubic B-spline warps fitted to the landmarks,
+  see FreeFormDeformation
+  """
+
+  #
+  # generic settings that can (should) be overridden by the subclass
+  #
+
+  # displayed for the user to select the registration
+  name = "B-spline Registration"
+  tooltip = "Fits a smooth B-spline warp to any number of landmarks, resampled quickly by Slicer"
+
+  # can be true or false
+  # - True: landmarks are displayed and managed by LandmarkRegistration
+  # - False: landmarks are hidden
+  usesLandmarks = True
+
+  # can be any non-negative number
+  # - widget will be disabled until landmarks are defined
+  landmarksNeededToEnable = 1
+
+  # used for reloading - every concrete class should include this
+  sourceFile = __file__
+
+  def __init__(self,parent=None):
+    super().__init__(parent)
+
+    self.deformation = None
+
+  def create(self,registrationState):
+    """Make the plugin-specific user interface"""
+    super().create(registrationState)
+    #
+    # B-spline Registration Pane
+    #
+    bsplineCollapsibleButton = ctk.ctkCollapsibleButton()
+    bsplineCollapsibleButton.text = "B-spline Registration"
+    bsplineFormLayout = qt.QFormLayout()
+    bsplineCollapsibleButton.setLayout(bsplineFormLayout)
+    self.widgets.append(bsplineCollapsibleButton)
+
+    self.spacingSpinBox = qt.QDoubleSpinBox()
+    self.spacingSpinBox.minimum = 0
+    self.spacingSpinBox.maximum = 500
+    self.spacingSpinBox.decimals = 1
+    self.spacingSpinBox.suffix = " mm"
+    self.spacingSpinBox.specialValueText = "Automatic"
+    self.spacingSpinBox.setToolTip( "Control point spacing of the finest level.  Smaller values follow the landmarks more locally.  Automatic puts four coarsest level intervals across the fixed volume." )
+    self.widgets.append(self.spacingSpinBox)
+    bsplineFormLayout.addRow("Control point spacing ", self.spacingSpinBox)
+
+    self.levelsSpinBox = qt.QSpinBox()
+    self.levelsSpinBox.minimum = 1
+    self.levelsSpinBox.maximum = 6
+    self.levelsSpinBox.value = 3
+    self.levelsSpinBox.setToolTip( "Number of control point grids, each with half the spacing of the one before.  Coarse levels fit the overall warp and fine levels the local detail." )
+    self.widgets.append(self.levelsSpinBox)
+    bsplineFormLayout.addRow("Levels ", self.levelsSpinBox)
+
+    self.smoothnessSpinBox = qt.QDoubleSpinBox()
+    self.smoothnessSpinBox.minimum = 0
+    self.smoothnessSpinBox.maximum = 100
+    self.smoothnessSpinBox.decimals = 3
+    self.smoothnessSpinBox.singleStep = 0.01
+    self.smoothnessSpinBox.value = 0.1
+    self.smoothnessSpinBox.setToolTip( "Penalty on bending of the control point grids.  Larger values give smoother warps that follow the landmarks less closely." )
+    self.widgets.append(self.smoothnessSpinBox)
+    bsplineFormLayout.addRow("Smoothness ", self.smoothnessSpinBox)
+
+    applyButton = qt.QPushButton("Apply")
+    applyButton.toolTip = "Fit the warp to the current landmarks."
+    bsplineFormLayout.addWidget(applyButton)
+    applyButton.connect("clicked()",self.onBSplineApply)
+    self.widgets.append(applyButton)
+
+    exportButton = qt.QPushButton("Export to B-spline Transform")
+    exportButton.toolTip = "To save this transform or use it in other Slicer modules you can export the current warp to a B-spline Transform."
+    bsplineFormLayout.addWidget(exportButton)
+    exportButton.connect("clicked()",self.onExportBSpline)
+    self.widgets.append(exportButton)
+
+    self.parent.layout().addWidget(bsplineCollapsibleButton)
+
+  def destroy(self):
+    """Clean up"""
+    self.registrationState().logic.setLandmarkResiduals(None)
+    super().destroy()
+
+  def onLandmarkEndMoving(self,state):
+    """Called when the user changes a landmark"""
+    self.onBSplineApply()
+
+  def onBSplineApply(self):
+    """Call this whenever the warp needs to be calculated"""
+    state = self.registrationState()
+
+    if state.fixed and state.moving and state.transformed:
+      self.performBSplineRegistration(state)
+
+  def performBSplineRegistration(self, state):
+    """Fit the warp from the fixed landmarks to the moving ones, on
+    control point grids along the axes of the fixed volume that cover it,
+    and set it as the transform from parent so that resampling needs no
+    inversion."""
+    if state.transformed.GetTransformNodeID() != state.transform.GetID():
+      state.transformed.SetAndObserveTransformNodeID(state.transform.GetID())
+
+    landmarkSet = state.landmarkSet()
+    fixedPoints = landmarkSet.column(0, definedOnly=True)
+    movingPoints = landmarkSet.column(1, definedOnly=True)
+    if fixedPoints.shape[0] == 0:
+      return
+
+    origin, spacing, dimensions, directions = GridExport.volumeGridGeometry(state.fixed)
+    size = (numpy.array(dimensions) - 1) * spacing[0]
+    corners = origin + numpy.array(list(itertools.product(*[(0, extent) for extent in size]))) @ directions.T
+    levels = self.levelsSpinBox.value
+    controlSpacing = self.spacingSpinBox.value or max(size.max(), 1.0) / 2 ** (levels + 1)
+    self.deformation, converged = fitLandmarks(fixedPoints, movingPoints, controlSpacing, levels=levels,
+                                               smoothness=self.smoothnessSpinBox.value,
+                                               directions=directions, domain=corners)
+    if not converged:
+      logging.warning("%s: the warp was not fitted to tolerance, increase the smoothness" % self.name)
+
+    state.transform.SetAndObserveTransformFromParent(bsplineTransform(self.deformation))
+    state.logic.updateLandmarkResiduals(state)
+
+  def onExportBSpline(self):
+    """Copies the current warp to a new B-spline transform node"""
+    state = self.registrationState()
+    if self.deformation is None or not state.transform:
+      return
+    bsplineNode = slicer.vtkMRMLBSplineTransformNode()
+    bsplineNode.SetAndObserveTransformFromParent(bsplineTransform(self.deformation))
+    bsplineNode.SetName(state.transform.GetName()+"-bspline")
+    slicer.mrmlScene.AddNode(bsplineNode)
+    return bsplineNode
+
+
+# Add this plugin to the dictionary of available registrations.
+# Since this module may be discovered before the Editor itself,
+# create the list if it doesn't already exist.
+try:
+  slicer.modules.registrationPlugins
+except AttributeError:
+  slicer.modules.registrationPlugins = {}
+slicer.modules.registrationPlugins['BSpline'] = BSplinePlugin
@@ -0,0 +1,248 @@
+import math, os
+import numpy
+from . import LinearSolver
+from .ThinPlateSpline import ThinPlateSpline, thinPlateKernel
+
+#
+# Bootstrap uncertainty of landmark transforms
+#
+# The landmarks are resampled with replacement and the transform is
+# refitted to every replicate.  The spread of the replicate displacements
+# at each grid point measures how much the transform there depends on
+# the particular landmarks chosen.
+#
+# Every replicate is stored in a common form, thin plate weights on all
+# the fixed landmarks (zero for landmarks not drawn, and for linear fits)
+# plus an affine part, so a block of grid points is evaluated for all
+# replicates with one matrix product.  Replicates are fitted and grid
+# slabs are evaluated in a process pool, or in threads inside the Slicer
+# application, which must not be forked.  For the processes the landmark
+# arrays, the replicate coefficients and the output grids live in shared
+# memory.  Each slab is reduced to its mean and standard deviation right
+# away, so the B replicate grids are never held in memory.
+#
+# Displacements are in the resampling direction: from a fixed volume
+# position to the corresponding moving volume position, minus the
+# fixed position.
+#
+
+bootstrapMethods = LinearSolver.linearModes + ('ThinPlate',)
+
+def _createShared(shape, dtype=numpy.float64):
+  from multiprocessing import shared_memory
+  dtype = numpy.dtype(dtype)
+  size = max(1, int(numpy.prod(shape)) * dtype.itemsize)
+  block = shared_memory.SharedMemory(create=True, size=size)
+  array = numpy.ndarray(shape, dtype=dtype, buffer=block.buf)
+  return block, array, (block.name, tuple(shape), dtype.str)
+
+def _attachShared(specs):
+  """Map the (name, shape, dtype) specs to arrays.  Returns the arrays
+  and the blocks, which can only be closed once no view of them is left."""
+  from multiprocessing import shared_memory
+  arrays = {}
+  blocks = []
+  for key,(name,shape,dtype) in specs.items():
+    # workers share the resource tracker of the creating process, which
+    # unlinks the block once
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    arrays[key] = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=block.buf)
+  return arrays, blocks
+
+def _releaseShared(arrays, blocks):
+  arrays.clear()
+  for block in blocks:
+    block.close()
+
+def _commonFrame(fixed):
+  """Origin and scale shared by the polynomial parts of all replicates"""
+  origin = fixed.mean(axis=0)
+  spread = math.sqrt(numpy.mean(numpy.sum((fixed - origin) ** 2, axis=1)))
+  return origin, (spread if spread > 0 else 1.0)
+
+def _fitReplicates(arrays, first, last, method, scaleMode):
+  """Fit replicates first to last-1 into the shared weight arrays"""
+  fixed = arrays['fixed']
+  moving = arrays['moving']
+  origin, scale = _commonFrame(fixed)
+  for replicate in range(first, last):
+    counts = arrays['counts'][replicate]
+    weights = arrays['weights'][replicate]
+    polynomial = arrays['polynomial'][replicate]
+    weights[:] = 0
+    try:
+      if method == 'ThinPlate':
+        # repeated landmarks are the same interpolation constraint
+        drawn = numpy.flatnonzero(counts)
+        spline = ThinPlateSpline(fixed[drawn], moving[drawn])
+        count = drawn.shape[0]
+        weights[drawn] = spline.coefficients[:count]
+        constant, linear = spline.coefficients[count], spline.coefficients[count+1:]
+        # re-express the affine part in the common frame
+        polynomial[0] = constant + (origin - spline.origin) @ linear / spline.scale + spline.origin - origin
+        polynomial[1:] = linear * (scale / spline.scale)
+      else:
+        matrix = LinearSolver.fitLinear(fixed, moving, method, weights=counts, scaleMode=scaleMode)
+        polynomial[0] = matrix[:3,:3] @ origin + matrix[:3,3] - origin
+        polynomial[1:] = scale * matrix[:3,:3].T
+      arrays['valid'][replicate] = numpy.isfinite(polynomial).all() and numpy.isfinite(weights).all()
+    except (numpy.linalg.LinAlgError, ValueError):
+      arrays['valid'][replicate] = False
+
+def _evaluateSlab(arrays, first, last, ijkToRAS, dimensions, useKernel):
+  """Reduce the replicate displacements at the grid points with flat
+  (k,j,i) indices first to last-1 to their mean and standard deviation"""
+  fixed = arrays['fixed']
+  origin, scale = _commonFrame(fixed)
+  valid = arrays['valid'].astype(bool)
+  weights = arrays['weights'][valid]
+  polynomial = arrays['polynomial'][valid]
+  replicateCount = weights.shape[0]
+  k, j, i = numpy.unravel_index(numpy.arange(first, last), (dimensions[2], dimensions[1], dimensions[0]))
+  ijk = numpy.stack((i, j, k), axis=1).astype(numpy.float64)
+  centered = ijk @ ijkToRAS[:3,:3].T + ijkToRAS[:3,3] - origin
+  basis = numpy.empty((centered.shape[0],4))
+  basis[:,0] = 1.0
+  basis[:,1:] = centered / scale
+  # (M, B*3) mapped positions of all replicates, relative to the origin
+  mapped = basis @ polynomial.transpose(1,0,2).reshape(4, replicateCount * 3)
+  if useKernel:
+    mapped += thinPlateKernel(centered, fixed - origin) @ weights.transpose(1,0,2).reshape(-1, replicateCount * 3)
+  mapped = mapped.reshape(-1, replicateCount, 3)
+  mean = mapped.mean(axis=1)
+  squares = ((mapped - mean[:,numpy.newaxis,:]) ** 2).sum(axis=1)
+  arrays['mean'][first:last] = mean - centered
+  arrays['std'][first:last] = numpy.sqrt(squares / max(replicateCount - 1, 1))
+
+def _fitTask(specs, *arguments):
+  """Pool task running _fitReplicates on the shared arrays"""
+  arrays, blocks = _attachShared(specs)
+  try:
+    _fitReplicates(arrays, *arguments)
+  finally:
+    _releaseShared(arrays, blocks)
+
+def _evaluateTask(specs, *arguments):
+  """Pool task running _evaluateSlab on the shared arrays"""
+  arrays, blocks = _attachShared(specs)
+  try:
+    _evaluateSlab(arrays, *arguments)
+  finally:
+    _releaseShared(arrays, blocks)
+
+def _inApplication():
+  """True inside the Slicer application"""
+  try:
+    import slicer
+  except ImportError:
+    return False
+  return hasattr(slicer, 'app')
+
+def _executor(workers):
+  """(pool, processes) for the tasks, the pool being None to run serially
+  with one worker.  The Slicer application runs Qt and VTK threads, so
+  forking it could leave locks held in the child, and it cannot be
+  spawned as a plain python; there the pool has threads, numpy releasing
+  the GIL in the products that dominate.  Elsewhere worker processes are
+  started fresh (forkserver or spawn) and work on shared memory."""
+  if workers <= 1:
+    return None, False
+  if _inApplication():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=workers), False
+  import multiprocessing
+  from concurrent.futures import ProcessPoolExecutor
+  startMethod = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+  return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(startMethod)), True
+
+def _run(executor, calls):
+  if executor is None:
+    for function,arguments in calls:
+      function(*arguments)
+    return
+  futures = [executor.submit(function, *arguments) for function,arguments in calls]
+  for future in futures:
+    future.result()
+
+def bootstrapDisplacements(fixed, moving, method, ijkToRAS, dimensions, replicates=100,
+                           seed=0, workers=None, scaleMode='vtk', memoryPerTask=64*2**20):
+  """Bootstrap the fit of method to the landmark pairs over a grid.
+
+  fixed and moving are (N,3) arrays of corresponding landmarks, method
+  one of bootstrapMethods.  The grid has dimensions (I,J,K) and maps
+  indices to positions with the 4x4 ijkToRAS matrix, like a volume.
+  replicates landmark sets are drawn with replacement and fitted by
+  workers processes, or threads inside the application (default: one
+  per cpu).
+
+  Returns (mean, std), two (K,J,I,3) arrays with the mean displacement
+  and the standard deviation of the displacement components.
+  """
+  if method not in bootstrapMethods:
+    raise ValueError("Unknown method %s" % method)
+  fixed = numpy.ascontiguousarray(fixed, dtype=numpy.float64).reshape(-1,3)
+  moving = numpy.ascontiguousarray(moving, dtype=numpy.float64).reshape(-1,3)
+  if fixed.shape != moving.shape:
+    raise ValueError("Expected matching landmarks, got %s and %s" % (fixed.shape, moving.shape))
+  ijkToRAS = numpy.asarray(ijkToRAS, dtype=numpy.float64)
+  dimensions = tuple(int(dimension) for dimension in dimensions)
+  count = fixed.shape[0]
+  pointCount = dimensions[0] * dimensions[1] * dimensions[2]
+  if workers is None:
+    workers = os.cpu_count() or 1
+
+  random = numpy.random.default_rng(seed)
+  draws = random.integers(0, count, size=(replicates, count))
+  counts = numpy.zeros((replicates, count), dtype=numpy.int32)
+  numpy.add.at(counts, (numpy.arange(replicates)[:,numpy.newaxis], draws), 1)
+
+  executor, processes = _executor(min(workers, replicates))
+  blocks = []
+  specs = {}
+  arrays = {}
+  try:
+    for key,shape,dtype in (
+        ('fixed', (count,3), numpy.float64),
+        ('moving', (count,3), numpy.float64),
+        ('counts', (replicates,count), numpy.int32),
+        ('weights', (replicates,count,3), numpy.float64),
+        ('polynomial', (replicates,4,3), numpy.float64),
+        ('valid', (replicates,), numpy.int8),
+        ('mean', (pointCount,3), numpy.float64),
+        ('std', (pointCount,3), numpy.float64),
+        ):
+      if processes:
+        block, arrays[key], specs[key] = _createShared(shape, dtype)
+        blocks.append(block)
+      else:
+        arrays[key] = numpy.zeros(shape, dtype=dtype)
+    arrays['fixed'][...] = fixed
+    arrays['moving'][...] = moving
+    arrays['counts'][...] = counts
+    # worker processes attach the shared arrays by their specs
+    if processes:
+      fitTask, evaluateTask, data = _fitTask, _evaluateTask, specs
+    else:
+      fitTask, evaluateTask, data = _fitReplicates, _evaluateSlab, arrays
+
+    # a few tasks per worker to balance the load
+    step = max(1, math.ceil(replicates / (4 * workers)))
+    _run(executor, [(fitTask, (data, first, min(first + step, replicates), method, scaleMode))
+                    for first in range(0, replicates, step)])
+
+    # slabs sized so that the (points, replicates, 3) block and the kernel fit the budget
+    step = max(1, memoryPerTask // (8 * (3 * replicates + count + 8)))
+    useKernel = method == 'ThinPlate'
+    _run(executor, [(evaluateTask, (data, first, min(first + step, pointCount), ijkToRAS, dimensions, useKernel))
+                    for first in range(0, pointCount, step)])
+
+    shape = (dimensions[2], dimensions[1], dimensions[0], 3)
+    return arrays['mean'].reshape(shape).copy(), arrays['std'].reshape(shape).copy()
+  finally:
+    if executor is not None:
+      executor.shutdown()
+    arrays.clear()
+    for block in blocks:
+      block.close()
+      block.unlink()
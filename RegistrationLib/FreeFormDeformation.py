@@ -0,0 +1,247 @@
+import numpy
+import vtk
+from vtk.util import numpy_support
+from .WendlandSpline import _SparseMatrix, conjugateGradient
+
+#
+# Multilevel cubic B-spline free-form deformation fitted to landmarks
+#
+#   d(x) = sum_k c_k beta((x - o) / s - k)
+#
+# over a uniform lattice of control points k with origin o and spacing s,
+# beta being the centered cubic B-spline and the coefficients zero off
+# the lattice, the same displacement as vtkBSplineTransform with a zero
+# border.  Every landmark only touches its 4x4x4 nearest control points,
+# so the design matrix has 64 entries per row and is never formed: its
+# products are gathers and numpy.bincount.  The regularized normal
+# equations are solved by Jacobi preconditioned conjugate gradients, in
+# time linear in the number of landmarks for a given lattice.
+#
+# The regularization penalizes the second differences of the control
+# points along each lattice axis, which keeps the warp smooth where there
+# are no landmarks.  Levels go coarse to fine: each halves the spacing,
+# subdivides the spline of the previous levels exactly onto the finer
+# lattice and fits what the landmarks still miss.
+#
+
+def _basis(t):
+  """(M,4) cubic B-spline weights of the control points floor(f)-1 to
+  floor(f)+2 for fractional lattice positions t = f - floor(f)"""
+  t2 = t * t
+  t3 = t2 * t
+  return numpy.stack(((1 - t) ** 3, 3 * t3 - 6 * t2 + 4, -3 * t3 + 3 * t2 + 3 * t + 1, t3), axis=1) / 6
+
+def _slice(axis, start, stop, step=None):
+  index = [slice(None)] * 4
+  index[axis] = slice(start, stop, step)
+  return tuple(index)
+
+def _refineAxis(coefficients, axis):
+  """Subdivide the control points along axis of a (K,J,I,3) array onto
+  a lattice of half the spacing, (n,...) -> (2n-3,...)"""
+  count = coefficients.shape[axis]
+  shape = list(coefficients.shape)
+  shape[axis] = 2 * count - 3
+  refined = numpy.empty(shape)
+  # new points halfway between old ones, and at the old ones
+  refined[_slice(axis, 0, None, 2)] = (coefficients[_slice(axis, 0, -1)] + coefficients[_slice(axis, 1, None)]) / 2
+  refined[_slice(axis, 1, None, 2)] = (coefficients[_slice(axis, 0, -2)] + 6 * coefficients[_slice(axis, 1, -1)] +
+                                       coefficients[_slice(axis, 2, None)]) / 8
+  return refined
+
+def _bendingProduct(coefficients):
+  """D^T D of the (K,J,I,3) coefficients, D stacking the second
+  differences along the three lattice axes"""
+  result = numpy.zeros_like(coefficients)
+  for axis in range(3):
+    if coefficients.shape[axis] < 3:
+      continue
+    differences = coefficients[_slice(axis, 2, None)] - 2 * coefficients[_slice(axis, 1, -1)] + \
+        coefficients[_slice(axis, 0, -2)]
+    result[_slice(axis, 2, None)] += differences
+    result[_slice(axis, 1, -1)] -= 2 * differences
+    result[_slice(axis, 0, -2)] += differences
+  return result
+
+def _bendingDiagonal(shape):
+  """(K,J,I) diagonal of D^T D"""
+  diagonal = numpy.zeros(shape)
+  for axis in range(3):
+    count = shape[axis]
+    if count < 3:
+      continue
+    weights = numpy.zeros(count)
+    weights[2:] += 1
+    weights[1:-1] += 4
+    weights[:-2] += 1
+    view = [numpy.newaxis] * 3
+    view[axis] = slice(None)
+    diagonal += weights[tuple(view)]
+  return diagonal
+
+class FreeFormDeformation:
+  """
+  Cubic B-spline displacement field on a lattice of control points.
+
+  origin is the world position of control point (0,0,0), spacing the
+  isotropic lattice spacing, dimensions the (I,J,K) control point counts
+  and the columns of directions the lattice axes.  coefficients is the
+  (K,J,I,3) array of control point displacements, laid out like the
+  coefficient image of vtkBSplineTransform.
+  """
+
+  def __init__(self, origin, spacing, dimensions, directions=None, coefficients=None):
+    self.origin = numpy.array(origin, dtype=numpy.float64)
+    self.spacing = float(spacing)
+    self.dimensions = tuple(int(dimension) for dimension in dimensions)
+    self.directions = numpy.eye(3) if directions is None else numpy.array(directions, dtype=numpy.float64)
+    shape = (self.dimensions[2], self.dimensions[1], self.dimensions[0], 3)
+    self.coefficients = numpy.zeros(shape) if coefficients is None else \
+        numpy.array(coefficients, dtype=numpy.float64).reshape(shape)
+
+  @classmethod
+  def covering(cls, points, spacing, directions=None):
+    """Zero deformation whose lattice spans the (M,3) points, e.g. the
+    landmarks and the corners of a volume, with one control point
+    beyond them on every side"""
+    directions = numpy.eye(3) if directions is None else numpy.asarray(directions, dtype=numpy.float64)
+    local = numpy.asarray(points, dtype=numpy.float64).reshape(-1,3) @ directions
+    lower = local.min(axis=0)
+    intervals = numpy.maximum(numpy.ceil((local.max(axis=0) - lower) / spacing - 1e-9), 1).astype(int)
+    return cls(directions @ (lower - spacing), spacing, intervals + 3, directions)
+
+  def refined(self):
+    """The same deformation on a lattice of half the spacing.  It is
+    exact over the region the lattice spans, less one spacing on every
+    side."""
+    coefficients = self.coefficients
+    for axis in range(3):
+      coefficients = _refineAxis(coefficients, axis)
+    spacing = self.spacing / 2
+    return FreeFormDeformation(self.origin + self.directions @ numpy.full(3, spacing), spacing,
+                               [2 * dimension - 3 for dimension in self.dimensions], self.directions, coefficients)
+
+  def _stencil(self, points):
+    """(M,64) flat coefficient indices and weights of the control points
+    around each of the (M,3) points; points off the lattice get zero
+    weights"""
+    lattice = (points - self.origin) @ self.directions / self.spacing
+    cells = numpy.floor(lattice)
+    basis = [_basis(lattice[:,axis] - cells[:,axis]) for axis in range(3)]
+    first = cells.astype(numpy.int64) - 1
+    indices = []
+    for axis in range(3):
+      index = first[:,axis,numpy.newaxis] + numpy.arange(4)
+      inside = (index >= 0) & (index < self.dimensions[axis])
+      basis[axis] = basis[axis] * inside
+      indices.append(numpy.clip(index, 0, self.dimensions[axis] - 1))
+    weights = basis[2][:,:,numpy.newaxis,numpy.newaxis] * basis[1][:,numpy.newaxis,:,numpy.newaxis] * \
+        basis[0][:,numpy.newaxis,numpy.newaxis,:]
+    flat = (indices[2][:,:,numpy.newaxis,numpy.newaxis] * self.dimensions[1] +
+            indices[1][:,numpy.newaxis,:,numpy.newaxis]) * self.dimensions[0] + \
+        indices[0][:,numpy.newaxis,numpy.newaxis,:]
+    count = points.shape[0]
+    return flat.reshape(count,64), weights.reshape(count,64)
+
+  def displacements(self, points, chunkSize=65536):
+    """(M,3) displacements at an (M,3) array of points.  Safe to call
+    from several threads."""
+    points = numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1,3)
+    coefficients = self.coefficients.reshape(-1,3)
+    result = numpy.empty_like(points)
+    for start in range(0, points.shape[0], chunkSize):
+      indices, weights = self._stencil(points[start:start + chunkSize])
+      result[start:start + indices.shape[0]] = numpy.einsum('mk,mki->mi', weights, coefficients[indices])
+    return result
+
+  def transformPoints(self, points, chunkSize=65536):
+    """Map an (M,3) array of points through the deformation"""
+    points = numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1,3)
+    return points + self.displacements(points, chunkSize)
+
+  def fitDisplacements(self, points, displacements, smoothness=0.1, tolerance=1e-3, iterations=None):
+    """Add the regularized least squares fit of the (M,3) displacements
+    at the (M,3) points to the coefficients.  smoothness weighs the
+    second differences of the added coefficients against the fit, relative
+    to the average landmark weight of a control point.  Returns whether
+    the solver converged."""
+    points = numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1,3)
+    displacements = numpy.ascontiguousarray(displacements, dtype=numpy.float64).reshape(-1,3)
+    if points.shape[0] == 0:
+      return True
+    shape = self.coefficients.shape
+    count = shape[0] * shape[1] * shape[2]
+    indices, weights = self._stencil(points)
+    rows = numpy.repeat(numpy.arange(points.shape[0]), indices.shape[1])
+    design = _SparseMatrix(rows, indices.ravel(), weights.ravel(), (points.shape[0], count))
+    designTranspose = _SparseMatrix(indices.ravel(), rows, weights.ravel(), (count, points.shape[0]))
+    gram = None
+    if design.matrix is not None:
+      # with many landmarks per control point, products with the normal
+      # matrix formed once are cheaper than with the design matrix twice
+      gram = (designTranspose.matrix @ design.matrix).tocsr()
+      if gram.nnz > 2 * weights.size:
+        gram = None
+
+    dataDiagonal = numpy.bincount(indices.ravel(), weights=(weights * weights).ravel(), minlength=count)
+    # scale the penalty like the data term, plus a little ridge for
+    # control points no landmark or difference reaches
+    scale = smoothness * dataDiagonal.sum() / count
+    ridge = 1e-6 * max(scale, dataDiagonal.max())
+    diagonal = dataDiagonal + scale * _bendingDiagonal(shape[:3]).ravel() + ridge
+
+    class NormalMatrix:
+      def __matmul__(_, coefficients):
+        bending = _bendingProduct(coefficients.reshape(shape)).reshape(-1,3)
+        data = gram @ coefficients if gram is not None else designTranspose @ (design @ coefficients)
+        return data + scale * bending + ridge * coefficients
+
+    solution, converged = conjugateGradient(NormalMatrix(), designTranspose @ displacements, tolerance=tolerance,
+                                            iterations=iterations, diagonal=diagonal)
+    self.coefficients += solution.reshape(shape)
+    return converged
+
+def fitLandmarks(source, target, spacing, levels=3, smoothness=0.1, directions=None, domain=None):
+  """Multilevel FreeFormDeformation taking the (N,3) source landmarks to
+  the target ones.
+
+  spacing is the control point spacing of the finest level, each of the
+  coarser levels doubles it.  The lattice is aligned with the columns of
+  directions (default: world axes) and spans the source landmarks and
+  the optional (M,3) domain points.
+
+  Returns (deformation, converged).
+  """
+  source = numpy.ascontiguousarray(source, dtype=numpy.float64).reshape(-1,3)
+  target = numpy.ascontiguousarray(target, dtype=numpy.float64).reshape(-1,3)
+  if source.shape != target.shape:
+    raise ValueError("Expected matching landmarks, got %s and %s" % (source.shape, target.shape))
+  levels = max(int(levels), 1)
+  extent = source if domain is None else numpy.vstack((source, numpy.asarray(domain, dtype=numpy.float64).reshape(-1,3)))
+  deformation = FreeFormDeformation.covering(extent, spacing * 2 ** (levels - 1), directions)
+  converged = True
+  for level in range(levels):
+    if level:
+      deformation = deformation.refined()
+    converged &= deformation.fitDisplacements(source, target - source - deformation.displacements(source), smoothness)
+  return deformation, converged
+
+def bsplineTransform(deformation):
+  """slicer.vtkOrientedBSplineTransform of the deformation, with the
+  coefficients copied into its coefficient image"""
+  import slicer
+  coefficients = vtk.vtkImageData()
+  coefficients.SetOrigin(*deformation.origin)
+  coefficients.SetSpacing(*[deformation.spacing,]*3)
+  coefficients.SetDimensions(*deformation.dimensions)
+  coefficients.AllocateScalars(vtk.VTK_DOUBLE, 3)
+  numpy_support.vtk_to_numpy(coefficients.GetPointData().GetScalars())[:] = deformation.coefficients.reshape(-1,3)
+  transform = slicer.vtkOrientedBSplineTransform()
+  transform.SetBorderModeToZero()
+  transform.SetCoefficientData(coefficients)
+  matrix = vtk.vtkMatrix4x4()
+  for row in range(3):
+    for column in range(3):
+      matrix.SetElement(row, column, deformation.directions[row][column])
+  transform.SetGridDirectionMatrix(matrix)
+  return transform
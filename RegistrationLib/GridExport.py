@@ -0,0 +1,110 @@
+import os
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+#
+# Sampling transforms on displacement grids
+#
+# The grid is split into slabs of consecutive points that are mapped
+# with vectorized numpy code in a thread pool.  numpy releases the GIL
+# in its matrix products and element-wise kernels, so the slabs run in
+# parallel without copying the landmarks into other processes.  Every
+# slab writes straight into its part of one preallocated displacement
+# array, which is then handed to vtk without a copy.
+#
+
+def gridPoints(origin, spacing, dimensions, directions, first, last):
+  """(last-first,3) positions of the grid points with flat (k,j,i)
+  indices first to last-1, for a grid with the given origin, spacing
+  and (I,J,K) dimensions whose axes are the columns of directions"""
+  k, j, i = numpy.unravel_index(numpy.arange(first, last), (dimensions[2], dimensions[1], dimensions[0]))
+  ijk = numpy.stack((i, j, k), axis=1) * numpy.asarray(spacing, dtype=numpy.float64)
+  return ijk @ numpy.asarray(directions, dtype=numpy.float64).T + numpy.asarray(origin, dtype=numpy.float64)
+
+def volumeGridGeometry(volumeNode, spacing=None):
+  """(origin, spacing, dimensions, directions) of a grid along the axes
+  of volumeNode that covers it with isotropic samples.  spacing defaults
+  to five times the largest voxel spacing and is at least the smallest."""
+  ijkToRAS = vtk.vtkMatrix4x4()
+  volumeNode.GetIJKToRASMatrix(ijkToRAS)
+  ijkToRAS = numpy.array([[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)])
+  voxelSpacing = numpy.linalg.norm(ijkToRAS[:3,:3], axis=0)
+  directions = ijkToRAS[:3,:3] / voxelSpacing
+  spacing = max(spacing or voxelSpacing.max() * 5, voxelSpacing.min())
+  size = (numpy.array(volumeNode.GetImageData().GetDimensions()) - 1) * voxelSpacing
+  dimensions = [int(numpy.ceil(extent / spacing - 1e-6)) + 1 for extent in size]
+  return ijkToRAS[:3,3], [spacing,]*3, dimensions, directions
+
+def sampleDisplacements(mapPoints, origin, spacing, dimensions, directions=None, workers=None,
+                        slabSize=2**16, progress=None, dtype=numpy.float32):
+  """Sample the displacement mapPoints(p) - p over a grid.
+
+  mapPoints maps an (M,3) array of positions and must be safe to call
+  from several threads.  The grid has the given origin, spacing and
+  (I,J,K) dimensions, with axes along the columns of the 3x3 directions
+  matrix (default: identity).  Slabs of slabSize points are evaluated
+  in a pool of workers threads (default: one per cpu).
+
+  progress, if given, is called on the calling thread with the fraction
+  of slabs done; when it returns True the remaining slabs are cancelled
+  and None is returned.
+
+  Returns a (K,J,I,3) array of dtype.
+  """
+  if directions is None:
+    directions = numpy.eye(3)
+  dimensions = tuple(int(dimension) for dimension in dimensions)
+  pointCount = dimensions[0] * dimensions[1] * dimensions[2]
+  displacements = numpy.empty((pointCount,3), dtype=dtype)
+  if workers is None:
+    workers = os.cpu_count() or 1
+
+  def sampleSlab(first, last):
+    points = gridPoints(origin, spacing, dimensions, directions, first, last)
+    displacements[first:last] = mapPoints(points) - points
+
+  slabs = [(first, min(first + slabSize, pointCount)) for first in range(0, pointCount, slabSize)]
+  if workers <= 1:
+    for index,(first,last) in enumerate(slabs):
+      sampleSlab(first, last)
+      if progress and progress((index + 1) / len(slabs)):
+        return None
+  else:
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+      futures = [executor.submit(sampleSlab, first, last) for first,last in slabs]
+      for done,future in enumerate(as_completed(futures)):
+        future.result()
+        if progress and progress((done + 1) / len(slabs)):
+          return None
+    finally:
+      executor.shutdown(wait=True, cancel_futures=True)
+  return displacements.reshape(dimensions[2], dimensions[1], dimensions[0], 3)
+
+def displacementImage(displacements, origin, spacing):
+  """Wrap a (K,J,I,3) displacement array as vtkImageData without copying.
+  The image keeps a reference to the array."""
+  displacements = numpy.ascontiguousarray(displacements)
+  image = vtk.vtkImageData()
+  image.SetOrigin(*origin)
+  image.SetSpacing(*spacing)
+  image.SetDimensions(displacements.shape[2], displacements.shape[1], displacements.shape[0])
+  scalars = numpy_support.numpy_to_vtk(displacements.reshape(-1,3), deep=False)
+  scalars.SetName("Displacement")
+  image.GetPointData().SetScalars(scalars)
+  return image
+
+def gridTransform(displacements, origin, spacing, directions=None):
+  """slicer.vtkOrientedGridTransform with the (K,J,I,3) displacements"""
+  import slicer
+  transform = slicer.vtkOrientedGridTransform()
+  transform.SetDisplacementGridData(displacementImage(displacements, origin, spacing))
+  if directions is not None:
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(3):
+      for column in range(3):
+        matrix.SetElement(row, column, directions[row][column])
+    transform.SetGridDirectionMatrix(matrix)
+  return transform
@@ -0,0 +1,110 @@
+import csv, json, os
+import numpy
+
+#
+# Reading and writing landmark files
+# - fcsv: Slicer markups fiducial text files (RAS or LPS)
+# - csv: a header row naming a label column and x,y,z (RAS) columns
+# - json: Slicer markups json (.mrk.json) or a {name: [r,a,s]} dictionary
+#
+
+markupsSchema = "https://raw.githubusercontent.com/slicer/slicer/master/Modules/Loadable/Markups/Resources/Schema/markups-schema-v1.0.3.json#"
+
+fcsvColumns = ('id','x','y','z','ow','ox','oy','oz','vis','sel','lock','label','desc','associatedNodeID')
+
+def landmarkFileFormat(path):
+  """Return 'fcsv', 'csv' or 'json' based on the file extension"""
+  lowerPath = path.lower()
+  for fileFormat in ('fcsv', 'csv', 'json'):
+    if lowerPath.endswith('.' + fileFormat):
+      return fileFormat
+  raise ValueError("Unsupported landmark file format: %s" % path)
+
+def _fromCoordinateSystem(positions, coordinateSystem):
+  """Convert positions to RAS in place"""
+  if str(coordinateSystem).strip().upper() in ('LPS', '1'):
+    positions[:,:2] *= -1
+  return positions
+
+def readLandmarkFile(path):
+  """Return (names, positions) read from a landmark file, with positions
+  as an (N,3) array of RAS coordinates"""
+  fileFormat = landmarkFileFormat(path)
+  names = []
+  rows = []
+  if fileFormat == 'fcsv':
+    coordinateSystem = 'RAS'
+    columns = fcsvColumns
+    with open(path, newline='') as fp:
+      for line in fp:
+        if line.startswith('#'):
+          key,_,value = line[1:].partition('=')
+          key = key.strip().lower()
+          if key == 'coordinatesystem':
+            coordinateSystem = value.strip()
+          elif key == 'columns':
+            columns = tuple([column.strip() for column in value.split(',')])
+          continue
+        if not line.strip():
+          continue
+        record = dict(zip(columns, next(csv.reader([line]))))
+        names.append(record['label'])
+        rows.append([float(record[axis]) for axis in 'xyz'])
+    positions = _fromCoordinateSystem(numpy.array(rows, dtype=float).reshape(-1,3), coordinateSystem)
+  elif fileFormat == 'csv':
+    with open(path, newline='') as fp:
+      reader = csv.DictReader(fp)
+      fieldNames = {name.strip().lower(): name for name in reader.fieldnames or ()}
+      labelField = fieldNames.get('label', fieldNames.get('name'))
+      axisFields = [fieldNames.get(axis, fieldNames.get(ras)) for axis,ras in zip('xyz','ras')]
+      if labelField is None or None in axisFields:
+        raise ValueError("%s needs a label (or name) column and x,y,z columns" % path)
+      for record in reader:
+        names.append(record[labelField])
+        rows.append([float(record[field]) for field in axisFields])
+    positions = numpy.array(rows, dtype=float).reshape(-1,3)
+  else:
+    with open(path) as fp:
+      document = json.load(fp)
+    if 'markups' in document:
+      markup = document['markups'][0]
+      for controlPoint in markup.get('controlPoints', []):
+        # points not placed yet have no position
+        if 'position' not in controlPoint or controlPoint.get('positionStatus') == 'undefined':
+          continue
+        names.append(controlPoint['label'])
+        rows.append(controlPoint['position'])
+      positions = _fromCoordinateSystem(numpy.array(rows, dtype=float).reshape(-1,3),
+                                        markup.get('coordinateSystem', 'LPS'))
+    else:
+      for name,position in document.items():
+        names.append(name)
+        rows.append(position)
+      positions = numpy.array(rows, dtype=float).reshape(-1,3)
+  return names, positions
+
+def writeLandmarkFile(path, names, positions, associatedNodeID=""):
+  """Write names and (N,3) RAS positions to a landmark file,
+  in the format given by the extension of path"""
+  fileFormat = landmarkFileFormat(path)
+  positions = numpy.asarray(positions, dtype=float).reshape(-1,3)
+  if fileFormat == 'fcsv':
+    with open(path, 'w', newline='') as fp:
+      fp.write("# Markups fiducial file version = 4.11\n")
+      fp.write("# CoordinateSystem = RAS\n")
+      fp.write("# columns = %s\n" % ','.join(fcsvColumns))
+      writer = csv.writer(fp, lineterminator='\n')
+      for index,(name,position) in enumerate(zip(names, positions)):
+        writer.writerow([index+1, *position, 0, 0, 0, 1, 1, 0, 0, name, "", associatedNodeID])
+  elif fileFormat == 'csv':
+    with open(path, 'w', newline='') as fp:
+      writer = csv.writer(fp, lineterminator='\n')
+      writer.writerow(('label','x','y','z'))
+      for name,position in zip(names, positions):
+        writer.writerow([name, *position])
+  else:
+    controlPoints = [{'label': name, 'position': list(map(float,position))}
+                     for name,position in zip(names, positions)]
+    document = {'@schema': markupsSchema, 'markups': [{'type': 'Fiducial', 'coordinateSystem': 'RAS', 'controlPoints': controlPoints}]}
+    with open(path, 'w') as fp:
+      json.dump(document, fp, indent=2)
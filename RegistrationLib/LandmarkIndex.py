@@ -0,0 +1,243 @@
+import vtk, slicer
+
+class LandmarkNameAllocator:
+  """
+  Hands out landmark names of the form prefix + number in constant time.
+
+  The allocator remembers the highest numbered name it has seen
+  (through noteName) or handed out, so new names are never reused
+  within a session even after the landmark is deleted.  Names that
+  were handed out but not yet added to a point list are reserved.
+  """
+
+  def __init__(self,prefix="L-"):
+    self.prefix = prefix
+    self.nextNumber = 0
+    self.reserved = set()
+
+  def reset(self):
+    self.nextNumber = 0
+    self.reserved = set()
+
+  def noteName(self,name):
+    """Record a name that is in use in a point list"""
+    self.reserved.discard(name)
+    if name.startswith(self.prefix):
+      number = name[len(self.prefix):]
+      if number.isdigit():
+        self.nextNumber = max(self.nextNumber, int(number) + 1)
+
+  def reserve(self,name):
+    """Keep name from being handed out, e.g. while it is being created"""
+    self.noteName(name)
+    self.reserved.add(name)
+
+  def release(self,name):
+    self.reserved.discard(name)
+
+  def allocate(self,isUsed=lambda name: False):
+    """Return a new reserved name.  isUsed is an optional callable
+    that reports names in use that have not been noted yet."""
+    while True:
+      name = "%s%d" % (self.prefix, self.nextNumber)
+      self.nextNumber += 1
+      if name not in self.reserved and not isUsed(name):
+        break
+    self.reserved.add(name)
+    return name
+
+
+class LandmarkIndex:
+  """
+  Incrementally maintained index of the point labels in the
+  landmark point lists.
+
+  Point lists are observed as soon as they are first queried and
+  the cached labels are only refreshed when points are added, removed
+  or relabeled.  Moving a point does not touch the index, so lookups
+  done while dragging are dictionary hits.
+
+  The generation counter is incremented whenever the set of labels
+  changes so that callers can cheaply detect stale derived data,
+  and rescanCount counts the point lists read in full.
+  Every label seen is also noted by the name allocator.
+  """
+
+  def __init__(self):
+    self.generation = 0
+    self.rescanCount = 0
+    self.nameAllocator = LandmarkNameAllocator()
+    self.labelsByListID = {} # listID -> labels, None when stale
+    self.indicesByListID = {} # listID -> {label: first index}, None when stale
+    self.observerTags = {} # listID -> [(pointList,tag),]
+    self.landmarksCache = {} # tuple of listIDs -> landmarksByName
+    self.sceneObserverTags = []
+    self.addSceneObservers()
+
+  def addSceneObservers(self):
+    """Drop the entries of point lists removed from the scene"""
+    self.removeSceneObservers()
+    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self.onNodeRemoved)
+    self.sceneObserverTags.append( (slicer.mrmlScene, tag) )
+    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
+    self.sceneObserverTags.append( (slicer.mrmlScene, tag) )
+
+  def removeSceneObservers(self):
+    for obj,tag in self.sceneObserverTags:
+      obj.RemoveObserver(tag)
+    self.sceneObserverTags = []
+
+  def removeObservers(self):
+    """Remove all scene and point list observers"""
+    self.removeSceneObservers()
+    for listID in list(self.observerTags.keys()):
+      self.untrack(listID)
+
+  def track(self,pointList):
+    """Start observing pointList if it is not already indexed"""
+    listID = pointList.GetID()
+    if listID in self.observerTags:
+      return
+    tags = []
+    tags.append( (pointList, pointList.AddObserver(pointList.PointAddedEvent, self.onPointAdded)) )
+    tags.append( (pointList, pointList.AddObserver(pointList.PointRemovedEvent, self.onPointRemoved)) )
+    tags.append( (pointList, pointList.AddObserver(pointList.PointModifiedEvent, self.onPointModified)) )
+    tags.append( (pointList, pointList.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onPointListModified)) )
+    self.observerTags[listID] = tags
+    self.labelsByListID[listID] = None
+    self.indicesByListID[listID] = None
+
+  def untrack(self,listID):
+    for obj,tag in self.observerTags.pop(listID, []):
+      obj.RemoveObserver(tag)
+    self.labelsByListID.pop(listID, None)
+    self.indicesByListID.pop(listID, None)
+    self.invalidate()
+
+  def invalidate(self,listID=None):
+    """Mark the labels of listID (or only the derived results) as stale"""
+    if listID is not None and listID in self.labelsByListID:
+      self.labelsByListID[listID] = None
+      self.indicesByListID[listID] = None
+    self.generation += 1
+    self.landmarksCache = {}
+
+  def labels(self,pointList):
+    """Return the list of labels of pointList indexed by control point index.
+    The returned list is owned by the index and must not be modified."""
+    self.track(pointList)
+    listID = pointList.GetID()
+    labels = self.labelsByListID[listID]
+    if labels is None:
+      labels = [pointList.GetNthControlPointLabel(index) for index in range(pointList.GetNumberOfControlPoints())]
+      self.labelsByListID[listID] = labels
+      self.rescanCount += 1
+      for label in labels:
+        self.nameAllocator.noteName(label)
+    return labels
+
+  def labelIndex(self,pointList):
+    """Return a dictionary mapping each label of pointList to the
+    index of the first control point with that label"""
+    labels = self.labels(pointList)
+    listID = pointList.GetID()
+    indices = self.indicesByListID[listID]
+    if indices is None:
+      indices = {}
+      for index,label in enumerate(labels):
+        indices.setdefault(label, index)
+      self.indicesByListID[listID] = indices
+    return indices
+
+  def newLandmarkName(self,pointLists):
+    """Return a landmark name not used in any of pointLists"""
+    labelIndices = [self.labelIndex(pointList) for pointList in pointLists if pointList]
+    return self.nameAllocator.allocate(
+        lambda name: any([name in labelIndex for labelIndex in labelIndices]))
+
+  def landmarksForPointLists(self,pointLists):
+    """Return a dictionary keyed by landmark name containing
+    pairs (pointList,index).  Entries in pointLists may be None,
+    in which case no landmark can be complete.
+    The result is cached until the labels change and must be
+    treated as read-only."""
+    key = tuple([pointList.GetID() if pointList else None for pointList in pointLists])
+    if key in self.landmarksCache:
+      return self.landmarksCache[key]
+    landmarksByName = {}
+    for pointList in pointLists:
+      if not pointList:
+        continue
+      for pointIndex,pointName in enumerate(self.labels(pointList)):
+        if pointName in landmarksByName:
+          landmarksByName[pointName].append((pointList,pointIndex))
+        else:
+          landmarksByName[pointName] = [(pointList,pointIndex),]
+    for pointName in list(landmarksByName.keys()):
+      if len(landmarksByName[pointName]) != len(pointLists):
+        del landmarksByName[pointName]
+    self.landmarksCache[key] = landmarksByName
+    return landmarksByName
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointAdded(self,pointList,event,index):
+    """Points appended at the end are added to the cached labels,
+    otherwise indices shift and the list is rescanned on next use"""
+    listID = pointList.GetID()
+    labels = self.labelsByListID.get(listID)
+    if labels is None or index is None or index != len(labels):
+      self.invalidate(listID)
+      return
+    label = pointList.GetNthControlPointLabel(index)
+    labels.append(label)
+    if self.indicesByListID[listID] is not None:
+      self.indicesByListID[listID].setdefault(label, index)
+    self.nameAllocator.noteName(label)
+    self.invalidate()
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointRemoved(self,pointList,event,index):
+    """Removing the last point keeps the cached labels,
+    otherwise indices shift and the list is rescanned on next use"""
+    listID = pointList.GetID()
+    labels = self.labelsByListID.get(listID)
+    if labels is None or index is None or index != len(labels) - 1:
+      self.invalidate(listID)
+      return
+    labels.pop()
+    self.indicesByListID[listID] = None
+    self.invalidate()
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointModified(self,pointList,event,index):
+    """Only a label change affects the index.  Events collected
+    during StartModify/EndModify carry no index, so rescan the list."""
+    listID = pointList.GetID()
+    labels = self.labelsByListID.get(listID)
+    if labels is None:
+      return
+    if index is None or index < 0 or index >= len(labels):
+      self.invalidate(listID)
+      return
+    label = pointList.GetNthControlPointLabel(index)
+    if label != labels[index]:
+      labels[index] = label
+      self.nameAllocator.noteName(label)
+      self.indicesByListID[listID] = None
+      self.invalidate()
+
+  def onPointListModified(self,pointList,event):
+    """Catch wholesale changes (e.g. copy or undo) that change the point count"""
+    labels = self.labelsByListID.get(pointList.GetID())
+    if labels is not None and len(labels) != pointList.GetNumberOfControlPoints():
+      self.invalidate(pointList.GetID())
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self,caller,event,node):
+    if node and node.GetID() in self.observerTags:
+      self.untrack(node.GetID())
+
+  def onSceneEndClose(self,caller,event):
+    for listID in list(self.observerTags.keys()):
+      self.untrack(listID)
+    self.nameAllocator.reset()
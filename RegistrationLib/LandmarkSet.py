@@ -0,0 +1,156 @@
+import numpy
+import vtk, slicer
+from vtk.util import numpy_support
+
+def arrayFromPointList(pointList):
+  """Return an (n,3) float64 array with the control point positions of pointList.
+  Lists that are not under a transform are read with a single call,
+  otherwise fall back to reading the local coordinates point by point."""
+  pointCount = pointList.GetNumberOfControlPoints()
+  if pointCount == 0:
+    return numpy.zeros((0,3))
+  if pointList.GetParentTransformNode() is None:
+    points = vtk.vtkPoints()
+    points.SetDataTypeToDouble()
+    pointList.GetControlPointPositionsWorld(points)
+    return numpy.array(numpy_support.vtk_to_numpy(points.GetData()), dtype=numpy.float64).reshape(-1,3)
+  array = numpy.zeros((pointCount,3))
+  for index in range(pointCount):
+    pointList.GetNthControlPointPosition(index, array[index])
+  return array
+
+def updatePointListFromArray(pointList, array):
+  """Set the positions of all control points of pointList from an (n,3) array.
+  The array must have one row per existing control point so labels are kept."""
+  array = numpy.ascontiguousarray(array, dtype=numpy.float64)
+  if array.shape != (pointList.GetNumberOfControlPoints(), 3):
+    raise ValueError("Expected %d positions, got %s" % (pointList.GetNumberOfControlPoints(), array.shape))
+  if pointList.GetParentTransformNode() is None:
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(array, deep=True))
+    pointList.SetControlPointPositionsWorld(points)
+    return
+  wasModifying = pointList.StartModify()
+  for index in range(array.shape[0]):
+    pointList.SetNthControlPointPosition(index, *array[index])
+  pointList.EndModify(wasModifying)
+
+def definedMaskForPointList(pointList):
+  """Return a boolean array telling which control points have a defined position"""
+  pointCount = pointList.GetNumberOfControlPoints()
+  if pointList.GetNumberOfDefinedControlPoints() == pointCount:
+    return numpy.ones(pointCount, dtype=bool)
+  return numpy.array([pointList.GetNthControlPointPositionStatus(index) == pointList.PositionDefined
+                       for index in range(pointCount)], dtype=bool)
+
+
+class LandmarkSet:
+  """
+  Struct-of-arrays view of the landmarks shared by a set of point lists.
+
+  names      - landmark names, one per row
+  positions  - (N,V,3) float64 array, one column per point list
+  indices    - (N,V) control point index of each landmark in each list
+  flags      - (N,) uint8 bit field, see DEFINED and OUTLIER
+  pointLists - the V point list nodes, in column order
+
+  Landmarks are joined on their label, in the order they appear
+  in the first point list.  Positions are read and written with
+  one call per point list rather than one call per point.
+  """
+
+  __slots__ = ('names', 'positions', 'indices', 'flags', 'pointLists', '_rowsByName')
+
+  # per-landmark flag bits
+  DEFINED = 1 # position is defined in every point list
+  OUTLIER = 2 # rejected by the last robust fit
+
+  def __init__(self, pointLists=(), names=(), indices=None):
+    self.pointLists = tuple(pointLists)
+    self.names = list(names)
+    columnCount = len(self.pointLists)
+    if indices is None:
+      indices = numpy.zeros((len(self.names), columnCount), dtype=numpy.int64)
+    self.indices = numpy.asarray(indices, dtype=numpy.int64).reshape(len(self.names), columnCount)
+    self.positions = numpy.zeros((len(self.names), columnCount, 3))
+    self.flags = numpy.zeros(len(self.names), dtype=numpy.uint8)
+    self._rowsByName = None
+
+  @classmethod
+  def fromPointLists(cls, pointLists, landmarkIndex):
+    """Build the set of landmarks present in every one of pointLists.
+    landmarkIndex is the LandmarkIndex used to look up labels."""
+    if not pointLists or None in pointLists:
+      return cls(pointLists)
+    # label dictionaries preserve the order of first occurrence
+    labelIndices = [landmarkIndex.labelIndex(pointList) for pointList in pointLists]
+    names = []
+    indices = []
+    for name,firstIndex in labelIndices[0].items():
+      row = [firstIndex]
+      for labelIndex in labelIndices[1:]:
+        index = labelIndex.get(name)
+        if index is None:
+          break
+        row.append(index)
+      else:
+        names.append(name)
+        indices.append(row)
+    landmarkSet = cls(pointLists, names, indices)
+    landmarkSet.readFromPointLists()
+    return landmarkSet
+
+  def __len__(self):
+    return len(self.names)
+
+  def readFromPointLists(self):
+    """Refresh positions and the DEFINED flag from MRML, keeping the current rows"""
+    defined = numpy.ones(len(self.names), dtype=bool)
+    for column,pointList in enumerate(self.pointLists):
+      rows = self.indices[:,column]
+      self.positions[:,column,:] = arrayFromPointList(pointList)[rows]
+      defined &= definedMaskForPointList(pointList)[rows]
+    self.flags &= ~numpy.uint8(self.DEFINED)
+    self.flags |= numpy.where(defined, self.DEFINED, 0).astype(numpy.uint8)
+
+  def writeToPointLists(self, columns=None):
+    """Push positions back to MRML, one call per point list.
+    columns optionally restricts the update to some of the point lists."""
+    if columns is None:
+      columns = range(len(self.pointLists))
+    for column in columns:
+      pointList = self.pointLists[column]
+      array = arrayFromPointList(pointList)
+      array[self.indices[:,column]] = self.positions[:,column,:]
+      updatePointListFromArray(pointList, array)
+
+  def rowForName(self, name):
+    """Return the row of the named landmark, or None"""
+    if self._rowsByName is None:
+      self._rowsByName = {name: row for row,name in enumerate(self.names)}
+    return self._rowsByName.get(name)
+
+  def definedMask(self):
+    return (self.flags & self.DEFINED) != 0
+
+  def setFlag(self, flag, mask):
+    """Set flag on the rows where mask is true and clear it elsewhere"""
+    self.flags &= ~numpy.uint8(flag)
+    self.flags[numpy.asarray(mask, dtype=bool)] |= numpy.uint8(flag)
+
+  def flaggedNames(self, flag):
+    return [name for name,flags in zip(self.names, self.flags) if flags & flag]
+
+  def column(self, column, definedOnly=False):
+    """Return a contiguous (N,3) array with the positions from one point list"""
+    positions = self.positions[:,column,:]
+    if definedOnly:
+      positions = positions[self.definedMask()]
+    return numpy.ascontiguousarray(positions)
+
+  def vtkPoints(self, column, definedOnly=True):
+    """Return a vtkPoints filled in one step from the positions of one point list.
+    By default landmarks without a defined position in every list are skipped."""
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(self.column(column, definedOnly), deep=True))
+    return points
@@ -1,6 +1,154 @@
-import qt, slicer, os
+import math
+import qt, vtk, slicer, os
 from . import pqWidget
 
+class LandmarkTableModel(qt.QAbstractTableModel):
+  """
+  Table model with one row per landmark name, sorted by name.
+  Changes to the set of names are applied as row insertions and
+  removals so the view only repaints what changed.
+  The error column shows the residual of each landmark under the
+  current registration, with the leave-one-out error in the tool tip.
+  """
+
+  NameColumn = 0
+  ErrorColumn = 1
+  ActiveColumn = 2
+  RemoveColumn = 3
+
+  def __init__(self,parent=None):
+    qt.QAbstractTableModel.__init__(self, parent)
+    self.names = []
+    self.selectedName = None
+    self.outlierNames = set()
+    self.residuals = None # RegistrationLib.ResidualReport shown in the error column
+    # icons are loaded once and shared by all rows
+    iconDirectory = os.path.join(os.path.dirname(slicer.modules.landmarkregistration.path), 'Resources/Icons/')
+    # active icon - https://thenounproject.com/term/crosshair/4434/
+    # remove icon - http://findicons.com/icon/158288/trash_recyclebin_empty_closed_w
+    self.icons = {
+      self.ActiveColumn: qt.QIcon(os.path.join(iconDirectory, "icon_Active.png")),
+      self.RemoveColumn: qt.QIcon(os.path.join(iconDirectory, "icon_Trash.png")),
+      }
+    self.toolTips = {
+      self.ActiveColumn: "Make this the active landmark",
+      self.RemoveColumn: "Remove this landmark from all volumes",
+      }
+    self.boldFont = qt.QFont()
+    self.boldFont.setBold(True)
+    self.outlierBrush = qt.QBrush(qt.QColor(200, 0, 0))
+
+  def rowCount(self,parent=qt.QModelIndex()):
+    if parent.isValid():
+      return 0
+    return len(self.names)
+
+  def columnCount(self,parent=qt.QModelIndex()):
+    if parent.isValid():
+      return 0
+    return 4
+
+  def data(self,index,role=qt.Qt.DisplayRole):
+    if not index.isValid() or index.row() >= len(self.names):
+      return None
+    name = self.names[index.row()]
+    column = index.column()
+    if column == self.NameColumn:
+      if role == qt.Qt.DisplayRole:
+        return name
+      if role == qt.Qt.FontRole and name == self.selectedName:
+        return self.boldFont
+      if name in self.outlierNames:
+        if role == qt.Qt.ForegroundRole:
+          return self.outlierBrush
+        if role == qt.Qt.ToolTipRole:
+          return "Rejected as an outlier by the robust fit"
+    elif column == self.ErrorColumn:
+      if self.residuals is None:
+        return None
+      error,leaveOneOutError = self.residuals.errorsForName(name)
+      if role == qt.Qt.DisplayRole and not math.isnan(error):
+        return "%.2f" % error
+      if role == qt.Qt.TextAlignmentRole:
+        return int(qt.Qt.AlignRight | qt.Qt.AlignVCenter)
+      if role == qt.Qt.ForegroundRole and name in self.outlierNames:
+        return self.outlierBrush
+      if role == qt.Qt.ToolTipRole and not math.isnan(error):
+        toolTip = "Registration error %.2f mm" % error
+        if not math.isnan(leaveOneOutError):
+          toolTip += ", %.2f mm when left out of the fit" % leaveOneOutError
+        return toolTip
+    else:
+      if role == qt.Qt.DecorationRole:
+        return self.icons[column]
+      if role == qt.Qt.ToolTipRole:
+        return self.toolTips[column]
+    return None
+
+  def flags(self,index):
+    if not index.isValid():
+      return qt.Qt.NoItemFlags
+    if index.column() == self.ActiveColumn and self.names[index.row()] == self.selectedName:
+      return qt.Qt.NoItemFlags
+    return qt.Qt.ItemIsEnabled
+
+  def nameAt(self,index):
+    if index.isValid() and index.row() < len(self.names):
+      return self.names[index.row()]
+    return None
+
+  def setNames(self,names):
+    """Update the rows to the sorted list of names"""
+    names = sorted(names)
+    if names == self.names:
+      return
+    newNames = set(names)
+    oldNames = set(self.names)
+    if len(newNames.symmetric_difference(oldNames)) > len(names) // 2:
+      # mostly new content (e.g. other volumes selected)
+      self.beginResetModel()
+      self.names = names
+      self.endResetModel()
+      return
+    for row in reversed(range(len(self.names))):
+      if self.names[row] not in newNames:
+        self.beginRemoveRows(qt.QModelIndex(), row, row)
+        del self.names[row]
+        self.endRemoveRows()
+    # the remaining names are a sorted subsequence of names
+    for row,name in enumerate(names):
+      if name not in oldNames:
+        self.beginInsertRows(qt.QModelIndex(), row, row)
+        self.names.insert(row, name)
+        self.endInsertRows()
+
+  def setOutlierNames(self,names):
+    """Repaint only the rows whose outlier state changed"""
+    names = set(names)
+    changedNames = names.symmetric_difference(self.outlierNames)
+    self.outlierNames = names
+    for changedName in changedNames:
+      if changedName in self.names:
+        row = self.names.index(changedName)
+        self.dataChanged(self.index(row, self.NameColumn), self.index(row, self.NameColumn))
+
+  def setResiduals(self,report):
+    """Show the errors of a RegistrationLib.ResidualReport (or none).
+    Only the error column is repainted."""
+    self.residuals = report
+    if self.names:
+      self.dataChanged(self.index(0, self.ErrorColumn), self.index(len(self.names) - 1, self.ErrorColumn))
+
+  def setSelectedName(self,name):
+    """Repaint only the rows of the previously and newly selected names"""
+    previousName = self.selectedName
+    self.selectedName = name
+    for changedName in (previousName, name):
+      if changedName in self.names:
+        row = self.names.index(changedName)
+        self.dataChanged(self.index(row, 0), self.index(row, self.columnCount() - 1))
+
+
 class LandmarksWidget(pqWidget):
   """
   A "QWidget"-like class that manages a set of landmarks
@@ -13,10 +161,12 @@ class LandmarksWidget(pqWidget):
     self.volumeNodes = []
     self.selectedLandmark = None # a landmark name
     self.landmarkGroupBox = None # a QGroupBox
-    self.labels = {} # the current buttons in the group box
     self.pendingUpdate = False # update on new scene nodes
+    self.pendingPoints = [] # (pointList,controlPointID) placed since the last update
+    self.pendingListIDs = set() # lists whose points are all in pendingPoints
+    self.pendingFullUpdate = False # reconcile every point list in the scene
     self.updatingPoints = False # don't update while update in process
-    self.observerTags = [] # for monitoring point changes
+    self.observerTags = {} # pointList ID -> [(pointList,tag),] for monitoring point changes
     self.movingView = None # layoutName of slice node where point is being moved
 
     self.widget = qt.QWidget()
@@ -24,19 +174,7 @@ class LandmarksWidget(pqWidget):
     self.landmarkArrayHolder = qt.QWidget()
     self.landmarkArrayHolder.setLayout(qt.QVBoxLayout())
     self.layout.addRow(self.landmarkArrayHolder)
-    self.updateLandmarkArray()
-
-  def setVolumeNodes(self,volumeNodes):
-    """Set up the widget to reflect the currently selected
-    volume nodes.  This triggers an update of the landmarks"""
-    self.volumeNodes = volumeNodes
-    self.updateLandmarkArray()
 
-  def updateLandmarkArray(self):
-    """Rebuild the list of buttons based on current landmarks"""
-    # reset the widget
-    if self.landmarkGroupBox:
-      self.landmarkGroupBox.setParent(None)
     self.landmarkGroupBox = qt.QGroupBox("Landmarks")
     self.landmarkGroupBox.setLayout(qt.QFormLayout())
     # add the action buttons at the top
@@ -55,61 +193,110 @@ class LandmarksWidget(pqWidget):
     # for now, hide
     self.renameButton.hide()
 
-    # make a button for each current landmark
-    self.labels = {}
-    landmarks = self.logic.landmarksForVolumes(self.volumeNodes)
-    keys = sorted(landmarks.keys())
-    for landmarkName in keys:
-      row = qt.QWidget()
-      rowLayout = qt.QHBoxLayout()
-      rowLayout.setContentsMargins(0, 0, 0, 0)
-
-      label = qt.QLabel(landmarkName)
-      rowLayout.addWidget(label, 8)
-
-      # active button - https://thenounproject.com/term/crosshair/4434/
-      activeButton = qt.QPushButton()
-      activeButton.setIcon(qt.QIcon(os.path.join(os.path.dirname(slicer.modules.landmarkregistration.path), 'Resources/Icons/', "icon_Active.png")))
-      activeButton.connect('clicked()', lambda l=landmarkName: self.pickLandmark(l))
-      rowLayout.addWidget(activeButton, 1)
-
-      if landmarkName == self.selectedLandmark:
-        label.setStyleSheet("QWidget{font-weight: bold;}")
-        activeButton.setEnabled(False)
-
-      # remove button - http://findicons.com/icon/158288/trash_recyclebin_empty_closed_w
-      removeButton = qt.QPushButton()
-      removeButton.setIcon(qt.QIcon(os.path.join(os.path.dirname(slicer.modules.landmarkregistration.path), 'Resources/Icons/', "icon_Trash.png")))
-      removeButton.connect('clicked()', lambda l=landmarkName: self.removeLandmark(l))
-      rowLayout.addWidget(removeButton, 1)
-
-      row.setLayout(rowLayout)
-
-      self.landmarkGroupBox.layout().addRow( row )
-      self.labels[landmarkName] = [label, activeButton]
+    # one row per landmark, only the visible rows are painted
+    self.landmarkModel = LandmarkTableModel()
+    self.landmarkView = qt.QTableView()
+    self.landmarkView.setModel(self.landmarkModel)
+    self.landmarkView.horizontalHeader().hide()
+    self.landmarkView.verticalHeader().hide()
+    self.landmarkView.setShowGrid(False)
+    self.landmarkView.setSelectionMode(qt.QAbstractItemView.NoSelection)
+    self.landmarkView.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    self.landmarkView.horizontalHeader().setSectionResizeMode(LandmarkTableModel.NameColumn, qt.QHeaderView.Stretch)
+    for column in (LandmarkTableModel.ErrorColumn, LandmarkTableModel.ActiveColumn, LandmarkTableModel.RemoveColumn):
+      self.landmarkView.horizontalHeader().setSectionResizeMode(column, qt.QHeaderView.ResizeToContents)
+    self.landmarkView.connect('clicked(QModelIndex)', self.onLandmarkViewClicked)
+    self.landmarkGroupBox.layout().addRow(self.landmarkView)
+
+    self.residualLabel = qt.QLabel()
+    self.residualLabel.setToolTip("Root mean square distance between the transformed moving landmarks and the fixed landmarks.  The leave-one-out error estimates the registration error away from the landmarks.")
+    self.landmarkGroupBox.layout().addRow(self.residualLabel)
+
     self.landmarkArrayHolder.layout().addWidget(self.landmarkGroupBox)
+    self.updateLandmarkArray()
 
-    # observe manipulation of the landmarks
+    # outliers found by robust registrations are shown in the table
+    self.landmarkModel.setOutlierNames(self.logic.outlierLandmarks)
+    self.logic.outlierObservers.append(self.landmarkModel.setOutlierNames)
+    # as are the landmark errors of the current registration
+    self.setResiduals(self.logic.landmarkResiduals)
+    self.logic.residualObservers.append(self.setResiduals)
+
+    # observe manipulation of the landmarks, later lists are
+    # picked up through onSceneNodeAdded
     self.addLandmarkObservers()
 
+  def setVolumeNodes(self,volumeNodes):
+    """Set up the widget to reflect the currently selected
+    volume nodes.  This triggers an update of the landmarks"""
+    self.volumeNodes = volumeNodes
+    self.updateLandmarkArray()
+    # points placed before the volumes were selected are picked up by a full pass
+    self.pendingFullUpdate = True
+    self.requestNodeAddedUpdate()
+
+  def updateLandmarkArray(self):
+    """Update the landmark table rows based on current landmarks"""
+    landmarks = self.logic.landmarksForVolumes(self.volumeNodes)
+    self.landmarkModel.setNames(landmarks.keys())
+    self.landmarkModel.setSelectedName(self.selectedLandmark)
+
+  def setResiduals(self,report):
+    """Show the per-landmark errors and their root mean square"""
+    self.landmarkModel.setResiduals(report)
+    if report is None or math.isnan(report.rms):
+      self.residualLabel.text = ""
+      return
+    text = "RMS error %.2f mm" % report.rms
+    if not math.isnan(report.leaveOneOutRMS):
+      text += ", leave-one-out %.2f mm" % report.leaveOneOutRMS
+    self.residualLabel.text = text
+
+  def onLandmarkViewClicked(self,index):
+    """Dispatch clicks on the active and remove columns of the table"""
+    landmarkName = self.landmarkModel.nameAt(index)
+    if landmarkName is None:
+      return
+    if index.column() == LandmarkTableModel.ActiveColumn:
+      self.pickLandmark(landmarkName)
+    elif index.column() == LandmarkTableModel.RemoveColumn:
+      self.removeLandmark(landmarkName)
+
   def addLandmarkObservers(self):
     """Add observers to all pointLists in scene
-    so we will know when new markups are added
+    so we will know when new markups are added.
+    Lists that are already observed are left alone.
     """
-    self.removeLandmarkObservers()
-    for pointList in slicer.util.getNodes('vtkMRMLMarkupsFiducialNode*').values():
-      tag = pointList.AddObserver(
-              pointList.PointModifiedEvent, lambda caller,event: self.onPointMoved(caller))
-      self.observerTags.append( (pointList,tag) )
-      tag = pointList.AddObserver(
-              pointList.PointEndInteractionEvent, lambda caller,event: self.onPointEndMoving(caller))
-      self.observerTags.append( (pointList,tag) )
-      tag = pointList.AddObserver(
-              pointList.PointPositionDefinedEvent, self.requestNodeAddedUpdate)
-      self.observerTags.append( (pointList,tag) )
-      tag = pointList.AddObserver(
-              pointList.PointPositionUndefinedEvent, self.requestNodeAddedUpdate)
-      self.observerTags.append( (pointList,tag) )
+    for pointList in slicer.util.getNodesByClass('vtkMRMLMarkupsFiducialNode'):
+      self.observePointList(pointList)
+
+  def observePointList(self,pointList):
+    """Add the point observers to pointList unless it already has them"""
+    if pointList.GetID() in self.observerTags:
+      return
+    tags = []
+    tag = pointList.AddObserver(
+            pointList.PointModifiedEvent, lambda caller,event: self.onPointMoved(caller))
+    tags.append( (pointList,tag) )
+    tag = pointList.AddObserver(
+            pointList.PointEndInteractionEvent, lambda caller,event: self.onPointEndMoving(caller))
+    tags.append( (pointList,tag) )
+    tag = pointList.AddObserver(
+            pointList.PointPositionDefinedEvent, self.onPointPositionDefined)
+    tags.append( (pointList,tag) )
+    tag = pointList.AddObserver(
+            pointList.PointPositionUndefinedEvent, self.requestNodeAddedUpdate)
+    tags.append( (pointList,tag) )
+    self.observerTags[pointList.GetID()] = tags
+
+  def observedPointListIDs(self):
+    """IDs of all the point lists in the scene, which are observed"""
+    return frozenset(self.observerTags.keys())
+
+  def unobservePointList(self,pointListID):
+    """Remove the point observers of the list with the given ID"""
+    for obj,tag in self.observerTags.pop(pointListID, []):
+      obj.RemoveObserver(tag)
 
   def onPointMoved(self,pointList):
     """Callback when pointList's point has been changed.
@@ -135,20 +322,16 @@ class LandmarksWidget(pqWidget):
 
   def removeLandmarkObservers(self):
     """Remove any existing observers"""
-    for obj,tag in self.observerTags:
-      obj.RemoveObserver(tag)
-    self.observerTags = []
+    for pointListID in list(self.observerTags.keys()):
+      self.unobservePointList(pointListID)
+    if self.landmarkModel.setOutlierNames in self.logic.outlierObservers:
+      self.logic.outlierObservers.remove(self.landmarkModel.setOutlierNames)
+    if self.setResiduals in self.logic.residualObservers:
+      self.logic.residualObservers.remove(self.setResiduals)
 
   def pickLandmark(self,landmarkName,clearMovingView=True):
-    """Hightlight the named landmark button and emit a 'signal'"""
-    for key in self.labels.keys():
-      self.labels[key][0].setStyleSheet("QWidget{font-weight: normal;}")
-      self.labels[key][1].setEnabled(True)
-    try:
-      self.labels[landmarkName][0].setStyleSheet("QWidget{font-weight: bold;}")
-      self.labels[landmarkName][1].setEnabled(False)
-    except KeyError:
-      pass
+    """Hightlight the named landmark row and emit a 'signal'"""
+    self.landmarkModel.setSelectedName(landmarkName)
     self.selectedLandmark = landmarkName
     self.renameButton.enabled = True
     if clearMovingView:
@@ -181,12 +364,52 @@ class LandmarksWidget(pqWidget):
           "New name for landmark '%s'?" % self.selectedLandmark)
       if newName != "":
         for pointList,index in landmarks[self.selectedLandmark]:
-          pointList.SetNthControlPointLabel(newName)
+          pointList.SetNthControlPointLabel(index, newName)
         self.selectedLandmark = newName
         self.updateLandmarkArray()
         self.pickLandmark(newName)
 
-  def requestNodeAddedUpdate(self,caller,event):
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onSceneNodeAdded(self,caller,event,node):
+    """Observe new point lists.  They may already hold points (e.g. loaded from file)"""
+    if node and node.IsA('vtkMRMLMarkupsFiducialNode'):
+      self.observePointList(node)
+      self.queuePoints(node)
+    self.requestNodeAddedUpdate()
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onSceneNodeRemoved(self,caller,event,node):
+    """Nothing to reconcile, but the landmark array may change"""
+    if node and node.IsA('vtkMRMLMarkupsFiducialNode'):
+      self.unobservePointList(node.GetID())
+    self.requestNodeAddedUpdate()
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointPositionDefined(self,pointList,event,index):
+    """Queue the newly placed point for reconciliation"""
+    self.queuePoints(pointList, index)
+    self.requestNodeAddedUpdate()
+
+  def queuePoints(self,pointList,index=None):
+    """Remember a point by its control point ID, since indices can
+    shift before the update runs.  Without an index (events collected
+    during a batch modification, single points are added outside of
+    one) all points of the list are queued, once per update.
+    Points placed by the update itself, like the matching points in
+    the other lists, are already reconciled and are not queued."""
+    if self.updatingPoints:
+      return
+    if index is None or index < 0:
+      if pointList.GetID() in self.pendingListIDs:
+        return
+      self.pendingListIDs.add(pointList.GetID())
+      indices = range(pointList.GetNumberOfControlPoints())
+    else:
+      indices = (index,)
+    for pointIndex in indices:
+      self.pendingPoints.append( (pointList, pointList.GetNthControlPointID(pointIndex)) )
+
+  def requestNodeAddedUpdate(self,caller=None,event=None):
     """Start a SingleShot timer that will check the points
     in the scene and turn them into landmarks if needed"""
     if not self.pendingUpdate:
@@ -204,9 +427,12 @@ class LandmarksWidget(pqWidget):
 
   def nodeAddedUpdate(self):
     """Perform the update of any new points.
-    First collect from any point lists not associated with one of our
-    volumes (like when the process first gets started) and then check for
-    new points added to one of our lists.
+    Only the points queued by the scene and point list events are
+    reconciled: points associated with one of our volumes but
+    placed in another list become landmarks, and points placed
+    in one of our lists get a matching point in the other lists.
+    A full pass over every point list (like when the process first
+    gets started) is only done after the volumes change.
     End result should be one point per list with identical names and
     correctly assigned associated node ids.
     Most recently created new point is picked as active landmark.
@@ -215,15 +441,20 @@ class LandmarksWidget(pqWidget):
       return
     slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
     self.updatingPoints = True
-    addedAssociatedLandmark = self.logic.collectAssociatedPoints(self.volumeNodes)
-    addedLandmark = self.logic.landmarksFromPoints(self.volumeNodes)
-    if not addedLandmark:
-      addedLandmark = addedAssociatedLandmark
+    pendingPoints = self.pendingPoints
+    self.pendingPoints = []
+    self.pendingListIDs = set()
+    if self.pendingFullUpdate:
+      self.pendingFullUpdate = False
+      addedAssociatedLandmark = self.logic.collectAssociatedPoints(self.volumeNodes)
+      addedLandmark = self.logic.landmarksFromPoints(self.volumeNodes)
+      if not addedLandmark:
+        addedLandmark = addedAssociatedLandmark
+    else:
+      addedLandmark = self.logic.landmarksFromPlacedPoints(self.volumeNodes, pendingPoints)
     if addedLandmark:
       self.pickLandmark(addedLandmark)
-    self.addLandmarkObservers()
     self.updateLandmarkArray()
     self.pendingUpdate = False
     self.updatingPoints = False
     slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
-
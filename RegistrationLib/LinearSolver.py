@@ -0,0 +1,574 @@
+import math, os
+import numpy
+
+#
+# Closed form landmark fits on (N,3) arrays
+#
+# Each fit returns the 4x4 matrix mapping source points onto target
+# points, following the conventions of vtkLandmarkTransform so that the
+# results can be swapped in for it:
+# - one landmark gives a pure translation
+# - two landmarks (or collinear ones) give the smallest rotation that
+#   aligns the directions of the first two points
+# - the similarity scale is the ratio of the spreads of the two sets,
+#   unless scaleMode is 'leastSquares' (Umeyama's estimate)
+#
+# fitRobust runs RANSAC over minimal subsets to reject outliers.
+#
+# Only numpy is needed, so the fits can be used without Slicer;
+# updateTransformNode writes a result into a MRML transform node.
+#
+
+linearModes = ('Rigid', 'Similarity', 'Affine')
+
+def _asPoints(points):
+  return numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1,3)
+
+def _asWeights(weights, count):
+  if weights is None:
+    return None
+  weights = numpy.asarray(weights, dtype=numpy.float64).reshape(-1)
+  if weights.shape[0] != count:
+    raise ValueError("Expected %d weights, got %d" % (count, weights.shape[0]))
+  if (weights < 0).any() or weights.sum() <= 0:
+    raise ValueError("Weights must be non-negative and not all zero")
+  return weights
+
+def _prepare(source, target, weights):
+  """Return points, weights and centroids of the landmark pairs"""
+  source = _asPoints(source)
+  target = _asPoints(target)
+  count = min(source.shape[0], target.shape[0])
+  source = source[:count]
+  target = target[:count]
+  weights = _asWeights(weights, count)
+  if count == 0:
+    return source, target, weights, numpy.zeros(3), numpy.zeros(3)
+  if weights is None:
+    return source, target, weights, source.mean(axis=0), target.mean(axis=0)
+  return (source, target, weights,
+          numpy.average(source, axis=0, weights=weights),
+          numpy.average(target, axis=0, weights=weights))
+
+def _matrix(linear, translation):
+  matrix = numpy.eye(4)
+  matrix[:3,:3] = linear
+  matrix[:3,3] = translation
+  return matrix
+
+def _perpendicular(vector):
+  """A unit vector perpendicular to the unit vector, as vtkMath::Perpendiculars"""
+  squares = vector * vector
+  if squares[0] > squares[1] and squares[0] > squares[2]:
+    dx,dy,dz = 0,1,2
+  elif squares[1] > squares[2]:
+    dx,dy,dz = 1,2,0
+  else:
+    dx,dy,dz = 2,0,1
+  a,c = vector[dx], vector[dz]
+  length = numpy.sqrt(a*a + c*c)
+  perpendicular = numpy.zeros(3)
+  perpendicular[dx] = c / length
+  perpendicular[dz] = -a / length
+  return perpendicular
+
+def _quaternionToRotation(w, x, y, z):
+  ww, xx, yy, zz = w*w, x*x, y*y, z*z
+  wx, wy, wz = w*x, w*y, w*z
+  xy, xz, yz = x*y, x*z, y*z
+  return numpy.array([
+    [ww + xx - yy - zz, 2.0*(-wz + xy), 2.0*(wy + xz)],
+    [2.0*(wz + xy), ww - xx + yy - zz, 2.0*(-wx + yz)],
+    [2.0*(-wy + xz), 2.0*(wx + yz), ww - xx - yy + zz]])
+
+def _directionRotation(source, target):
+  """Smallest rotation taking the direction of the first two source
+  points to the direction of the first two target points"""
+  sourceDirection = source[1] - source[0]
+  targetDirection = target[1] - target[0]
+  sourceLength = numpy.linalg.norm(sourceDirection)
+  targetLength = numpy.linalg.norm(targetDirection)
+  if sourceLength == 0 or targetLength == 0:
+    # coincident points have no direction to turn
+    return numpy.eye(3)
+  sourceDirection = sourceDirection / sourceLength
+  targetDirection = targetDirection / targetLength
+  w = numpy.dot(sourceDirection, targetDirection)
+  axis = numpy.cross(sourceDirection, targetDirection)
+  r = numpy.linalg.norm(axis)
+  theta = numpy.arctan2(r, w)
+  w = numpy.cos(theta / 2)
+  if r != 0:
+    axis = axis * (numpy.sin(theta / 2) / r)
+  else:
+    # rotation by 180 degrees around a vector perpendicular to the direction
+    axis = _perpendicular(sourceDirection) * numpy.sin(theta / 2)
+  return _quaternionToRotation(w, *axis)
+
+def _spread(centered, weightedCentered):
+  return numpy.vdot(weightedCentered, centered)
+
+def _isDegenerate(source, singularValues):
+  """True when the points do not determine a rotation about their common line"""
+  if source.shape[0] == 2:
+    return True
+  return singularValues[1] <= singularValues[0] * 1e-12
+
+def fitRigid(source, target, weights=None):
+  """Rotation and translation mapping source onto target (Kabsch).
+  source and target are (N,3) arrays of corresponding points,
+  weights an optional (N,) array.  Returns a 4x4 matrix."""
+  return _fitRotation(source, target, weights, scaleMode=None)
+
+def fitSimilarity(source, target, weights=None, scaleMode='vtk'):
+  """Rotation, isotropic scale and translation mapping source onto target.
+  scaleMode 'vtk' uses the ratio of the spreads of the two point sets,
+  as vtkLandmarkTransform does; 'leastSquares' uses the scale minimizing
+  the squared residuals (Umeyama).  Returns a 4x4 matrix."""
+  if scaleMode not in ('vtk', 'leastSquares'):
+    raise ValueError("Unknown scale mode %s" % scaleMode)
+  return _fitRotation(source, target, weights, scaleMode=scaleMode)
+
+def _fitRotation(source, target, weights, scaleMode):
+  source, target, weights, sourceCentroid, targetCentroid = _prepare(source, target, weights)
+  count = source.shape[0]
+  if count == 0:
+    return numpy.eye(4)
+  if count == 1:
+    return _matrix(numpy.eye(3), targetCentroid - sourceCentroid)
+  centeredSource = source - sourceCentroid
+  centeredTarget = target - targetCentroid
+  weightedSource = centeredSource if weights is None else centeredSource * weights[:,numpy.newaxis]
+  sourceSpread = _spread(centeredSource, weightedSource)
+  if weights is None:
+    targetSpread = _spread(centeredTarget, centeredTarget)
+  else:
+    targetSpread = _spread(centeredTarget, centeredTarget * weights[:,numpy.newaxis])
+  covariance = weightedSource.T @ centeredTarget
+  return _rotationFromStatistics(source, target, covariance, sourceSpread, targetSpread,
+                                 sourceCentroid, targetCentroid, scaleMode)
+
+def _rotationFromStatistics(source, target, covariance, sourceSpread, targetSpread,
+                            sourceCentroid, targetCentroid, scaleMode):
+  """Rotation fit from the centered cross covariance and spreads.
+  source and target are only used when the points are degenerate."""
+  u, singularValues, vt = numpy.linalg.svd(covariance)
+  correction = numpy.ones(3)
+  if _isDegenerate(source, singularValues):
+    rotation = _directionRotation(source, target)
+  else:
+    if numpy.linalg.det(u) * numpy.linalg.det(vt) < 0:
+      correction[2] = -1.0
+    rotation = (vt.T * correction) @ u.T
+  scale = 1.0
+  if scaleMode == 'vtk' and sourceSpread > 0:
+    scale = numpy.sqrt(targetSpread / sourceSpread)
+  elif scaleMode == 'leastSquares' and sourceSpread > 0:
+    scale = numpy.dot(singularValues, correction) / sourceSpread
+  linear = scale * rotation
+  return _matrix(linear, targetCentroid - linear @ sourceCentroid)
+
+def fitAffine(source, target, weights=None):
+  """General linear map and translation mapping source onto target in
+  the least squares sense, solved through the 3x3 normal equations.
+  With fewer than four non-coplanar points the minimum norm
+  solution is returned.  Returns a 4x4 matrix."""
+  source, target, weights, sourceCentroid, targetCentroid = _prepare(source, target, weights)
+  count = source.shape[0]
+  if count == 0:
+    return numpy.eye(4)
+  if count == 1:
+    return _matrix(numpy.eye(3), targetCentroid - sourceCentroid)
+  centeredSource = source - sourceCentroid
+  centeredTarget = target - targetCentroid
+  weightedSource = centeredSource if weights is None else centeredSource * weights[:,numpy.newaxis]
+  # solve centeredSource @ linear.T = centeredTarget
+  matrix = _affineFromStatistics(weightedSource.T @ centeredSource, weightedSource.T @ centeredTarget,
+                                 sourceCentroid, targetCentroid)
+  if matrix is None:
+    if weights is not None:
+      rootWeights = numpy.sqrt(weights)[:,numpy.newaxis]
+      centeredSource = centeredSource * rootWeights
+      centeredTarget = centeredTarget * rootWeights
+    linear = numpy.linalg.lstsq(centeredSource, centeredTarget, rcond=None)[0].T
+    matrix = _matrix(linear, targetCentroid - linear @ sourceCentroid)
+  return matrix
+
+def _affineFromStatistics(normal, covariance, sourceCentroid, targetCentroid):
+  """Affine fit from the centered normal matrix and cross covariance,
+  or None when the normal equations are too badly conditioned"""
+  if numpy.linalg.cond(normal) >= 1e12:
+    return None
+  linear = numpy.linalg.solve(normal, covariance).T
+  return _matrix(linear, targetCentroid - linear @ sourceCentroid)
+
+def fitLinear(source, target, mode='Rigid', weights=None, scaleMode='vtk'):
+  """Dispatch to the fit for mode, one of linearModes"""
+  if mode == 'Rigid':
+    return fitRigid(source, target, weights)
+  if mode == 'Similarity':
+    return fitSimilarity(source, target, weights, scaleMode)
+  if mode == 'Affine':
+    return fitAffine(source, target, weights)
+  raise ValueError("Unknown linear mode %s" % mode)
+
+
+class IncrementalLinearFit:
+  """
+  Linear fit that follows single landmark moves in constant time.
+
+  The weighted sums of the points, of their outer products and of the
+  source-target cross products are kept, so moving one landmark only
+  subtracts its old contribution and adds the new one.  The matrix is
+  then recovered from the centered 3x3 statistics with the same
+  formulas as the full fits (one 3x3 SVD or solve).
+
+  The sums are taken relative to the centroids at the last full refit
+  to limit cancellation, and are recomputed from the stored points
+  every refitInterval moves to bound the drift of the running sums.
+  """
+
+  def __init__(self, refitInterval=256):
+    self.refitInterval = refitInterval
+    self.invalidate()
+
+  def invalidate(self):
+    """Drop the points, reset must be called before the next use"""
+    self.source = None
+    self.target = None
+    self.weights = None
+    self.updateCount = 0
+
+  def isValid(self):
+    return self.source is not None
+
+  def __len__(self):
+    return 0 if self.source is None else self.source.shape[0]
+
+  def reset(self, source, target, weights=None):
+    """Start over with (N,3) arrays of corresponding points"""
+    source, target, weights, sourceCentroid, targetCentroid = _prepare(source, target, weights)
+    self.source = numpy.array(source)
+    self.target = numpy.array(target)
+    self.weights = None if weights is None else numpy.array(weights)
+    self.refit()
+
+  def refit(self):
+    """Recompute the sums from the stored points"""
+    count = self.source.shape[0]
+    weights = numpy.ones(count) if self.weights is None else self.weights
+    self.weightSum = weights.sum() if count else 0.0
+    if count:
+      self.sourceOrigin = numpy.average(self.source, axis=0, weights=weights)
+      self.targetOrigin = numpy.average(self.target, axis=0, weights=weights)
+    else:
+      self.sourceOrigin = numpy.zeros(3)
+      self.targetOrigin = numpy.zeros(3)
+    source = self.source - self.sourceOrigin
+    target = self.target - self.targetOrigin
+    weightedSource = source * weights[:,numpy.newaxis]
+    self.sourceSum = weightedSource.sum(axis=0)
+    self.targetSum = (target * weights[:,numpy.newaxis]).sum(axis=0)
+    self.sourceProducts = weightedSource.T @ source
+    self.crossProducts = weightedSource.T @ target
+    self.targetSquares = numpy.vdot(target * weights[:,numpy.newaxis], target)
+    self.updateCount = 0
+
+  def movePoint(self, row, source=None, target=None):
+    """Replace the source and/or target position of landmark row"""
+    weight = 1.0 if self.weights is None else self.weights[row]
+    oldSource = self.source[row] - self.sourceOrigin
+    oldTarget = self.target[row] - self.targetOrigin
+    if source is not None:
+      self.source[row] = source
+    if target is not None:
+      self.target[row] = target
+    newSource = self.source[row] - self.sourceOrigin
+    newTarget = self.target[row] - self.targetOrigin
+    self.sourceSum += weight * (newSource - oldSource)
+    self.targetSum += weight * (newTarget - oldTarget)
+    self.sourceProducts += weight * (numpy.outer(newSource, newSource) - numpy.outer(oldSource, oldSource))
+    self.crossProducts += weight * (numpy.outer(newSource, newTarget) - numpy.outer(oldSource, oldTarget))
+    self.targetSquares += weight * (numpy.dot(newTarget, newTarget) - numpy.dot(oldTarget, oldTarget))
+    self.updateCount += 1
+    if self.updateCount >= self.refitInterval:
+      self.refit()
+
+  def matrix(self, mode='Rigid', scaleMode='vtk'):
+    """The 4x4 fit of the current points, see fitLinear"""
+    count = len(self)
+    if count < 2:
+      return fitLinear(self.source if count else numpy.zeros((0,3)),
+                       self.target if count else numpy.zeros((0,3)), mode)
+    sourceMean = self.sourceSum / self.weightSum
+    targetMean = self.targetSum / self.weightSum
+    sourceCentroid = self.sourceOrigin + sourceMean
+    targetCentroid = self.targetOrigin + targetMean
+    covariance = self.crossProducts - self.weightSum * numpy.outer(sourceMean, targetMean)
+    if mode == 'Affine':
+      normal = self.sourceProducts - self.weightSum * numpy.outer(sourceMean, sourceMean)
+      matrix = _affineFromStatistics(normal, covariance, sourceCentroid, targetCentroid)
+      if matrix is None:
+        matrix = fitAffine(self.source, self.target, self.weights)
+      return matrix
+    if mode not in ('Rigid', 'Similarity'):
+      raise ValueError("Unknown linear mode %s" % mode)
+    if mode == 'Rigid':
+      scaleMode = None
+    sourceSpread = numpy.trace(self.sourceProducts) - self.weightSum * numpy.dot(sourceMean, sourceMean)
+    targetSpread = self.targetSquares - self.weightSum * numpy.dot(targetMean, targetMean)
+    return _rotationFromStatistics(self.source, self.target, covariance, sourceSpread, targetSpread,
+                                   sourceCentroid, targetCentroid, scaleMode)
+
+#
+# Robust fits
+#
+
+minimalSampleSizes = {'Rigid': 3, 'Similarity': 3, 'Affine': 4}
+degreesOfFreedom = {'Rigid': 6, 'Similarity': 7, 'Affine': 12}
+
+# the automatic inlier threshold assumes gaussian landmark errors, so the
+# squared residuals over sigma squared follow a chi square law with 3 degrees
+# of freedom.  sigma is estimated from the lower quartile of the residuals,
+# which tolerates up to 75% outliers, and the threshold keeps 99% of the inliers.
+# The points of the minimal subset itself fit (nearly) exactly, so the
+# order statistic used is always past them.
+_scaleQuantile = 0.25
+_thresholdInSigmas = 3.3682141752187276
+
+def _chiSquare3Quantile(probability):
+  """Inverse of the chi square distribution function with 3 degrees of freedom"""
+  low, high = 0.0, 100.0
+  for iteration in range(60):
+    x = (low + high) / 2
+    if math.erf(math.sqrt(x / 2)) - math.sqrt(2 * x / math.pi) * math.exp(-x / 2) < probability:
+      low = x
+    else:
+      high = x
+  return (low + high) / 2
+
+def _scaleOrder(count, sampleSize):
+  """Index and quantile of the order statistic used to estimate sigma"""
+  k = min(count - 1, max(int(_scaleQuantile * (count - 1)), sampleSize + 1))
+  return k, (k + 0.5 - sampleSize) / (count - sampleSize)
+
+def _automaticThreshold(squared, sampleSize):
+  """Inlier threshold from the (M,) squared residuals of a good hypothesis"""
+  k, quantile = _scaleOrder(squared.shape[0], sampleSize)
+  sigmaSquared = numpy.partition(squared, k)[k] / _chiSquare3Quantile(quantile)
+  return max(_thresholdInSigmas * math.sqrt(sigmaSquared), 1e-9)
+
+_executor = None
+
+def _robustExecutor():
+  """Thread pool shared by the robust fits, created on first use"""
+  global _executor
+  if _executor is None:
+    from concurrent.futures import ThreadPoolExecutor
+    _executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1),
+                                   thread_name_prefix='LinearSolver')
+  return _executor
+
+def _batchFits(source, target, mode, scaleMode):
+  """Fit one transform per sample.  source and target are (B,S,3)
+  arrays of B samples of S points.  Returns (B,3,3) linear parts,
+  (B,3) translations and a (B,) mask of usable samples."""
+  count = source.shape[0]
+  sourceCentroids = source.mean(axis=1)
+  targetCentroids = target.mean(axis=1)
+  centeredSource = source - sourceCentroids[:,numpy.newaxis,:]
+  centeredTarget = target - targetCentroids[:,numpy.newaxis,:]
+  if mode == 'Affine':
+    normal = numpy.einsum('bni,bnj->bij', centeredSource, centeredSource)
+    covariance = numpy.einsum('bni,bnj->bij', centeredSource, centeredTarget)
+    valid = numpy.abs(numpy.linalg.det(normal)) > 1e-9 * numpy.einsum('bii->b', normal) ** 3
+    normal[~valid] = numpy.eye(3)
+    linear = numpy.linalg.solve(normal, covariance).transpose(0,2,1)
+  else:
+    covariance = numpy.einsum('bni,bnj->bij', centeredSource, centeredTarget)
+    u, singularValues, vt = numpy.linalg.svd(covariance)
+    valid = singularValues[:,1] > singularValues[:,0] * 1e-9
+    correction = numpy.ones((count,3))
+    correction[:,2] = numpy.where(numpy.linalg.det(u) * numpy.linalg.det(vt) < 0, -1.0, 1.0)
+    linear = (vt.transpose(0,2,1) * correction[:,numpy.newaxis,:]) @ u.transpose(0,2,1)
+    if mode == 'Similarity':
+      sourceSpread = numpy.einsum('bni,bni->b', centeredSource, centeredSource)
+      targetSpread = numpy.einsum('bni,bni->b', centeredTarget, centeredTarget)
+      valid &= sourceSpread > 0
+      if scaleMode == 'leastSquares':
+        scale = numpy.einsum('bi,bi->b', singularValues, correction) / numpy.where(valid, sourceSpread, 1)
+      else:
+        scale = numpy.sqrt(targetSpread / numpy.where(valid, sourceSpread, 1))
+      linear = linear * scale[:,numpy.newaxis,numpy.newaxis]
+  translations = targetCentroids - numpy.einsum('bij,bj->bi', linear, sourceCentroids)
+  return linear, translations, valid
+
+def _squaredResiduals(linear, translations, source, target):
+  """(B,N) squared distances between the B transformed sources and target"""
+  transformed = numpy.matmul(source, linear.transpose(0,2,1))
+  transformed += (translations[:,numpy.newaxis,:] - target)
+  transformed *= transformed
+  return transformed.sum(axis=2)
+
+def _scoreHypotheses(source, target, samples, mode, scaleMode, scoringSource, scoringTarget):
+  """Fit the hypotheses of one chunk of samples and evaluate them on
+  the scoring points.  Returns the (B,M) squared residuals, the linear
+  parts, the translations and the mask of usable hypotheses."""
+  linear, translations, valid = _batchFits(source[samples], target[samples], mode, scaleMode)
+  squared = _squaredResiduals(linear, translations, scoringSource, scoringTarget)
+  return squared, linear, translations, valid
+
+def fitRobust(source, target, mode='Rigid', threshold=None, confidence=0.99,
+              maxHypotheses=2000, batchSize=128, scoringSize=512, scaleMode='vtk', seed=0, parallel=True):
+  """Fit mode to the landmark pairs while rejecting outliers.
+
+  Hypotheses are fitted to random minimal subsets (3 points, or 4 for
+  Affine) in batches, and every batch is scored with vectorized
+  residuals, split across a thread pool.  Scoring is MSAC (residuals
+  truncated at threshold) so ties in the inlier count are broken by
+  the fit quality.  Sampling stops once the best inlier ratio shows,
+  with the given confidence, that an outlier free subset was drawn.
+  For large landmark sets the hypotheses are scored on a random subset
+  of scoringSize landmarks, so the cost of sampling does not grow with
+  the number of landmarks; only the final refinement visits them all.
+
+  threshold is the largest residual of an inlier in world units.
+  When None it is estimated from the lower quartile of the residuals,
+  first of the best least quantile of squares hypothesis of the first
+  batch and then of the best hypothesis found.  The result is refined
+  by least squares fits on the inliers.  When every subset is degenerate
+  all landmarks are kept and fitted by least squares.
+
+  Returns (matrix, inlierMask) with the 4x4 matrix and an (N,) bool array.
+  """
+  if mode not in minimalSampleSizes:
+    raise ValueError("Unknown linear mode %s" % mode)
+  source, target, weights, sourceCentroid, targetCentroid = _prepare(source, target, None)
+  count = source.shape[0]
+  sampleSize = minimalSampleSizes[mode]
+  if count <= sampleSize:
+    return fitLinear(source, target, mode, scaleMode=scaleMode), numpy.ones(count, dtype=bool)
+
+  random = numpy.random.default_rng(seed)
+  scoringSource, scoringTarget = source, target
+  if scoringSize and count > scoringSize:
+    subset = random.choice(count, scoringSize, replace=False)
+    scoringSource, scoringTarget = source[subset], target[subset]
+  scoringCount = scoringSource.shape[0]
+  chunkCount = 1
+  if parallel and scoringCount * batchSize > 50000:
+    chunkCount = min(_robustExecutor()._max_workers, max(1, batchSize // 32))
+
+  def scoreBatch(samples):
+    if chunkCount == 1 or samples.shape[0] < 2 * chunkCount:
+      return _scoreHypotheses(source, target, samples, mode, scaleMode, scoringSource, scoringTarget)
+    chunks = numpy.array_split(samples, chunkCount)
+    futures = [_robustExecutor().submit(_scoreHypotheses, source, target, chunk, mode, scaleMode,
+                                        scoringSource, scoringTarget)
+               for chunk in chunks]
+    results = [future.result() for future in futures]
+    return tuple(numpy.concatenate(parts) for parts in zip(*results))
+
+  def drawSamples(batch):
+    # sample without replacement within each subset
+    keys = random.random((batch, count)) if count <= 64 else None
+    if keys is not None:
+      return numpy.argpartition(keys, sampleSize, axis=1)[:,:sampleSize]
+    samples = random.integers(0, count, size=(batch, sampleSize))
+    for column in range(1, sampleSize):
+      while True:
+        repeated = (samples[:,column:column+1] == samples[:,:column]).any(axis=1)
+        if not repeated.any():
+          break
+        samples[repeated,column] = random.integers(0, count, size=repeated.sum())
+    return samples
+
+  bestCost = numpy.inf
+  bestLinear = numpy.eye(3)
+  bestTranslation = targetCentroid - sourceCentroid
+  hypothesisCount = 0
+  neededHypotheses = maxHypotheses
+  automaticThreshold = threshold is None
+  batch = min(batchSize, 64 if automaticThreshold else 32)
+  exhaustive = math.comb(count, sampleSize) <= 4 * batchSize
+  if exhaustive:
+    # few landmarks: try every subset in one batch
+    import itertools
+    allSamples = numpy.array(list(itertools.combinations(range(count), sampleSize)))
+    batch = neededHypotheses = allSamples.shape[0]
+  bestQuantile = numpy.inf
+  scaleIndex = _scaleOrder(scoringCount, sampleSize)[0]
+  while hypothesisCount < min(neededHypotheses, maxHypotheses):
+    samples = allSamples if exhaustive else drawSamples(batch)
+    squared, linear, translations, valid = scoreBatch(samples)
+    hypothesisCount += samples.shape[0]
+    if automaticThreshold:
+      # the least quantile of squares hypothesis so far sets the inlier scale
+      quantiles = numpy.partition(squared, scaleIndex, axis=1)[:,scaleIndex]
+      quantiles[~valid] = numpy.inf
+      lowest = numpy.argmin(quantiles)
+      if quantiles[lowest] < bestQuantile:
+        bestQuantile = quantiles[lowest]
+        threshold = _automaticThreshold(squared[lowest], sampleSize)
+        if numpy.isfinite(bestCost):
+          bestCost = numpy.minimum(bestSquared, threshold * threshold).sum()
+      if threshold is None:
+        # no subset so far was in general position to set the scale
+        if exhaustive:
+          break
+        continue
+    costs = numpy.minimum(squared, threshold * threshold).sum(axis=1)
+    costs[~valid] = numpy.inf
+    best = numpy.argmin(costs)
+    if costs[best] < bestCost:
+      bestCost = costs[best]
+      bestLinear = linear[best]
+      bestTranslation = translations[best]
+      bestSquared = squared[best]
+      inlierRatio = numpy.count_nonzero(bestSquared <= threshold * threshold) / scoringCount
+      # hypotheses needed to draw one outlier free subset with the given confidence
+      outlierFreeProbability = inlierRatio ** sampleSize
+      if outlierFreeProbability >= 1:
+        neededHypotheses = 0
+      elif outlierFreeProbability > 0:
+        neededHypotheses = math.log(1 - confidence) / math.log(1 - outlierFreeProbability)
+    if exhaustive:
+      break
+    # grow the batches while many hypotheses are still needed
+    batch = int(min(batchSize, max(batch, neededHypotheses - hypothesisCount)))
+
+  if not numpy.isfinite(bestCost):
+    # every subset was degenerate (e.g. collinear landmarks, or coplanar
+    # ones for Affine), so there is nothing to tell outliers by
+    return fitLinear(source, target, mode, scaleMode=scaleMode), numpy.ones(count, dtype=bool)
+  if automaticThreshold:
+    threshold = _automaticThreshold(bestSquared, sampleSize)
+  matrix = _matrix(bestLinear, bestTranslation)
+  inlierMask = numpy.ones(count, dtype=bool)
+  for refinement in range(5):
+    residuals = transformPoints(matrix, source) - target
+    squared = numpy.einsum('ni,ni->n', residuals, residuals)
+    if automaticThreshold and refinement > 0:
+      # unbiased noise estimate from the least squares fit of the inliers
+      redundancy = 3 * inlierMask.sum() - degreesOfFreedom[mode]
+      if redundancy > 0:
+        sigmaSquared = squared[inlierMask].sum() / redundancy
+        threshold = max(_thresholdInSigmas * math.sqrt(sigmaSquared), 1e-9)
+    newMask = squared <= threshold * threshold
+    if newMask.sum() < sampleSize:
+      break
+    if refinement > 0 and (newMask == inlierMask).all():
+      break
+    inlierMask = newMask
+    matrix = fitLinear(source[inlierMask], target[inlierMask], mode, scaleMode=scaleMode)
+  return matrix, inlierMask
+
+def transformPoints(matrix, points):
+  """Apply a 4x4 matrix to an (N,3) array of points"""
+  points = _asPoints(points)
+  return points @ matrix[:3,:3].T + matrix[:3,3]
+
+def updateTransformNode(transformNode, matrix):
+  """Set matrix as the to-parent transform of transformNode"""
+  import slicer.util
+  slicer.util.updateTransformMatrixFromArray(transformNode, matrix)
@@ -0,0 +1,176 @@
+import vtk, slicer
+
+class PointListAssociation:
+  """
+  Two-way index between volume nodes and their landmark point lists.
+
+  The association is stored in the scene twice so it survives saving,
+  loading and renaming: the volume node references its list with the
+  node reference role below, and the list carries the volume ID in its
+  AssociatedNodeID attribute.  Both directions are cached by node ID
+  and the cache entries are checked with constant time ID lookups.
+
+  Lists from older scenes, that are only related to their volume by
+  the name convention "<volume name>-landmarks", are adopted the first
+  time the volume is queried.  Volumes known to have no list are
+  remembered until a point list is added to the scene, so that the
+  name search is not repeated for every query.
+
+  When an associated volume is renamed, a list still named after the
+  old volume name is renamed to follow it.
+  """
+
+  referenceRole = "LandmarkRegistrationPointList"
+  attributeName = "AssociatedNodeID"
+  listSuffix = "-landmarks"
+
+  def __init__(self):
+    self.listIDByVolumeID = {}
+    self.volumeIDByListID = {}
+    self.volumesWithoutList = set()
+    self.volumeNames = {} # volumeID -> name when the volume was observed
+    self.volumeObserverTags = {} # volumeID -> (volumeNode,tag)
+    self.sceneObserverTags = []
+    self.addSceneObservers()
+
+  def addSceneObservers(self):
+    self.removeSceneObservers()
+    for event,callback in (
+        (slicer.mrmlScene.NodeAddedEvent, self.onNodeAdded),
+        (slicer.mrmlScene.NodeRemovedEvent, self.onNodeRemoved),
+        (slicer.mrmlScene.EndCloseEvent, self.onSceneReset),
+        (slicer.mrmlScene.EndImportEvent, self.onSceneReset),
+        ):
+      tag = slicer.mrmlScene.AddObserver(event, callback)
+      self.sceneObserverTags.append( (slicer.mrmlScene, tag) )
+
+  def removeSceneObservers(self):
+    for obj,tag in self.sceneObserverTags:
+      obj.RemoveObserver(tag)
+    self.sceneObserverTags = []
+
+  def removeObservers(self):
+    """Remove all scene and volume observers"""
+    self.removeSceneObservers()
+    self.clear()
+
+  def clear(self):
+    for volumeNode,tag in self.volumeObserverTags.values():
+      volumeNode.RemoveObserver(tag)
+    self.volumeObserverTags = {}
+    self.volumeNames = {}
+    self.listIDByVolumeID = {}
+    self.volumeIDByListID = {}
+    self.volumesWithoutList = set()
+
+  def listName(self,volumeNode):
+    """The conventional name of the point list of volumeNode"""
+    return volumeNode.GetName() + self.listSuffix
+
+  def associate(self,volumeNode,pointList):
+    """Record pointList as the landmark list of volumeNode, in the scene and in the index"""
+    volumeID = volumeNode.GetID()
+    listID = pointList.GetID()
+    if volumeNode.GetNodeReferenceID(self.referenceRole) != listID:
+      volumeNode.SetNodeReferenceID(self.referenceRole, listID)
+    if pointList.GetAttribute(self.attributeName) != volumeID:
+      pointList.SetAttribute(self.attributeName, volumeID)
+    self.forgetVolume(volumeID)
+    self.forgetList(listID)
+    self.listIDByVolumeID[volumeID] = listID
+    self.volumeIDByListID[listID] = volumeID
+    self.observeVolume(volumeNode)
+
+  def forgetVolume(self,volumeID):
+    listID = self.listIDByVolumeID.pop(volumeID, None)
+    if listID is not None:
+      self.volumeIDByListID.pop(listID, None)
+    self.volumesWithoutList.discard(volumeID)
+    volumeNode,tag = self.volumeObserverTags.pop(volumeID, (None,None))
+    if volumeNode:
+      volumeNode.RemoveObserver(tag)
+    self.volumeNames.pop(volumeID, None)
+
+  def forgetList(self,listID):
+    volumeID = self.volumeIDByListID.pop(listID, None)
+    if volumeID is not None:
+      self.listIDByVolumeID.pop(volumeID, None)
+
+  def observeVolume(self,volumeNode):
+    volumeID = volumeNode.GetID()
+    if volumeID not in self.volumeObserverTags:
+      tag = volumeNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onVolumeModified)
+      self.volumeObserverTags[volumeID] = (volumeNode, tag)
+    self.volumeNames[volumeID] = volumeNode.GetName()
+
+  def pointListForVolume(self,volumeNode,adopt=None):
+    """Return the point list associated with volumeNode, or None.
+    adopt is an optional callable invoked with lists found through the
+    legacy name convention, before they are associated."""
+    if not volumeNode:
+      return None
+    volumeID = volumeNode.GetID()
+    listID = self.listIDByVolumeID.get(volumeID)
+    if listID is not None:
+      pointList = slicer.mrmlScene.GetNodeByID(listID)
+      if pointList:
+        return pointList
+      self.forgetVolume(volumeID)
+    elif volumeID in self.volumesWithoutList:
+      return None
+
+    pointList = volumeNode.GetNodeReference(self.referenceRole)
+    if not pointList:
+      pointList = slicer.mrmlScene.GetFirstNodeByName(self.listName(volumeNode))
+      if pointList and not pointList.IsA("vtkMRMLMarkupsFiducialNode"):
+        pointList = None
+      if pointList and adopt and pointList.GetAttribute(self.attributeName) != volumeID:
+        adopt(pointList)
+    if not pointList:
+      self.volumesWithoutList.add(volumeID)
+      return None
+    self.associate(volumeNode, pointList)
+    return pointList
+
+  def volumeIDForPointList(self,pointList):
+    """Return the ID of the volume pointList belongs to, or None"""
+    if not pointList:
+      return None
+    volumeID = self.volumeIDByListID.get(pointList.GetID())
+    if volumeID is None:
+      volumeID = pointList.GetAttribute(self.attributeName)
+    return volumeID
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAdded(self,caller,event,node):
+    """A new point list may be the list of a volume we know has none"""
+    if node and node.IsA("vtkMRMLMarkupsFiducialNode"):
+      self.volumesWithoutList = set()
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self,caller,event,node):
+    if not node:
+      return
+    nodeID = node.GetID()
+    if nodeID in self.volumeIDByListID:
+      self.forgetList(nodeID)
+    if nodeID in self.listIDByVolumeID or nodeID in self.volumeObserverTags:
+      self.forgetVolume(nodeID)
+    self.volumesWithoutList.discard(nodeID)
+
+  def onSceneReset(self,caller,event):
+    """Node IDs may have been reused or remapped"""
+    self.clear()
+
+  def onVolumeModified(self,volumeNode,event):
+    """Keep the name of the list in step with the volume name"""
+    volumeID = volumeNode.GetID()
+    oldName = self.volumeNames.get(volumeID)
+    newName = volumeNode.GetName()
+    if oldName is None or oldName == newName:
+      return
+    self.volumeNames[volumeID] = newName
+    listID = self.listIDByVolumeID.get(volumeID)
+    pointList = slicer.mrmlScene.GetNodeByID(listID) if listID else None
+    if pointList and pointList.GetName() == oldName + self.listSuffix:
+      pointList.SetName(newName + self.listSuffix)
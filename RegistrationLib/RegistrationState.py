@@ -5,6 +5,11 @@
 class RegistrationState:
   """ Holds parameters of registration.
   An instance of this class is passed to virtual methods
+
+  The module widget keeps one instance and only rebuilds it when
+  the volume or transform selection changes or point lists are
+  created or removed, so plugins may hold on to it (and to the
+  results of the accessors below) for the duration of a drag.
   """
 
   # MRML volume nodes
@@ -20,3 +25,30 @@ class RegistrationState:
   # MRML Linear Transform Node
   transform = None
 
+  # LandmarkRegistrationLogic instance
+  logic = None
+
+  # name of the landmark selected in the landmarks widget
+  currentLandmarkName = None
+
+  def volumeNodes(self):
+    """The (fixed, moving) volume pair used for registration"""
+    return (self.fixed, self.moving)
+
+  def pointLists(self):
+    """The (fixed, moving) point lists matching volumeNodes()"""
+    return (self.fixedPoints, self.movingPoints)
+
+  def landmarks(self):
+    """Landmarks shared by the fixed and moving point lists,
+    keyed by name, as pairs (pointList,index).  Read-only."""
+    return self.logic.landmarkIndex.landmarksForPointLists(self.pointLists())
+
+  def landmarkSet(self):
+    """LandmarkSet of the fixed and moving point lists
+    with positions refreshed from MRML"""
+    return self.logic.landmarkSetForPointLists(self.pointLists())
+
+  def vtkPoints(self):
+    """vtkPoints of the defined landmarks, indexed by volume node"""
+    return self.logic.vtkPointsForVolumes(self.volumeNodes(), self.pointLists())
@@ -0,0 +1,203 @@
+import numpy
+import vtk
+from vtk.util import numpy_support
+from . import LinearSolver
+from .ThinPlateSpline import ThinPlateSpline
+
+#
+# Per-landmark fit errors of a registration
+#
+# The moving landmarks are mapped through the registration transform in
+# one call and compared with the fixed landmarks.  For linear and thin
+# plate spline fits the leave-one-out error of every landmark (its error
+# when the transform is fitted to the other landmarks only) is also
+# computed in one batch, which estimates the target registration error
+# away from the landmarks.
+#
+
+leaveOneOutMethods = LinearSolver.linearModes + ('ThinPlate',)
+
+def mapPoints(transform, points):
+  """Map an (N,3) array of points through transform in one call.
+  transform is a MRML transform node (its transform to parent is used)
+  or a vtkAbstractTransform."""
+  points = numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1,3)
+  if points.shape[0] == 0:
+    return points.copy()
+  if transform.IsA('vtkMRMLTransformNode'):
+    if transform.IsLinear():
+      matrix = vtk.vtkMatrix4x4()
+      transform.GetMatrixTransformToParent(matrix)
+      return LinearSolver.transformPoints(_arrayFromMatrix(matrix), points)
+    transform = transform.GetTransformToParent()
+  elif transform.IsA('vtkLinearTransform'):
+    return LinearSolver.transformPoints(_arrayFromMatrix(transform.GetMatrix()), points)
+  inputPoints = vtk.vtkPoints()
+  inputPoints.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+  outputPoints = vtk.vtkPoints()
+  outputPoints.SetDataTypeToDouble()
+  transform.TransformPoints(inputPoints, outputPoints)
+  return numpy.array(numpy_support.vtk_to_numpy(outputPoints.GetData()), dtype=numpy.float64).reshape(-1,3)
+
+def _arrayFromMatrix(matrix):
+  return numpy.array([[matrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+def leaveOneOutResiduals(source, target, method='Rigid', scaleMode='vtk'):
+  """Residual of every landmark under the fit of all the others.
+
+  source and target are (N,3) arrays of corresponding points and
+  method one of leaveOneOutMethods.  For ThinPlate the residuals
+  come from the inverse of the bordered kernel system, see
+  ThinPlateSpline.leaveOneOutResiduals.  For Affine they come from
+  the hat matrix, e_i / (1 - h_ii).
+  For Rigid and Similarity the centered statistics of the full fit
+  are downdated by each landmark in turn and the N rotations are
+  solved as one stacked 3x3 SVD.  Landmarks whose removal leaves
+  too few points, or degenerate ones, get nan.
+
+  Returns an (N,3) array of transformed source minus target.
+  """
+  if method not in leaveOneOutMethods:
+    raise ValueError("Unknown method %s" % method)
+  source = numpy.ascontiguousarray(source, dtype=numpy.float64).reshape(-1,3)
+  target = numpy.ascontiguousarray(target, dtype=numpy.float64).reshape(-1,3)
+  count = source.shape[0]
+  residuals = numpy.full((count,3), numpy.nan)
+  if method == 'ThinPlate':
+    try:
+      return ThinPlateSpline(source, target).leaveOneOutResiduals()
+    except numpy.linalg.LinAlgError:
+      return residuals
+  mode = method
+  if count - 1 < LinearSolver.minimalSampleSizes[mode]:
+    return residuals
+  sourceCentroid = source.mean(axis=0)
+  targetCentroid = target.mean(axis=0)
+  centeredSource = source - sourceCentroid
+  centeredTarget = target - targetCentroid
+  downdate = count / (count - 1.0)
+
+  if mode == 'Affine':
+    normal = centeredSource.T @ centeredSource
+    if numpy.linalg.cond(normal) >= 1e12:
+      return residuals
+    linear = numpy.linalg.solve(normal, centeredSource.T @ centeredTarget)
+    fitted = centeredSource @ linear - centeredTarget
+    leverage = 1.0 / count + numpy.einsum('ni,ni->n', centeredSource @ numpy.linalg.inv(normal), centeredSource)
+    usable = leverage < 1 - 1e-9
+    residuals[usable] = fitted[usable] / (1 - leverage[usable])[:,numpy.newaxis]
+    return residuals
+
+  # statistics of the other landmarks, relative to their own centroids
+  covariance = (centeredSource.T @ centeredTarget)[numpy.newaxis] - \
+      downdate * centeredSource[:,:,numpy.newaxis] * centeredTarget[:,numpy.newaxis,:]
+  sourceCentroids = sourceCentroid - centeredSource / (count - 1)
+  targetCentroids = targetCentroid - centeredTarget / (count - 1)
+  u, singularValues, vt = numpy.linalg.svd(covariance)
+  usable = singularValues[:,1] > singularValues[:,0] * 1e-12
+  correction = numpy.ones((count,3))
+  correction[:,2] = numpy.where(numpy.linalg.det(u) * numpy.linalg.det(vt) < 0, -1.0, 1.0)
+  linear = (vt.transpose(0,2,1) * correction[:,numpy.newaxis,:]) @ u.transpose(0,2,1)
+  if mode == 'Similarity':
+    sourceSquares = numpy.einsum('ni,ni->n', centeredSource, centeredSource)
+    sourceSpread = sourceSquares.sum() - downdate * sourceSquares
+    usable &= sourceSpread > 0
+    sourceSpread = numpy.where(usable, sourceSpread, 1)
+    if scaleMode == 'leastSquares':
+      scale = numpy.einsum('ni,ni->n', singularValues, correction) / sourceSpread
+    else:
+      targetSquares = numpy.einsum('ni,ni->n', centeredTarget, centeredTarget)
+      targetSpread = targetSquares.sum() - downdate * targetSquares
+      scale = numpy.sqrt(numpy.maximum(targetSpread, 0) / sourceSpread)
+    linear = linear * scale[:,numpy.newaxis,numpy.newaxis]
+  mapped = numpy.einsum('nij,nj->ni', linear, source - sourceCentroids) + targetCentroids
+  residuals[usable] = (mapped - target)[usable]
+  return residuals
+
+
+class ResidualReport:
+  """
+  Per-landmark errors of a registration, in world units.
+
+  names                - landmark names, one per row
+  residuals            - (N,3) transformed moving minus fixed position
+  errors               - (N,) residual lengths
+  rms                  - root mean square of errors
+  leaveOneOutErrors    - (N,) leave-one-out error lengths, or None when
+                         the registration provides no estimate
+  leaveOneOutRMS       - root mean square of the finite leave-one-out errors
+
+  Rows without a defined position have nan errors and do not count
+  towards the root mean squares.
+  """
+
+  __slots__ = ('names', 'residuals', 'errors', 'rms', 'leaveOneOutErrors', 'leaveOneOutRMS', '_rowsByName')
+
+  def __init__(self, names=(), residuals=None, leaveOneOutResiduals=None):
+    self.names = list(names)
+    if residuals is None:
+      residuals = numpy.full((len(self.names),3), numpy.nan)
+    self.residuals = numpy.asarray(residuals, dtype=numpy.float64).reshape(-1,3)
+    self.errors = numpy.sqrt(numpy.einsum('ni,ni->n', self.residuals, self.residuals))
+    self.rms = _rms(self.errors)
+    self.leaveOneOutErrors = None
+    self.leaveOneOutRMS = numpy.nan
+    if leaveOneOutResiduals is not None:
+      leaveOneOutResiduals = numpy.asarray(leaveOneOutResiduals, dtype=numpy.float64).reshape(-1,3)
+      self.leaveOneOutErrors = numpy.sqrt(numpy.einsum('ni,ni->n', leaveOneOutResiduals, leaveOneOutResiduals))
+      self.leaveOneOutRMS = _rms(self.leaveOneOutErrors)
+    self._rowsByName = None
+
+  def __len__(self):
+    return len(self.names)
+
+  def errorsForName(self, name):
+    """Return (error, leaveOneOutError) of the named landmark.
+    Missing values are nan."""
+    if self._rowsByName is None:
+      self._rowsByName = {name: row for row,name in enumerate(self.names)}
+    row = self._rowsByName.get(name)
+    if row is None:
+      return numpy.nan, numpy.nan
+    if self.leaveOneOutErrors is None:
+      return self.errors[row], numpy.nan
+    return self.errors[row], self.leaveOneOutErrors[row]
+
+def _rms(errors):
+  errors = errors[numpy.isfinite(errors)]
+  if errors.shape[0] == 0:
+    return numpy.nan
+  return numpy.sqrt(numpy.mean(errors * errors))
+
+def computeResiduals(landmarkSet, transform, method=None, fitMask=None,
+                     fixedColumn=0, movingColumn=1, scaleMode='vtk', leaveOneOut=None):
+  """Build the ResidualReport of transform for the landmarks of landmarkSet.
+
+  The moving column is mapped through transform (see mapPoints) and
+  compared with the fixed column.  When method (one of
+  leaveOneOutMethods) is given the transform is taken to be that fit
+  of the landmarks and the leave-one-out errors are computed as well.  fitMask tells
+  which rows the fit used (e.g. the inliers of a robust fit); the
+  other rows were left out already, so their residual is their
+  leave-one-out residual.  Callers that already have the leave-one-out
+  residuals of the defined rows can pass them as leaveOneOut instead.
+  """
+  definedMask = landmarkSet.definedMask()
+  moving = landmarkSet.column(movingColumn, definedOnly=True)
+  fixed = landmarkSet.column(fixedColumn, definedOnly=True)
+  residuals = numpy.full((len(landmarkSet),3), numpy.nan)
+  residuals[definedMask] = mapPoints(transform, moving) - fixed
+
+  if leaveOneOut is not None:
+    definedLeaveOneOut = leaveOneOut
+    leaveOneOut = numpy.full((len(landmarkSet),3), numpy.nan)
+    leaveOneOut[definedMask] = definedLeaveOneOut
+  elif method is not None:
+    fitted = numpy.ones(moving.shape[0], dtype=bool)
+    if fitMask is not None:
+      fitted = numpy.asarray(fitMask, dtype=bool)[definedMask]
+    definedLeaveOneOut = residuals[definedMask]
+    definedLeaveOneOut[fitted] = leaveOneOutResiduals(moving[fitted], fixed[fitted], method, scaleMode)
+    leaveOneOut = numpy.full((len(landmarkSet),3), numpy.nan)
+    leaveOneOut[definedMask] = definedLeaveOneOut
+  return ResidualReport(landmarkSet.names, residuals, leaveOneOut)
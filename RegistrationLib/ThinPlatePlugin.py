@@ -1,5 +1,10 @@
+import numpy
 import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 from . import RegistrationPlugin
+from . import GridExport
+from .Residuals import mapPoints
+from .ThinPlateSpline import ThinPlateSpline, ThinPlateSmoothing
 
 
 #########################################################
@@ -47,10 +52,36 @@ class ThinPlatePlugin(RegistrationPlugin):
   # used for reloading - every concrete class should include this
   sourceFile = __file__
 
+  # grid samples along the longest side of the moving volume
+  # for the preview shown while a landmark is dragged
+  previewGridSamples = 24
+
+  # a dragged landmark only refreshes the preview within the distance
+  # of its previewNeighbors-th nearest landmark, which hold the warp
+  # in place beyond; the rest of the grid is refreshed once the drag
+  # pauses for previewRefreshDelay milliseconds
+  previewNeighbors = 3
+  previewRefreshDelay = 150
+
+  # the smoothing slider is off at 0, then spreads the
+  # regularizations of smoothingRange logarithmically
+  smoothingSteps = 140
+  smoothingRange = (1e-2, 1e5)
+
   def __init__(self,parent=None):
     super().__init__(parent)
 
     self.thinPlateTransform = None
+    self.previewTransform = None
+    self.previewPoints = None # (G,3) positions of the preview grid points
+    self.previewStale = None # grid points not yet sampled from the current spline
+    self.previewMapPoints = None
+    self.previewRefreshTimer = None
+    self.thinPlateSpline = ThinPlateSpline()
+    self.thinPlateSplineKey = None
+    self.thinPlateSplineRows = {} # landmark name -> row in thinPlateSpline
+    self.thinPlateSplineMovedRow = None # row updated in place by the last update, if any
+    self.thinPlateSmoothing = None # ThinPlateSmoothing of the current landmarks
 
   def create(self,registrationState):
     """Make the plugin-specific user interface"""
@@ -65,9 +96,43 @@ class ThinPlatePlugin(RegistrationPlugin):
     self.widgets.append(thinPlateCollapsibleButton)
 
     self.hotUpdateButton = qt.QCheckBox("Hot Update")
+    self.hotUpdateButton.setToolTip( "Follow a dragged landmark with a coarse preview of the warp, refined to the exact spline when the landmark is released." )
     thinPlateFormLayout.addWidget(self.hotUpdateButton)
     self.widgets.append(self.hotUpdateButton)
 
+    self.previewRefreshTimer = qt.QTimer()
+    self.previewRefreshTimer.singleShot = True
+    self.previewRefreshTimer.connect('timeout()', self.refreshPreviewTransform)
+
+    smoothingLayout = qt.QHBoxLayout()
+    self.smoothingSlider = qt.QSlider(qt.Qt.Horizontal)
+    self.smoothingSlider.minimum = 0
+    self.smoothingSlider.maximum = self.smoothingSteps
+    self.smoothingSlider.setToolTip( "Regularization of the spline.  Off interpolates the landmarks exactly, larger values follow them less closely and bend less, up to an affine transform." )
+    self.smoothingSlider.connect('valueChanged(int)', self.onSmoothingChanged)
+    self.smoothingSlider.connect('sliderReleased()', self.onThinPlateApply)
+    smoothingLayout.addWidget(self.smoothingSlider)
+    self.widgets.append(self.smoothingSlider)
+    self.smoothingLabel = qt.QLabel("Off")
+    smoothingLayout.addWidget(self.smoothingLabel)
+    self.widgets.append(self.smoothingLabel)
+    optimizeSmoothingButton = qt.QPushButton("Cross Validate")
+    optimizeSmoothingButton.setToolTip( "Set the smoothing with the lowest generalized cross validation error of the landmarks." )
+    optimizeSmoothingButton.connect('clicked()', self.onOptimizeSmoothing)
+    smoothingLayout.addWidget(optimizeSmoothingButton)
+    self.widgets.append(optimizeSmoothingButton)
+    thinPlateFormLayout.addRow("Smoothing ", smoothingLayout)
+
+    self.gridSpacingSpinBox = qt.QDoubleSpinBox()
+    self.gridSpacingSpinBox.minimum = 0
+    self.gridSpacingSpinBox.maximum = 100
+    self.gridSpacingSpinBox.decimals = 2
+    self.gridSpacingSpinBox.suffix = " mm"
+    self.gridSpacingSpinBox.specialValueText = "Automatic"
+    self.gridSpacingSpinBox.setToolTip( "Spacing of the exported grid, down to the voxel spacing of the fixed volume.  Automatic uses five times the largest voxel spacing." )
+    self.widgets.append(self.gridSpacingSpinBox)
+    thinPlateFormLayout.addRow("Grid spacing ", self.gridSpacingSpinBox)
+
     exportGridButton = qt.QPushButton("Export to Grid Transform")
     exportGridButton.toolTip = "To save this transform or use it in other Slicer modules you can export the current Thin Plate transform to a Grid Transform."
     thinPlateFormLayout.addWidget(exportGridButton)
@@ -78,49 +143,135 @@ class ThinPlatePlugin(RegistrationPlugin):
 
   def destroy(self):
     """Clean up"""
+    if self.previewRefreshTimer:
+      self.previewRefreshTimer.stop()
+    self.registrationState().logic.setLandmarkResiduals(None)
     super().destroy()
 
   def onExportGrid(self):
     """Converts the current thin plate transform to a grid"""
     state = self.registrationState()
-
-    # since the transform is ras-to-ras, we find the extreme points
-    # in ras space of the fixed (target) volume and fix the unoriented
-    # box around it.  Sample the grid transform at the resolution of
-    # the fixed volume, which may be a bit overkill but it should aways
-    # work without too much loss.
-    rasBounds = [0,]*6
-    state.fixed.GetRASBounds(rasBounds)
-    from math import floor, ceil
-    origin = list(map(int,map(floor,rasBounds[::2])))
-    maxes = list(map(int,map(ceil,rasBounds[1::2])))
-    boundSize = [m - o for m,o in zip(maxes,origin) ]
-    spacing = state.fixed.GetSpacing()
-    spacing = [max(spacing)*5]*3
-    samples = [ceil(int(b / s)) for b,s in zip(boundSize,spacing)]
-    extent = [0,]*6
-    extent[::2] = [0,]*3
-    extent[1::2] = samples
-    extent = list(map(int,extent))
-
-    toGrid = vtk.vtkTransformToGrid()
-    toGrid.SetGridOrigin(origin)
-    toGrid.SetGridSpacing(spacing)
-    toGrid.SetGridExtent(extent)
-    toGrid.SetInput(state.transform.GetTransformFromParent())
-    toGrid.Update()
-
-    gridTransform = slicer.vtkOrientedGridTransform()
-    gridTransform.SetDisplacementGridData(toGrid.GetOutput())
+    if not state.fixed or not state.transform:
+      return
+
+    # the grid stores the transform from parent, which maps the fixed
+    # volume into the moving one for resampling, so it is laid out on
+    # the axes of the fixed volume and covers it.  Sampling at the voxel
+    # spacing of the fixed volume always works, at a memory cost.
+    origin, spacing, dimensions, directions = GridExport.volumeGridGeometry(state.fixed, self.gridSpacingSpinBox.value)
+
+    if self.updateThinPlateSpline(state):
+      inverse = self.thinPlateSpline.inverseTransformPoints
+      workers = None
+    else:
+      # too few landmarks for the spline, let vtk handle them
+      fromParent = state.transform.GetTransformFromParent()
+      inverse = lambda points: mapPoints(fromParent, points)
+      workers = 1
+
+    progressDialog = slicer.util.createProgressDialog(labelText="Sampling the grid transform", maximum=100)
+    def progress(fraction):
+      progressDialog.value = int(100 * fraction)
+      slicer.app.processEvents()
+      return progressDialog.wasCanceled
+    try:
+      displacements = GridExport.sampleDisplacements(inverse, origin, spacing, dimensions, directions,
+                                                     workers=workers, progress=progress)
+    finally:
+      progressDialog.close()
+    if displacements is None:
+      return
+
+    gridTransform = GridExport.gridTransform(displacements, origin, spacing, directions)
     gridNode = slicer.vtkMRMLGridTransformNode()
     gridNode.SetAndObserveTransformFromParent(gridTransform)
     gridNode.SetName(state.transform.GetName()+"-grid")
     slicer.mrmlScene.AddNode(gridNode)
+    return gridNode
+
+  def regularization(self):
+    """Regularization selected with the smoothing slider"""
+    value = self.smoothingSlider.value
+    if value == 0:
+      return 0.0
+    smallest, largest = numpy.log10(self.smoothingRange)
+    return float(10 ** (smallest + (value - 1) * (largest - smallest) / (self.smoothingSteps - 1)))
+
+  def smoothingSliderValue(self,regularization):
+    """Slider position closest to regularization"""
+    if regularization <= 0:
+      return 0
+    smallest, largest = numpy.log10(self.smoothingRange)
+    step = (numpy.log10(regularization) - smallest) / (largest - smallest) * (self.smoothingSteps - 1)
+    return int(numpy.clip(numpy.round(step), 0, self.smoothingSteps - 1)) + 1
+
+  def onSmoothingChanged(self,value):
+    """While the slider is dragged the spline is swept from the cached
+    ThinPlateSmoothing and previewed on a grid; the exact vtk spline is
+    computed when it is released."""
+    regularization = self.regularization()
+    self.smoothingLabel.text = "%.3g" % regularization if regularization > 0 else "Off"
+    if not self.smoothingSlider.sliderDown:
+      self.onThinPlateApply()
+      return
+    state = self.registrationState()
+    if not (state.fixed and state.moving and state.transformed):
+      return
+    smoothing = self.currentThinPlateSmoothing(state)
+    if smoothing is None:
+      return
+    try:
+      leaveOneOut = smoothing.leaveOneOutResiduals(regularization)
+    except numpy.linalg.LinAlgError:
+      return
+    self.updatePreviewTransform(state, lambda points: smoothing.transformPoints(points, regularization))
+    state.logic.updateLandmarkResiduals(state, leaveOneOut=leaveOneOut)
+
+  def onOptimizeSmoothing(self):
+    """Move the smoothing slider to the generalized cross validation optimum"""
+    state = self.registrationState()
+    smoothing = self.currentThinPlateSmoothing(state)
+    if smoothing is None:
+      return
+    self.smoothingSlider.value = self.smoothingSliderValue(smoothing.optimalRegularization())
+
+  def currentThinPlateSmoothing(self,state):
+    """ThinPlateSmoothing of the current landmarks, diagonalized once
+    until they change.  None if there are too few landmarks."""
+    if self.thinPlateSmoothing is None:
+      if not state.fixedPoints or not state.movingPoints:
+        return None
+      landmarkSet = state.landmarkSet()
+      try:
+        self.thinPlateSmoothing = ThinPlateSmoothing(landmarkSet.column(1, definedOnly=True),
+                                                     landmarkSet.column(0, definedOnly=True))
+      except numpy.linalg.LinAlgError:
+        return None
+    return self.thinPlateSmoothing
 
   def onLandmarkMoved(self,state):
-    """Called when the user changes a landmark"""
+    """Called when the user changes a landmark.
+    With hot update the cached spline follows the dragged landmark
+    in O(N^2) and is shown through a coarse grid transform, resampled
+    around the landmark only; the exact vtk spline is computed once
+    the drag ends."""
     if self.hotUpdateButton.checked:
-      self.onThinPlateApply()
+      if not (state.fixed and state.moving and state.transformed):
+        return
+      row = self.thinPlateSplineRows.get(state.currentLandmarkName)
+      previousSource = None
+      if row is not None and row < len(self.thinPlateSpline):
+        previousSource = self.thinPlateSpline.source[row].copy()
+      if self.updateThinPlateSpline(state, movedLandmarkName=state.currentLandmarkName):
+        centers = None
+        if self.thinPlateSplineMovedRow is not None and previousSource is not None:
+          # the grid is in moving space, where the spline changes around
+          # the old and new positions of the moving landmark
+          centers = numpy.array((previousSource, self.thinPlateSpline.source[row]))
+        self.updatePreviewTransform(state, centers=centers)
+        state.logic.updateLandmarkResiduals(state, leaveOneOut=self.thinPlateSpline.leaveOneOutResiduals())
+      else:
+        self.onThinPlateApply()
 
   def onLandmarkEndMoving(self,state):
     """Called when the user changes a landmark"""
@@ -131,29 +282,162 @@ class ThinPlatePlugin(RegistrationPlugin):
     state = self.registrationState()
 
     if state.fixed and state.moving and state.transformed:
-      landmarks = state.logic.landmarksForVolumes((state.fixed, state.moving))
-      self.performThinPlateRegistration(state, landmarks)
+      self.performThinPlateRegistration(state)
 
-  def performThinPlateRegistration(self, state, landmarks):
+  def performThinPlateRegistration(self, state):
     """Perform the thin plate transform using the vtkThinPlateSplineTransform class"""
-
-    volumeNodes = (state.fixed, state.moving)
-    pointListNodes = (state.fixedPoints,state.movingPoints)
-    points = state.logic.vtkPointsForVolumes( volumeNodes, pointListNodes )
+    if self.previewRefreshTimer:
+      self.previewRefreshTimer.stop()
+
+    splineValid = self.updateThinPlateSpline(state)
+    if splineValid and self.thinPlateSpline.regularization > 0:
+      # the smoothing spline is the interpolating spline through the smoothed targets
+      sourcePoints = vtk.vtkPoints()
+      sourcePoints.SetData(numpy_support.numpy_to_vtk(self.thinPlateSpline.source, deep=True))
+      targetPoints = vtk.vtkPoints()
+      targetPoints.SetData(numpy_support.numpy_to_vtk(self.thinPlateSpline.fittedTargets(), deep=True))
+    else:
+      points = state.vtkPoints()
+      sourcePoints, targetPoints = points[state.moving], points[state.fixed]
 
     # since this is a resample transform, source is the fixed (resampling target) space
     # and moving is the target space
     if not self.thinPlateTransform:
       self.thinPlateTransform = vtk.vtkThinPlateSplineTransform()
     self.thinPlateTransform.SetBasisToR() # for 3D transform
-    self.thinPlateTransform.SetSourceLandmarks(points[state.moving])
-    self.thinPlateTransform.SetTargetLandmarks(points[state.fixed])
+    self.thinPlateTransform.SetSourceLandmarks(sourcePoints)
+    self.thinPlateTransform.SetTargetLandmarks(targetPoints)
     self.thinPlateTransform.Update()
 
-    if points[state.moving].GetNumberOfPoints() != points[state.fixed].GetNumberOfPoints():
-      raise hell
-
     state.transform.SetAndObserveTransformToParent(self.thinPlateTransform)
+    if splineValid:
+      state.logic.updateLandmarkResiduals(state, leaveOneOut=self.thinPlateSpline.leaveOneOutResiduals())
+    else:
+      state.logic.updateLandmarkResiduals(state)
+
+  def updateThinPlateSpline(self,state,movedLandmarkName=None):
+    """Bring the cached spline up to date with the landmarks.
+    With movedLandmarkName only that landmark is read back and the
+    cached system is updated, as long as it is still valid for the
+    current landmarks; otherwise the spline is fitted again.
+    Returns False when the landmarks do not define a spline."""
+    if not state.fixedPoints or not state.movingPoints:
+      return False
+    # the smoothing sweep is for the landmarks as they were
+    self.thinPlateSmoothing = None
+    regularization = self.regularization()
+    fitKey = (state.fixedPoints.GetID(), state.movingPoints.GetID(), state.logic.landmarkIndex.generation)
+    row = self.thinPlateSplineRows.get(movedLandmarkName)
+    landmark = state.landmarks().get(movedLandmarkName) if row is not None else None
+    try:
+      if self.thinPlateSpline.isValid() and fitKey == self.thinPlateSplineKey and landmark is not None \
+          and self.thinPlateSpline.regularization == regularization:
+        (fixedList,fixedIndex),(movingList,movingIndex) = landmark
+        fixedPosition = [0,]*3
+        movingPosition = [0,]*3
+        fixedList.GetNthControlPointPosition(fixedIndex, fixedPosition)
+        movingList.GetNthControlPointPosition(movingIndex, movingPosition)
+        self.thinPlateSpline.moveLandmark(row, source=movingPosition, target=fixedPosition)
+        self.thinPlateSplineMovedRow = row
+      else:
+        self.thinPlateSplineMovedRow = None
+        landmarkSet = state.landmarkSet()
+        definedMask = landmarkSet.definedMask()
+        definedNames = [name for name,defined in zip(landmarkSet.names, definedMask) if defined]
+        self.thinPlateSplineRows = {name: row for row,name in enumerate(definedNames)}
+        self.thinPlateSplineKey = fitKey
+        self.thinPlateSpline.regularization = regularization
+        # like the vtk spline, map the moving (source) landmarks onto the fixed (target) ones
+        self.thinPlateSpline.fit(landmarkSet.column(1, definedOnly=True),
+                                 landmarkSet.column(0, definedOnly=True))
+    except numpy.linalg.LinAlgError:
+      self.thinPlateSpline.invalidate()
+      self.thinPlateSplineMovedRow = None
+      return False
+    return True
+
+  def updatePreviewTransform(self,state,mapPoints=None,centers=None):
+    """Sample the cached spline (or the mapPoints function of (M,3)
+    arrays) on a coarse grid over the moving volume and show it as the
+    transform to parent, interpolated trilinearly.  The grid is reused
+    between updates.  With the (C,3) centers of a change of the spline,
+    only the grid points near them are sampled now and the others when
+    the updates pause, see refreshPreviewTransform."""
+    if mapPoints is None:
+      mapPoints = self.thinPlateSpline.transformPoints
+    self.previewMapPoints = mapPoints
+    rasBounds = [0,]*6
+    state.moving.GetRASBounds(rasBounds)
+    lower = numpy.array(rasBounds[::2])
+    upper = numpy.array(rasBounds[1::2])
+    spacing = max((upper - lower).max() / (self.previewGridSamples - 1), 1e-3)
+    # one sample of margin around the volume
+    origin = lower - spacing
+    dimensions = [int(numpy.ceil(size / spacing)) + 3 for size in upper - lower]
+
+    grid = self.previewTransform.GetDisplacementGrid() if self.previewTransform else None
+    if grid is None or list(grid.GetDimensions()) != dimensions \
+        or not numpy.allclose(grid.GetOrigin(), origin) or grid.GetSpacing()[0] != spacing:
+      grid = vtk.vtkImageData()
+      grid.SetOrigin(*origin)
+      grid.SetSpacing(spacing, spacing, spacing)
+      grid.SetDimensions(*dimensions)
+      grid.AllocateScalars(vtk.VTK_DOUBLE, 3)
+      self.previewTransform = slicer.vtkOrientedGridTransform()
+      self.previewTransform.SetInterpolationModeToLinear()
+      self.previewTransform.SetDisplacementGridData(grid)
+      self.previewPoints = GridExport.gridPoints(origin, [spacing,]*3, dimensions, numpy.eye(3),
+                                                 0, dimensions[0] * dimensions[1] * dimensions[2])
+      centers = None
+
+    if centers is None:
+      update = numpy.ones(self.previewPoints.shape[0], dtype=bool)
+    else:
+      radius = max(self.previewRadius(centers), 2 * spacing)
+      update = numpy.zeros(self.previewPoints.shape[0], dtype=bool)
+      for center in centers:
+        offsets = self.previewPoints - center
+        update |= numpy.einsum('ni,ni->n', offsets, offsets) < radius * radius
+    self.previewStale = ~update
+    self.samplePreviewPoints(update)
+    if state.transform.GetTransformToParent() != self.previewTransform:
+      state.transform.SetAndObserveTransformToParent(self.previewTransform)
+    if self.previewStale.any() and self.previewRefreshTimer:
+      # restarted by every update, so it only fires when they pause
+      self.previewRefreshTimer.start(self.previewRefreshDelay)
+
+  def previewRadius(self,centers):
+    """Distance from the (C,3) centers within which a moved landmark
+    changes the spline noticeably: that of its previewNeighbors-th
+    nearest other landmark, infinite with too few landmarks"""
+    source = self.thinPlateSpline.source
+    if source.shape[0] <= self.previewNeighbors + 1:
+      return numpy.inf
+    distances = numpy.linalg.norm(source[numpy.newaxis] - centers[:,numpy.newaxis], axis=2)
+    # the nearest one is the landmark itself
+    return numpy.partition(distances, self.previewNeighbors, axis=1)[:,self.previewNeighbors].max()
+
+  def samplePreviewPoints(self,mask):
+    """Sample the preview map at the grid points in mask"""
+    grid = self.previewTransform.GetDisplacementGrid()
+    displacements = numpy_support.vtk_to_numpy(grid.GetPointData().GetScalars()).reshape(-1,3)
+    points = self.previewPoints[mask]
+    displacements[mask] = self.previewMapPoints(points) - points
+    grid.Modified()
+    self.previewTransform.Modified()
+
+  def refreshPreviewTransform(self):
+    """Sample the grid points left stale by the updates of a drag"""
+    if self.previewTransform is None or self.previewStale is None or not self.previewStale.any():
+      return
+    state = self.registrationState()
+    if state.transform.GetTransformToParent() != self.previewTransform:
+      # the exact spline has replaced the preview
+      return
+    self.samplePreviewPoints(self.previewStale)
+    self.previewStale[...] = False
+    if self.thinPlateSpline.isValid():
+      state.logic.updateLandmarkResiduals(state, leaveOneOut=self.thinPlateSpline.leaveOneOutResiduals())
 
 
 # Add this plugin to the dictionary of available registrations.
@@ -0,0 +1,373 @@
+import numpy
+
+#
+# Thin plate spline on (N,3) landmark arrays
+#
+# Same interpolant as vtkThinPlateSplineTransform with SetBasisToR:
+#
+#   f(x) = A x + b + sum_i w_i U(|x - p_i|),  U(r) = r
+#
+# with the coefficients solved from the bordered kernel system
+#
+#   [ K   P ] [ W ]   [ Q ]
+#   [ P^T 0 ] [ A ] = [ 0 ]
+#
+# where K_ij = U(|p_i - p_j|) and the rows of P are (1, p_i).
+# The inverse of the system is kept, so leave-one-out residuals of all
+# landmarks come from it in closed form (Rippa's formula), and moving
+# one landmark updates it in O(N^2) instead of solving again in O(N^3).
+#
+# With a regularization lam > 0 the kernel block becomes K - lam I and
+# the spline approximates the targets instead of interpolating them,
+# trading landmark error for less bending.  ThinPlateSmoothing
+# diagonalizes the system once so that lam can be swept in O(N^2) per
+# value, and picks it by generalized cross validation.
+#
+# Only numpy is needed, so the spline can be used without Slicer.
+#
+
+def _asPoints(points):
+  return numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1,3)
+
+def thinPlateKernel(points, centers):
+  """(M,N) matrix of U(|points_m - centers_n|).
+  Distances are computed with matrix products, so inputs should be
+  centered near the origin to keep the rounding error small."""
+  squared = numpy.einsum('mi,mi->m', points, points)[:,numpy.newaxis] \
+      + numpy.einsum('ni,ni->n', centers, centers)[numpy.newaxis,:] \
+      - 2.0 * (points @ centers.T)
+  numpy.maximum(squared, 0, out=squared)
+  return numpy.sqrt(squared, out=squared)
+
+def _frame(source):
+  """Origin and scale of the polynomial basis for the source landmarks"""
+  if source.shape[0] == 0:
+    return numpy.zeros(3), 1.0
+  origin = source.mean(axis=0)
+  spread = numpy.sqrt(numpy.mean(numpy.sum((source - origin) ** 2, axis=1)))
+  return origin, (spread if spread > 0 else 1.0)
+
+def _polynomialBasis(centered, scale):
+  """(M,4) polynomial basis (1, x, y, z) in scaled coordinates"""
+  basis = numpy.empty((centered.shape[0],4))
+  basis[:,0] = 1.0
+  basis[:,1:] = centered / scale
+  return basis
+
+def _evaluate(centered, centers, coefficients, scale, chunkSize):
+  """Spline with coefficients (kernel weights then polynomial) at the
+  centered points, in chunks to bound the (chunk,N) kernel block"""
+  count = centers.shape[0]
+  result = numpy.empty_like(centered)
+  for start in range(0, centered.shape[0], chunkSize):
+    chunk = centered[start:start + chunkSize]
+    result[start:start + chunkSize] = thinPlateKernel(chunk, centers) @ coefficients[:count] \
+        + _polynomialBasis(chunk, scale) @ coefficients[count:]
+  return result
+
+
+class ThinPlateSpline:
+  """
+  Interpolating 3D thin plate spline mapping source landmarks onto
+  target landmarks.
+
+  Coordinates are shifted to the source centroid and the polynomial
+  part is expressed in units of the source spread, which keeps the
+  bordered system well scaled without changing the interpolant.
+
+  moveLandmark follows single landmark moves: a new target only
+  changes the right hand side, so the coefficients are corrected in
+  O(N); a new source changes one row and column of the system, a rank
+  two change applied to the inverse with the Woodbury identity in
+  O(N^2).  The inverse is recomputed every refitInterval source moves,
+  or when the update is badly conditioned, to bound the rounding drift.
+
+  With a positive regularization the spline is the smoothing spline
+  of the landmarks, see fittedTargets.
+  """
+
+  def __init__(self, source=None, target=None, refitInterval=64, regularization=0.0):
+    self.refitInterval = refitInterval
+    self.regularization = regularization
+    self.source = numpy.zeros((0,3))
+    self.target = numpy.zeros((0,3))
+    self.origin = numpy.zeros(3)
+    self.scale = 1.0
+    self.systemMatrix = None
+    self.systemInverse = None
+    self.coefficients = None # (N+4,3): kernel weights W then polynomial A
+    self.updateCount = 0
+    if source is not None:
+      self.fit(source, target)
+
+  def __len__(self):
+    return self.source.shape[0]
+
+  def _centered(self, points):
+    return _asPoints(points) - self.origin
+
+  def _polynomial(self, centered):
+    return _polynomialBasis(centered, self.scale)
+
+  def isValid(self):
+    return self.coefficients is not None
+
+  def invalidate(self):
+    """Drop the fit, fit must be called before the next use"""
+    self.systemMatrix = None
+    self.systemInverse = None
+    self.coefficients = None
+
+  def system(self):
+    """The (N+4,N+4) bordered kernel matrix of the source landmarks"""
+    count = len(self)
+    centered = self._centered(self.source)
+    polynomial = self._polynomial(centered)
+    matrix = numpy.zeros((count + 4, count + 4))
+    matrix[:count,:count] = thinPlateKernel(centered, centered)
+    matrix[numpy.arange(count),numpy.arange(count)] = -self.regularization
+    matrix[:count,count:] = polynomial
+    matrix[count:,:count] = polynomial.T
+    return matrix
+
+  def fit(self, source, target):
+    """Solve for the spline through the (N,3) landmark pairs.
+    Raises numpy.linalg.LinAlgError when the source landmarks are
+    coincident or all in one plane (fewer than 4 independent points)."""
+    source = _asPoints(source)
+    target = _asPoints(target)
+    if source.shape != target.shape:
+      raise ValueError("Expected matching landmarks, got %s and %s" % (source.shape, target.shape))
+    self.source = source.copy()
+    self.target = target.copy()
+    self.origin, self.scale = _frame(source)
+    self.refit()
+
+  def refit(self):
+    """Build and invert the system of the current landmarks"""
+    self.systemMatrix = self.system()
+    self.systemInverse = numpy.linalg.inv(self.systemMatrix)
+    self.updateCount = 0
+    self.updateCoefficients()
+
+  def _systemRow(self, index, source):
+    """Row index of the system with landmark index at source"""
+    centered = self._centered(source)
+    row = numpy.empty(len(self) + 4)
+    row[:len(self)] = thinPlateKernel(centered, self._centered(self.source))[0]
+    row[index] = -self.regularization
+    row[len(self):] = self._polynomial(centered)[0]
+    return row
+
+  def moveLandmark(self, index, source=None, target=None):
+    """Replace the source and/or target position of landmark index"""
+    if target is not None:
+      target = numpy.asarray(target, dtype=numpy.float64).reshape(3)
+      self.coefficients += numpy.outer(self.systemInverse[:,index], target - self.target[index])
+      self.target[index] = target
+    if source is None:
+      return
+    source = numpy.asarray(source, dtype=numpy.float64).reshape(3)
+    change = self._systemRow(index, source) - self.systemMatrix[index]
+    self.source[index] = source
+    self.systemMatrix[index] += change
+    self.systemMatrix[:,index] += change
+    self.updateCount += 1
+    if self.updateCount >= self.refitInterval:
+      self.refit()
+      return
+    # system + U V^T with U = [e_index, change] and V = [change, e_index]
+    inverseU = numpy.stack((self.systemInverse[:,index], self.systemInverse @ change), axis=1)
+    inverseV = inverseU[:,::-1]
+    capacitance = numpy.eye(2) + numpy.stack((change @ inverseU, inverseU[index]))
+    if abs(numpy.linalg.det(capacitance)) < 1e-10 * max(1.0, numpy.abs(capacitance).max() ** 2):
+      self.refit()
+      return
+    self.systemInverse -= inverseU @ numpy.linalg.solve(capacitance, inverseV.T)
+    self.updateCoefficients()
+
+  def updateCoefficients(self):
+    """Recompute the coefficients from the target landmarks"""
+    count = len(self)
+    self.coefficients = self.systemInverse[:,:count] @ (self.target - self.origin)
+
+  def fittedTargets(self):
+    """(N,3) positions the spline maps the source landmarks to: the
+    targets, or their smoothed positions with a regularization.  The
+    interpolating spline through the fitted targets is the same spline."""
+    return self.target + self.regularization * self.coefficients[:len(self)]
+
+  def transformPoints(self, points, chunkSize=4096):
+    """Map an (M,3) array of points through the spline.
+    Points are processed in chunks to bound the (chunk,N) kernel block."""
+    return _evaluate(self._centered(points), self._centered(self.source),
+                     self.coefficients, self.scale, chunkSize) + self.origin
+
+  def _valueAndJacobian(self, centered):
+    """Centered spline values (M,3) and Jacobians (M,3,3) at centered points.
+    The kernel gradient sum_i w_i (x - p_i) / r_i is formed as
+    x sum_i w_i / r_i - sum_i w_i p_i^T / r_i, two matrix products."""
+    count = len(self)
+    centers = self._centered(self.source)
+    weights = self.coefficients[:count]
+    distances = thinPlateKernel(centered, centers)
+    values = distances @ weights + self._polynomial(centered) @ self.coefficients[count:]
+    inverseDistances = numpy.divide(1.0, distances, out=numpy.zeros_like(distances), where=distances > 1e-12)
+    weightedCenters = (weights[:,:,numpy.newaxis] * centers[:,numpy.newaxis,:]).reshape(count, 9)
+    jacobians = centered[:,numpy.newaxis,:] * (inverseDistances @ weights)[:,:,numpy.newaxis] \
+        - (inverseDistances @ weightedCenters).reshape(-1,3,3) \
+        + self.coefficients[count+1:].T[numpy.newaxis] / self.scale
+    return values, jacobians
+
+  def inverseTransformPoints(self, points, tolerance=1e-3, iterations=30, chunkSize=4096):
+    """Map an (M,3) array of points back through the spline.
+    Like vtkThinPlateSplineTransform, each point is solved with Newton's
+    method from the first guess p - (f(p) - p), here for a whole chunk of
+    points at once until they are within tolerance.  Points that do not
+    converge in the given iterations keep their last estimate."""
+    targets = self._centered(points)
+    result = numpy.empty_like(targets)
+    for start in range(0, targets.shape[0], chunkSize):
+      target = targets[start:start + chunkSize]
+      values, _ = self._valueAndJacobian(target)
+      estimate = 2 * target - values
+      active = numpy.arange(target.shape[0])
+      for iteration in range(iterations):
+        values, jacobians = self._valueAndJacobian(estimate[active])
+        errors = values - target[active]
+        unconverged = numpy.einsum('mi,mi->m', errors, errors) > tolerance * tolerance
+        active, errors, jacobians = active[unconverged], errors[unconverged], jacobians[unconverged]
+        if active.shape[0] == 0:
+          break
+        try:
+          estimate[active] -= numpy.linalg.solve(jacobians, errors[:,:,numpy.newaxis])[:,:,0]
+        except numpy.linalg.LinAlgError:
+          break
+      result[start:start + chunkSize] = estimate
+    return result + self.origin
+
+  def leaveOneOutResiduals(self):
+    """(N,3) residuals of every landmark under the spline through the others.
+    For an interpolant with coefficients c = L^-1 y, leaving out
+    landmark i changes its prediction by c_i / (L^-1)_ii, so all the
+    residuals come from the inverse already computed by fit.
+    Landmarks that cannot be left out (fewer than 5 landmarks) get nan."""
+    count = len(self)
+    residuals = numpy.full((count,3), numpy.nan)
+    if count < 5:
+      return residuals
+    diagonal = numpy.diagonal(self.systemInverse)[:count]
+    usable = numpy.abs(diagonal) > 1e-300
+    residuals[usable] = -self.coefficients[:count][usable] / diagonal[usable,numpy.newaxis]
+    return residuals
+
+
+class ThinPlateSmoothing:
+  """
+  Smoothing thin plate splines of one landmark set, for any
+  regularization lam >= 0.
+
+  U(r) = r is conditionally negative definite, so on the null space of
+  P^T the bending energy -W^T K W is positive and the regularized system
+  has kernel block K - lam I.  With Q2 an orthonormal basis of that null
+  space and -Q2^T K Q2 = V E V^T diagonalized once in O(N^3), the
+  weights are W = -Q2 V (E + lam I)^-1 V^T Q2^T Q.  Coefficients, fitted
+  landmarks and leave-one-out residuals for each lam then cost O(N^2),
+  and the generalized cross validation score O(N).
+
+  Raises numpy.linalg.LinAlgError for fewer than 5 landmarks, or source
+  landmarks all in one plane.
+  """
+
+  def __init__(self, source, target):
+    source = _asPoints(source)
+    target = _asPoints(target)
+    if source.shape != target.shape:
+      raise ValueError("Expected matching landmarks, got %s and %s" % (source.shape, target.shape))
+    count = source.shape[0]
+    if count < 5:
+      raise numpy.linalg.LinAlgError("Smoothing needs at least 5 landmarks, got %d" % count)
+    self.source = source.copy()
+    self.target = target.copy()
+    self.origin, self.scale = _frame(source)
+    centered = source - self.origin
+    q, r = numpy.linalg.qr(_polynomialBasis(centered, self.scale), mode='complete')
+    triangleDiagonal = numpy.abs(numpy.diagonal(r))
+    if triangleDiagonal.min() <= 1e-10 * triangleDiagonal.max():
+      raise numpy.linalg.LinAlgError("Source landmarks are in one plane")
+    self.rangeBasis = q[:,:4]
+    self.triangle = r[:4]
+    self.kernel = thinPlateKernel(centered, centered)
+    self.kernel[numpy.arange(count),numpy.arange(count)] = 0.0
+    nullBasis = q[:,4:]
+    self.eigenvalues, eigenvectors = numpy.linalg.eigh(-(nullBasis.T @ self.kernel @ nullBasis))
+    self.basis = nullBasis @ eigenvectors # (N,N-4) orthonormal columns
+    self.squaredBasis = self.basis * self.basis
+    self.projection = self.basis.T @ (target - self.origin)
+    self.projectionSquares = numpy.einsum('ki,ki->k', self.projection, self.projection)
+
+  def __len__(self):
+    return self.source.shape[0]
+
+  def _shrinkage(self, regularization):
+    shrinkage = self.eigenvalues + regularization
+    if shrinkage.min() <= 1e-12 * numpy.abs(shrinkage).max():
+      raise numpy.linalg.LinAlgError("Singular system for regularization %g" % regularization)
+    return 1.0 / shrinkage
+
+  def weights(self, regularization):
+    """(N,3) kernel weights of the spline"""
+    return -self.basis @ (self.projection * self._shrinkage(regularization)[:,numpy.newaxis])
+
+  def coefficients(self, regularization):
+    """(N+4,3) coefficients laid out as ThinPlateSpline.coefficients"""
+    weights = self.weights(regularization)
+    polynomialPart = self.target - self.origin + regularization * weights - self.kernel @ weights
+    polynomial = numpy.linalg.solve(self.triangle, self.rangeBasis.T @ polynomialPart)
+    return numpy.vstack((weights, polynomial))
+
+  def fittedTargets(self, regularization):
+    """(N,3) smoothed target positions of the source landmarks"""
+    return self.target + regularization * self.weights(regularization)
+
+  def transformPoints(self, points, regularization, chunkSize=4096):
+    """Map an (M,3) array of points through the spline"""
+    return _evaluate(_asPoints(points) - self.origin, self.source - self.origin,
+                     self.coefficients(regularization), self.scale, chunkSize) + self.origin
+
+  def leaveOneOutResiduals(self, regularization):
+    """(N,3) residuals of every landmark under the spline fitted to the
+    others: W_i / G_ii with G = Q2 V (E + lam I)^-1 V^T Q2^T, the
+    regularized form of ThinPlateSpline.leaveOneOutResiduals"""
+    shrinkage = self._shrinkage(regularization)
+    weights = -self.basis @ (self.projection * shrinkage[:,numpy.newaxis])
+    return weights / (self.squaredBasis @ shrinkage)[:,numpy.newaxis]
+
+  def generalizedCrossValidation(self, regularizations):
+    """Generalized cross validation score N |(I - H) Q|^2 / tr(I - H)^2
+    of the influence matrix H for each regularization.  The factors of
+    lam cancel, so the score stays finite down to lam = 0."""
+    regularizations = numpy.atleast_1d(numpy.asarray(regularizations, dtype=numpy.float64))
+    shifted = self.eigenvalues[numpy.newaxis,:] + regularizations[:,numpy.newaxis]
+    usable = (shifted > 1e-12 * numpy.abs(shifted).max(axis=1, keepdims=True)).all(axis=1)
+    shrinkage = 1.0 / numpy.where(shifted > 0, shifted, 1.0)
+    scores = len(self) * ((shrinkage * shrinkage) @ self.projectionSquares) / shrinkage.sum(axis=1) ** 2
+    return numpy.where(usable, scores, numpy.inf)
+
+  def regularizationRange(self):
+    """(smallest, largest) regularizations that change the spline:
+    far below the smallest eigenvalue it interpolates, far above the
+    largest it is affine"""
+    largest = max(self.eigenvalues.max(), 1e-12)
+    smallest = max(self.eigenvalues.min(), largest * 1e-12)
+    return smallest * 1e-2, largest * 1e2
+
+  def optimalRegularization(self, regularizations=None):
+    """Regularization with the lowest generalized cross validation
+    score among regularizations (default: 0 and 256 values spread
+    logarithmically over regularizationRange)"""
+    if regularizations is None:
+      smallest, largest = self.regularizationRange()
+      regularizations = numpy.concatenate(([0.0], numpy.geomspace(smallest, largest, 256)))
+    regularizations = numpy.atleast_1d(numpy.asarray(regularizations, dtype=numpy.float64))
+    return float(regularizations[numpy.argmin(self.generalizedCrossValidation(regularizations))])
@@ -0,0 +1,69 @@
+import math, time
+import qt
+
+class UpdateScheduler:
+  """
+  Coalesces bursts of update requests (like point modified events
+  during a drag) so that the callback runs at most maximumRate times
+  per second.  Only the most recent request is kept; intermediate
+  ones are dropped and counted as skipped.  A maximumRate of 0 runs
+  every request immediately.
+
+  The interval is measured from the end of the previous run, so a
+  slow callback still leaves time for rendering and mouse events.
+  """
+
+  def __init__(self,callback,maximumRate=30):
+    self.callback = callback
+    self.maximumRate = maximumRate
+    self.pendingArguments = None
+    self.lastRunTime = None
+    self.processedCount = 0
+    self.skippedCount = 0
+    self.timer = qt.QTimer()
+    self.timer.singleShot = True
+    self.timer.connect('timeout()', self.runPending)
+
+  def request(self,*arguments):
+    """Run the callback with arguments now if the budget allows,
+    otherwise schedule it, replacing any request still pending"""
+    if self.pendingArguments is not None:
+      self.skippedCount += 1
+    self.pendingArguments = arguments
+    if self.timer.isActive():
+      return
+    wait = 0
+    if self.maximumRate > 0 and self.lastRunTime is not None:
+      wait = self.lastRunTime + 1. / self.maximumRate - time.perf_counter()
+    if wait <= 0:
+      self.runPending()
+    else:
+      self.timer.start(int(math.ceil(wait * 1000)))
+
+  def runPending(self):
+    """Run the pending request, if any"""
+    self.timer.stop()
+    if self.pendingArguments is None:
+      return
+    arguments = self.pendingArguments
+    self.pendingArguments = None
+    try:
+      self.callback(*arguments)
+    finally:
+      self.processedCount += 1
+      self.lastRunTime = time.perf_counter()
+
+  def cancel(self):
+    """Drop the pending request, e.g. because a final update follows"""
+    self.timer.stop()
+    if self.pendingArguments is not None:
+      self.skippedCount += 1
+      self.pendingArguments = None
+
+  def counts(self):
+    """Return (processed, skipped) since the last reset"""
+    return (self.processedCount, self.skippedCount)
+
+  def resetCounts(self):
+    self.processedCount = 0
+    self.skippedCount = 0
@@ -0,0 +1,57 @@
+import time
+import numpy
+from . import LinearSolver
+from .Residuals import ResidualReport, leaveOneOutResiduals, leaveOneOutMethods
+from .ThinPlateSpline import ThinPlateSpline
+
+#
+# Leave-one-out cross validation of landmark fits
+#
+# Refitting without each landmark in turn costs N fits, which is O(N^4)
+# for thin plate splines.  All the leave-one-out residuals are instead
+# read from a single fit (see Residuals.leaveOneOutResiduals), so the
+# whole validation costs about as much as one fit.
+#
+
+def fitResiduals(source, target, method='Rigid', scaleMode='vtk'):
+  """(N,3) residuals of the fit of method to all the landmark pairs"""
+  source = numpy.ascontiguousarray(source, dtype=numpy.float64).reshape(-1,3)
+  target = numpy.ascontiguousarray(target, dtype=numpy.float64).reshape(-1,3)
+  if method == 'ThinPlate':
+    try:
+      return ThinPlateSpline(source, target).transformPoints(source) - target
+    except numpy.linalg.LinAlgError:
+      return numpy.full(source.shape, numpy.nan)
+  matrix = LinearSolver.fitLinear(source, target, method, scaleMode=scaleMode)
+  return LinearSolver.transformPoints(matrix, source) - target
+
+def crossValidate(landmarkSet, method='Rigid', fixedColumn=0, movingColumn=1, scaleMode='vtk'):
+  """Return a ResidualReport with the fit and leave-one-out residuals
+  of every landmark of landmarkSet, for the fit of method (one of
+  leaveOneOutMethods) mapping the moving column onto the fixed one.
+  Landmarks without a defined position get nan."""
+  if method not in leaveOneOutMethods:
+    raise ValueError("Unknown method %s" % method)
+  definedMask = landmarkSet.definedMask()
+  moving = landmarkSet.column(movingColumn, definedOnly=True)
+  fixed = landmarkSet.column(fixedColumn, definedOnly=True)
+  residuals = numpy.full((len(landmarkSet),3), numpy.nan)
+  leaveOneOut = numpy.full((len(landmarkSet),3), numpy.nan)
+  if moving.shape[0]:
+    residuals[definedMask] = fitResiduals(moving, fixed, method, scaleMode)
+    leaveOneOut[definedMask] = leaveOneOutResiduals(moving, fixed, method, scaleMode)
+  return ResidualReport(landmarkSet.names, residuals, leaveOneOut)
+
+def benchmarkCrossValidation(counts=(100, 500, 1000, 2000), methods=leaveOneOutMethods, seed=0):
+  """Time the leave-one-out residuals on random landmark sets.
+  Returns a list of (method, count, seconds)."""
+  random = numpy.random.default_rng(seed)
+  timings = []
+  for count in counts:
+    source = random.normal(scale=50, size=(count,3))
+    target = source + random.normal(scale=2, size=(count,3))
+    for method in methods:
+      startTime = time.perf_counter()
+      leaveOneOutResiduals(source, target, method)
+      timings.append( (method, count, time.perf_counter() - startTime) )
+  return timings
@@ -0,0 +1,159 @@
+import logging
+import vtk, qt, ctk, slicer
+from . import RegistrationPlugin
+from . import GridExport
+from .WendlandSpline import WendlandSpline
+
+
+#########################################################
+#
+#
+comment = """
+
+  RegistrationPlugin is a superclass for code that plugs into the
+  slicer LandmarkRegistration module.
+
+  These classes are Abstract.
+
+# TODO :
+"""
+#
+#########################################################
+
+
+
+#
+# RegistrationPlugin
+#
+
+class WendlandPlugin(RegistrationPlugin):
+  """ Plugin for warps through many landmarks with compactly
+  supported radial basis functions, see WendlandSpline
+  """
+
+  #
+  # generic settings that can (should) be overridden by the subclass
+  #
+
+  # displayed for the user to select the registration
+  name = "Compact Support Registration"
+  tooltip = "Uses many landmarks, e.g. from surface correspondences, to define a local nonlinear warp"
+
+  # can be true or false
+  # - True: landmarks are displayed and managed by LandmarkRegistration
+  # - False: landmarks are hidden
+  usesLandmarks = True
+
+  # can be any non-negative number
+  # - widget will be disabled until landmarks are defined
+  landmarksNeededToEnable = 1
+
+  # used for reloading - every concrete class should include this
+  sourceFile = __file__
+
+  def __init__(self,parent=None):
+    super().__init__(parent)
+
+    self.wendlandSpline = None
+
+  def create(self,registrationState):
+    """Make the plugin-specific user interface"""
+    super().create(registrationState)
+    #
+    # Compact Support Registration Pane
+    #
+    wendlandCollapsibleButton = ctk.ctkCollapsibleButton()
+    wendlandCollapsibleButton.text = "Compact Support Registration"
+    wendlandFormLayout = qt.QFormLayout()
+    wendlandCollapsibleButton.setLayout(wendlandFormLayout)
+    self.widgets.append(wendlandCollapsibleButton)
+
+    self.radiusSpinBox = qt.QDoubleSpinBox()
+    self.radiusSpinBox.minimum = 0
+    self.radiusSpinBox.maximum = 1000
+    self.radiusSpinBox.decimals = 1
+    self.radiusSpinBox.suffix = " mm"
+    self.radiusSpinBox.specialValueText = "Automatic"
+    self.radiusSpinBox.setToolTip( "Distance over which a landmark moves its surroundings.  Larger values give smoother warps and slower fits.  Automatic reaches about ten neighboring landmarks." )
+    self.widgets.append(self.radiusSpinBox)
+    wendlandFormLayout.addRow("Support radius ", self.radiusSpinBox)
+
+    self.smoothingSpinBox = qt.QDoubleSpinBox()
+    self.smoothingSpinBox.minimum = 0
+    self.smoothingSpinBox.maximum = 100
+    self.smoothingSpinBox.decimals = 3
+    self.smoothingSpinBox.singleStep = 0.01
+    self.smoothingSpinBox.specialValueText = "Off"
+    self.smoothingSpinBox.setToolTip( "Follow the landmarks less closely, for noisy correspondences.  Off interpolates them." )
+    self.widgets.append(self.smoothingSpinBox)
+    wendlandFormLayout.addRow("Smoothing ", self.smoothingSpinBox)
+
+    self.gridSpacingSpinBox = qt.QDoubleSpinBox()
+    self.gridSpacingSpinBox.minimum = 0
+    self.gridSpacingSpinBox.maximum = 100
+    self.gridSpacingSpinBox.decimals = 2
+    self.gridSpacingSpinBox.suffix = " mm"
+    self.gridSpacingSpinBox.specialValueText = "Automatic"
+    self.gridSpacingSpinBox.setToolTip( "Spacing of the grid transform the warp is sampled on, down to the voxel spacing of the fixed volume.  Automatic resolves the support radius." )
+    self.widgets.append(self.gridSpacingSpinBox)
+    wendlandFormLayout.addRow("Grid spacing ", self.gridSpacingSpinBox)
+
+    applyButton = qt.QPushButton("Apply")
+    applyButton.toolTip = "Fit the warp to the current landmarks."
+    wendlandFormLayout.addWidget(applyButton)
+    applyButton.connect("clicked()",self.onWendlandApply)
+    self.widgets.append(applyButton)
+
+    self.parent.layout().addWidget(wendlandCollapsibleButton)
+
+  def destroy(self):
+    """Clean up"""
+    self.registrationState().logic.setLandmarkResiduals(None)
+    super().destroy()
+
+  def onLandmarkEndMoving(self,state):
+    """Called when the user changes a landmark"""
+    self.onWendlandApply()
+
+  def onWendlandApply(self):
+    """Call this whenever the warp needs to be calculated"""
+    state = self.registrationState()
+
+    if state.fixed and state.moving and state.transformed:
+      self.performWendlandRegistration(state)
+
+  def performWendlandRegistration(self, state):
+    """Fit the warp and sample it on a grid over the fixed volume.
+    The warp is fitted in the resampling direction, from the fixed
+    landmarks to the moving ones, so that the grid is the transform
+    from parent and resampling needs no inversion."""
+    if state.transformed.GetTransformNodeID() != state.transform.GetID():
+      state.transformed.SetAndObserveTransformNodeID(state.transform.GetID())
+
+    landmarkSet = state.landmarkSet()
+    fixedPoints = landmarkSet.column(0, definedOnly=True)
+    movingPoints = landmarkSet.column(1, definedOnly=True)
+    if fixedPoints.shape[0] == 0:
+      return
+    self.wendlandSpline = WendlandSpline(fixedPoints, movingPoints, radius=self.radiusSpinBox.value or None,
+                                         smoothing=self.smoothingSpinBox.value)
+    if not self.wendlandSpline.converged:
+      logging.warning("%s: the warp could not be fitted exactly, check for landmarks at the same position"
+                      " or increase the smoothing" % self.name)
+
+    # two samples per support radius resolve the warp
+    spacing = self.gridSpacingSpinBox.value or min(self.wendlandSpline.radius / 2, max(state.fixed.GetSpacing()) * 5)
+    origin, spacing, dimensions, directions = GridExport.volumeGridGeometry(state.fixed, spacing)
+    displacements = GridExport.sampleDisplacements(self.wendlandSpline.transformPoints, origin, spacing, dimensions, directions)
+    state.transform.SetAndObserveTransformFromParent(GridExport.gridTransform(displacements, origin, spacing, directions))
+    state.logic.updateLandmarkResiduals(state)
+
+
+# Add this plugin to the dictionary of available registrations.
+# Since this module may be discovered before the Editor itself,
+# create the list if it doesn't already exist.
+try:
+  slicer.modules.registrationPlugins
+except AttributeError:
+  slicer.modules.registrationPlugins = {}
+slicer.modules.registrationPlugins['Wendland'] = WendlandPlugin
@@ -0,0 +1,250 @@
+import itertools
+import numpy
+from . import LinearSolver
+
+#
+# Compactly supported radial basis warp on (N,3) landmark arrays
+#
+#   f(x) = A x + b + sum_i w_i phi(|x - p_i| / rho)
+#
+# with Wendland's C2 function phi(t) = (1 - t)^4 (4 t + 1) for t < 1 and
+# 0 beyond, which is positive definite in 3D.  The affine part is the
+# least squares fit of the landmarks and the kernel part interpolates
+# what it leaves.  A landmark only interacts with the landmarks within
+# the support radius rho, so the kernel matrix is sparse, and a point
+# is evaluated from the landmarks near it only.  Fitting and evaluation
+# scale with the number of neighbor pairs instead of N^3 and N per point.
+#
+# When scipy is available neighbors are found with its KD-tree and the
+# kernel matrix is solved with a sparse LU factorization.  Without it a
+# hashed grid of cells of the support radius finds the neighbors and the
+# system is solved by conjugate gradients, with numpy.bincount for the
+# sparse products; a smoothing term on the diagonal helps them converge.
+#
+
+def wendlandKernel(distances, radius):
+  """Wendland C2 function of distances / radius"""
+  t = numpy.minimum(numpy.asarray(distances, dtype=numpy.float64) / radius, 1.0)
+  return (1.0 - t) ** 4 * (4.0 * t + 1.0)
+
+def _scipy():
+  """scipy.spatial and scipy.sparse, or None when scipy is not installed"""
+  try:
+    import scipy.sparse, scipy.spatial
+  except ImportError:
+    return None
+  return scipy
+
+def _cellPairs(points, centers, radius):
+  """neighborPairs with a hashed grid of cells of size radius"""
+  lower = numpy.minimum(points.min(axis=0), centers.min(axis=0))
+  # shifted by one so that the neighbors of border cells have valid keys
+  pointCells = numpy.floor((points - lower) / radius).astype(numpy.int64) + 1
+  centerCells = numpy.floor((centers - lower) / radius).astype(numpy.int64) + 1
+  shape = numpy.maximum(pointCells.max(axis=0), centerCells.max(axis=0)) + 2
+  def cellKeys(cells):
+    return (cells[:,0] * shape[1] + cells[:,1]) * shape[2] + cells[:,2]
+  order = numpy.argsort(cellKeys(centerCells), kind='stable')
+  sortedKeys = cellKeys(centerCells)[order]
+  pointIndices, centerIndices, distances = [], [], []
+  for offset in itertools.product((-1, 0, 1), repeat=3):
+    queryKeys = cellKeys(pointCells + offset)
+    begin = numpy.searchsorted(sortedKeys, queryKeys, side='left')
+    counts = numpy.searchsorted(sortedKeys, queryKeys, side='right') - begin
+    total = counts.sum()
+    if total == 0:
+      continue
+    rows = numpy.repeat(numpy.arange(points.shape[0]), counts)
+    starts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    columns = order[numpy.repeat(begin, counts) + numpy.arange(total) - starts]
+    lengths = numpy.linalg.norm(points[rows] - centers[columns], axis=1)
+    near = lengths < radius
+    pointIndices.append(rows[near])
+    centerIndices.append(columns[near])
+    distances.append(lengths[near])
+  if not pointIndices:
+    return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+  return numpy.concatenate(pointIndices), numpy.concatenate(centerIndices), numpy.concatenate(distances)
+
+def neighborPairs(points, centers, radius, tree=None):
+  """All pairs of points and centers closer than radius, as arrays
+  (pointIndices, centerIndices, distances).  tree is an optional
+  scipy KD-tree of centers to reuse."""
+  points = numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1,3)
+  centers = numpy.ascontiguousarray(centers, dtype=numpy.float64).reshape(-1,3)
+  if points.shape[0] == 0 or centers.shape[0] == 0:
+    return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+  scipy = _scipy()
+  if scipy is None:
+    return _cellPairs(points, centers, radius)
+  if tree is None:
+    tree = scipy.spatial.cKDTree(centers)
+  pairs = scipy.spatial.cKDTree(points).sparse_distance_matrix(tree, radius, output_type='ndarray')
+  near = pairs['v'] < radius
+  return pairs['i'][near].astype(numpy.int64), pairs['j'][near].astype(numpy.int64), pairs['v'][near]
+
+def supportRadius(points, neighbors=10):
+  """Median distance from a landmark to its neighbors-th nearest other
+  landmark, so that a typical landmark interacts with about that many.
+  Without scipy it is found by growing a radius until the median
+  landmark has that many neighbors."""
+  points = numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1,3)
+  count = points.shape[0]
+  diagonal = numpy.linalg.norm(points.max(axis=0) - points.min(axis=0)) if count else 0.0
+  if count < 2 or diagonal == 0:
+    return 1.0
+  neighbors = min(neighbors, count - 1)
+  scipy = _scipy()
+  if scipy is not None:
+    distances, _ = scipy.spatial.cKDTree(points).query(points, k=neighbors + 1)
+    radius = numpy.median(distances[:,-1])
+    if radius > 0:
+      return radius
+  # start small, landmarks on a surface are closer than filling their box suggests
+  radius = diagonal * (neighbors / count) ** (1.0 / 3.0) / 8
+  while radius < 2 * diagonal:
+    pointIndices, _, _ = neighborPairs(points, points, radius)
+    if numpy.median(numpy.bincount(pointIndices, minlength=count)) - 1 >= neighbors:
+      break
+    radius *= 1.25
+  return radius
+
+class _SparseMatrix:
+  """Sparse matrix from (rows, columns, values) triplets, multiplied
+  with scipy.sparse when available and numpy.bincount otherwise"""
+
+  def __init__(self, rows, columns, values, shape):
+    self.rows, self.columns, self.values, self.shape = rows, columns, values, shape
+    scipy = _scipy()
+    self.matrix = scipy.sparse.csc_matrix((values, (rows, columns)), shape=shape) if scipy else None
+
+  def solve(self, rhs):
+    """Solve the symmetric positive definite system for each column of
+    rhs, with a sparse LU factorization when scipy is available and by
+    conjugate gradients otherwise.  Returns (x, converged)."""
+    if self.matrix is not None:
+      import scipy.sparse.linalg
+      try:
+        return scipy.sparse.linalg.splu(self.matrix, permc_spec='COLAMD').solve(rhs), True
+      except RuntimeError:
+        # exactly singular, e.g. coincident landmarks
+        pass
+    return conjugateGradient(self, rhs)
+
+  def __matmul__(self, vectors):
+    if self.matrix is not None:
+      return numpy.asarray(self.matrix @ vectors)
+    result = numpy.empty((self.shape[0], vectors.shape[1]))
+    for column in range(vectors.shape[1]):
+      result[:,column] = numpy.bincount(self.rows, weights=self.values * vectors[self.columns,column],
+                                        minlength=self.shape[0])
+    return result
+
+def conjugateGradient(matrix, rhs, tolerance=1e-8, iterations=None, diagonal=None, initial=None):
+  """Solve the symmetric positive definite system matrix @ x = rhs for
+  each column of rhs, all columns advancing together.  matrix only
+  needs to support matrix @ (N,k) arrays.  With the (N,) diagonal of
+  the matrix the iterations are Jacobi preconditioned.  Stops when every
+  residual is below tolerance relative to its right hand side.
+  Returns (x, converged)."""
+  if initial is None:
+    solution = numpy.zeros_like(rhs)
+    residual = rhs.copy()
+  else:
+    solution = numpy.array(initial, dtype=numpy.float64)
+    residual = rhs - matrix @ solution
+  inverseDiagonal = 1.0
+  if diagonal is not None:
+    diagonal = numpy.asarray(diagonal, dtype=numpy.float64)
+    inverseDiagonal = numpy.divide(1.0, diagonal, out=numpy.ones_like(diagonal), where=diagonal > 0)[:,numpy.newaxis]
+  preconditioned = inverseDiagonal * residual
+  direction = preconditioned.copy()
+  squares = numpy.einsum('ni,ni->i', residual, preconditioned)
+  thresholds = tolerance * tolerance * numpy.einsum('ni,ni->i', rhs, rhs)
+  if iterations is None:
+    iterations = min(max(100, 10 * rhs.shape[0]), 10000)
+  for iteration in range(iterations):
+    if (numpy.einsum('ni,ni->i', residual, residual) <= thresholds).all():
+      return solution, True
+    product = matrix @ direction
+    curvature = numpy.einsum('ni,ni->i', direction, product)
+    step = numpy.divide(squares, curvature, out=numpy.zeros_like(squares), where=curvature > 0)
+    solution += step * direction
+    residual -= step * product
+    preconditioned = inverseDiagonal * residual
+    newSquares = numpy.einsum('ni,ni->i', residual, preconditioned)
+    direction = preconditioned + numpy.divide(newSquares, squares, out=numpy.zeros_like(squares), where=squares > 0) * direction
+    squares = newSquares
+  return solution, bool((numpy.einsum('ni,ni->i', residual, residual) <= thresholds).all())
+
+class WendlandSpline:
+  """
+  Interpolating warp through (N,3) source and target landmarks with
+  Wendland compactly supported radial basis functions on top of the
+  least squares affine map, meant for landmark sets too large for a
+  thin plate spline.
+
+  radius is the support radius in world units; by default it is chosen
+  by supportRadius so that landmarks have about neighbors neighbors.
+  A larger support gives a smoother warp and a denser system.
+  A positive smoothing is added to the diagonal of the kernel matrix,
+  so the warp approximates the landmarks instead of interpolating them.
+  """
+
+  def __init__(self, source=None, target=None, radius=None, neighbors=10, smoothing=0.0):
+    self.neighbors = neighbors
+    self.smoothing = smoothing
+    self.radius = radius
+    self.source = numpy.zeros((0,3))
+    self.target = numpy.zeros((0,3))
+    self.affine = numpy.eye(4)
+    self.weights = numpy.zeros((0,3))
+    self.converged = True
+    self.tree = None
+    if source is not None:
+      self.fit(source, target, radius)
+
+  def __len__(self):
+    return self.source.shape[0]
+
+  def fit(self, source, target, radius=None):
+    """Solve for the warp through the landmark pairs.  Sets converged
+    to False if the system could not be solved to tolerance, which
+    happens with coincident landmarks and no smoothing."""
+    source = numpy.ascontiguousarray(source, dtype=numpy.float64).reshape(-1,3)
+    target = numpy.ascontiguousarray(target, dtype=numpy.float64).reshape(-1,3)
+    if source.shape != target.shape:
+      raise ValueError("Expected matching landmarks, got %s and %s" % (source.shape, target.shape))
+    self.source = source.copy()
+    self.target = target.copy()
+    if radius is not None:
+      self.radius = radius
+    elif self.radius is None:
+      self.radius = supportRadius(source, self.neighbors)
+    scipy = _scipy()
+    self.tree = scipy.spatial.cKDTree(source) if scipy and source.shape[0] else None
+
+    count = source.shape[0]
+    self.affine = LinearSolver.fitAffine(source, target)
+    remainder = target - LinearSolver.transformPoints(self.affine, source)
+    rows, columns, distances = neighborPairs(source, source, self.radius, self.tree)
+    values = wendlandKernel(distances, self.radius)
+    if self.smoothing:
+      values = numpy.where(rows == columns, values + self.smoothing, values)
+    kernel = _SparseMatrix(rows, columns, values, (count, count))
+    self.weights, self.converged = kernel.solve(remainder)
+
+  def transformPoints(self, points, chunkSize=65536):
+    """Map an (M,3) array of points through the warp, each from the
+    landmarks within the support radius.  Safe to call from several
+    threads."""
+    points = numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1,3)
+    result = LinearSolver.transformPoints(self.affine, points)
+    for start in range(0, points.shape[0], chunkSize):
+      chunk = points[start:start + chunkSize]
+      rows, columns, distances = neighborPairs(chunk, self.source, self.radius, self.tree)
+      values = wendlandKernel(distances, self.radius)
+      for axis in range(3):
+        result[start:start + chunk.shape[0],axis] += numpy.bincount(
+            rows, weights=values * self.weights[columns,axis], minlength=chunk.shape[0])
+    return result
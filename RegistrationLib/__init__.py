@@ -1,17 +1,41 @@
-from .pqWidget import *
-from .Visualization import *
-from .Landmarks import *
-from .RegistrationState import *
-from .RegistrationPlugin import *
+# the numerical modules need only numpy and vtk, so that scripts and the
+# worker processes of Bootstrap can import them outside the application
+from .LandmarkIO import *
+from . import LinearSolver
+from .Residuals import *
+from .ThinPlateSpline import *
+from .Validation import *
+from .Bootstrap import *
+from .GridExport import *
+from .WendlandSpline import *
+from .FreeFormDeformation import *
 
-for plugin in [
-  'Affine',
-  'ThinPlate',
-  'LocalBRAINSFit',
-  'LocalSimpleITK'
-  ]:
-  try:
-    __import__('RegistrationLib.%sPlugin' % plugin)
-  except ImportError as details:
-    import logging
-    logging.warning(f"Registration: Failed to import '{plugin}' plugin: {details}")
+try:
+  import qt as _qt
+except ImportError:
+  _qt = None
+
+if _qt is not None:
+  from .pqWidget import *
+  from .Visualization import *
+  from .Landmarks import *
+  from .LandmarkIndex import *
+  from .LandmarkSet import *
+  from .PointListAssociation import *
+  from .RegistrationState import *
+  from .RegistrationPlugin import *
+  from .UpdateScheduler import *
+
+  for plugin in [
+    'Affine',
+    'ThinPlate',
+    'Wendland',
+    'BSpline',
+    'LocalBRAINSFit',
+    'LocalSimpleITK'
+    ]:
+    try:
+      __import__('RegistrationLib.%sPlugin' % plugin)
+    except ImportError as details:
+      import logging
+      logging.warning(f"Registration: Failed to import '{plugin}' plugin: {details}")